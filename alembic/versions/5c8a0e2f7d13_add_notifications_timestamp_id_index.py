@@ -0,0 +1,29 @@
+"""Add notifications timestamp and id index
+
+Revision ID: 5c8a0e2f7d13
+Revises: b3e1f7c52d94
+Create Date: 2026-10-18 11:21:09.804416
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "5c8a0e2f7d13"
+down_revision = "b3e1f7c52d94"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_notifications_timestamp_id",
+        "notifications",
+        ["timestamp", "id"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index("ix_notifications_timestamp_id", table_name="notifications")
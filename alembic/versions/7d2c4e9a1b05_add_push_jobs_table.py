@@ -0,0 +1,45 @@
+"""Add push_jobs table
+
+Revision ID: 7d2c4e9a1b05
+Revises: 43f8a46a10f4
+Create Date: 2026-10-18 09:12:41.218734
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "7d2c4e9a1b05"
+down_revision = "43f8a46a10f4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "push_jobs",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("notification_id", sa.Integer(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("available_at", sa.DateTime(), nullable=False),
+        sa.Column("locked_until", sa.DateTime(), nullable=True),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["notification_id"],
+            ["notifications.id"],
+            name=op.f("fk_push_jobs_notification_id_notifications"),
+        ),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_push_jobs")),
+    )
+    op.create_index(op.f("ix_push_jobs_id"), "push_jobs", ["id"], unique=False)
+    op.create_index(
+        op.f("ix_push_jobs_available_at"), "push_jobs", ["available_at"], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_push_jobs_available_at"), table_name="push_jobs")
+    op.drop_index(op.f("ix_push_jobs_id"), table_name="push_jobs")
+    op.drop_table("push_jobs")
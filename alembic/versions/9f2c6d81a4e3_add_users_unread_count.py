@@ -0,0 +1,41 @@
+"""Add users unread_count
+
+Revision ID: 9f2c6d81a4e3
+Revises: e6d4b9a31f27
+Create Date: 2026-10-18 13:34:52.107285
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "9f2c6d81a4e3"
+down_revision = "e6d4b9a31f27"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("users", sa.Column("unread_count", sa.Integer(), nullable=True))
+    users = sa.sql.table("users", sa.sql.column("id"), sa.sql.column("unread_count"))
+    users_notifications = sa.sql.table(
+        "users_notifications", sa.sql.column("user_id"), sa.sql.column("is_read")
+    )
+    unread_count = (
+        sa.select([sa.func.count()])
+        .where(
+            sa.and_(
+                users_notifications.c.user_id == users.c.id,
+                users_notifications.c.is_read.is_(False),
+            )
+        )
+        .as_scalar()
+    )
+    op.execute(users.update().values(unread_count=unread_count))
+    op.alter_column("users", "unread_count", nullable=False)
+
+
+def downgrade():
+    op.drop_column("users", "unread_count")
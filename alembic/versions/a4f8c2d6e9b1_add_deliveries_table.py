@@ -0,0 +1,62 @@
+"""Add deliveries table
+
+Revision ID: a4f8c2d6e9b1
+Revises: 9f2c6d81a4e3
+Create Date: 2026-10-18 15:02:17.834519
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a4f8c2d6e9b1"
+down_revision = "9f2c6d81a4e3"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "deliveries",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("notification_id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("token", sa.String(), nullable=False),
+        sa.Column("platform", sa.String(), nullable=False),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("status_code", sa.Integer(), nullable=True),
+        sa.Column("reason", sa.String(), nullable=True),
+        sa.Column("latency", sa.Float(), nullable=False),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["notification_id"],
+            ["notifications.id"],
+            name=op.f("fk_deliveries_notification_id_notifications"),
+        ),
+        sa.ForeignKeyConstraint(
+            ["user_id"],
+            ["users.id"],
+            name=op.f("fk_deliveries_user_id_users"),
+        ),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_deliveries")),
+    )
+    op.create_index(op.f("ix_deliveries_id"), "deliveries", ["id"], unique=False)
+    op.create_index(
+        op.f("ix_deliveries_notification_id"),
+        "deliveries",
+        ["notification_id"],
+        unique=False,
+    )
+    op.create_index(
+        op.f("ix_deliveries_user_id"), "deliveries", ["user_id"], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_deliveries_user_id"), table_name="deliveries")
+    op.drop_index(op.f("ix_deliveries_notification_id"), table_name="deliveries")
+    op.drop_index(op.f("ix_deliveries_id"), table_name="deliveries")
+    op.drop_table("deliveries")
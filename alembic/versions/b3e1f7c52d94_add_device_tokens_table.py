@@ -0,0 +1,115 @@
+"""Add device_tokens table
+
+Revision ID: b3e1f7c52d94
+Revises: 7d2c4e9a1b05
+Create Date: 2026-10-18 10:03:27.561402
+
+"""
+
+from datetime import datetime, timezone
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "b3e1f7c52d94"
+down_revision = "7d2c4e9a1b05"
+branch_labels = None
+depends_on = None
+
+
+def get_platform(token):
+    if len(token) == 64:
+        return "ios"
+    if len(token) > 64:
+        return "android"
+    return None
+
+
+def upgrade():
+    device_tokens = op.create_table(
+        "device_tokens",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("token", sa.String(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("platform", sa.String(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("last_success_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["user_id"],
+            ["users.id"],
+            name=op.f("fk_device_tokens_user_id_users"),
+        ),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_device_tokens")),
+        sa.UniqueConstraint("token", name=op.f("uq_device_tokens_token")),
+    )
+    op.create_index(op.f("ix_device_tokens_id"), "device_tokens", ["id"], unique=False)
+    op.create_index(
+        "ix_device_tokens_user_id_platform",
+        "device_tokens",
+        ["user_id", "platform"],
+        unique=False,
+    )
+    # Move the tokens from the ";" separated users._device_tokens column.
+    # A device token is unique: if several users registered the same device,
+    # it's kept for the user who logged in last.
+    conn = op.get_bind()
+    users = sa.sql.table(
+        "users",
+        sa.sql.column("id"),
+        sa.sql.column("_device_tokens"),
+        sa.sql.column("login_token_expire_date"),
+    )
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    rows = []
+    seen = set()
+    for user_id, value in conn.execute(
+        sa.select([users.c.id, users.c._device_tokens]).order_by(
+            users.c.login_token_expire_date.desc()
+        )
+    ):
+        for token in (value or "").split(";"):
+            if not token or token in seen:
+                continue
+            seen.add(token)
+            rows.append(
+                {
+                    "token": token,
+                    "user_id": user_id,
+                    "platform": get_platform(token),
+                    "created_at": now,
+                }
+            )
+    if rows:
+        op.bulk_insert(device_tokens, rows)
+    with op.batch_alter_table("users") as batch_op:
+        batch_op.drop_column("_device_tokens")
+
+
+def downgrade():
+    with op.batch_alter_table("users") as batch_op:
+        batch_op.add_column(sa.Column("_device_tokens", sa.VARCHAR(), nullable=True))
+    conn = op.get_bind()
+    device_tokens = sa.sql.table(
+        "device_tokens",
+        sa.sql.column("id"),
+        sa.sql.column("token"),
+        sa.sql.column("user_id"),
+    )
+    users = sa.sql.table("users", sa.sql.column("id"), sa.sql.column("_device_tokens"))
+    tokens = {}
+    for user_id, token in conn.execute(
+        sa.select([device_tokens.c.user_id, device_tokens.c.token]).order_by(
+            device_tokens.c.id
+        )
+    ):
+        tokens.setdefault(user_id, []).append(token)
+    for user_id, user_tokens in tokens.items():
+        conn.execute(
+            users.update()
+            .where(users.c.id == user_id)
+            .values(_device_tokens=";".join(user_tokens))
+        )
+    op.drop_index("ix_device_tokens_user_id_platform", table_name="device_tokens")
+    op.drop_index(op.f("ix_device_tokens_id"), table_name="device_tokens")
+    op.drop_table("device_tokens")
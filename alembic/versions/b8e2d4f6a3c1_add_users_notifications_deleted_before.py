@@ -0,0 +1,28 @@
+"""Add users notifications_deleted_before
+
+Revision ID: b8e2d4f6a3c1
+Revises: f2c8e4a6b1d9
+Create Date: 2026-10-18 21:15:02.448391
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "b8e2d4f6a3c1"
+down_revision = "f2c8e4a6b1d9"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "users",
+        sa.Column("notifications_deleted_before", sa.DateTime(), nullable=True),
+    )
+
+
+def downgrade():
+    op.drop_column("users", "notifications_deleted_before")
@@ -0,0 +1,41 @@
+"""Add notification_id and deleted_at indexes
+
+Revision ID: c3f9a7e5d2b4
+Revises: b8e2d4f6a3c1
+Create Date: 2026-10-18 21:48:37.120554
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "c3f9a7e5d2b4"
+down_revision = "b8e2d4f6a3c1"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_users_notifications_notification_id",
+        "users_notifications",
+        ["notification_id"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_deleted_users_notifications_deleted_at",
+        "deleted_users_notifications",
+        ["deleted_at"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index(
+        "ix_deleted_users_notifications_deleted_at",
+        table_name="deleted_users_notifications",
+    )
+    op.drop_index(
+        "ix_users_notifications_notification_id", table_name="users_notifications"
+    )
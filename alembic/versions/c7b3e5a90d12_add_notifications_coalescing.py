@@ -0,0 +1,35 @@
+"""Add services coalescing_window and push_jobs nb_notifications
+
+Revision ID: c7b3e5a90d12
+Revises: a4f8c2d6e9b1
+Create Date: 2026-10-18 16:21:45.519307
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "c7b3e5a90d12"
+down_revision = "a4f8c2d6e9b1"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "services",
+        sa.Column(
+            "coalescing_window", sa.Integer(), server_default="0", nullable=False
+        ),
+    )
+    op.add_column(
+        "push_jobs",
+        sa.Column("nb_notifications", sa.Integer(), server_default="1", nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_column("push_jobs", "nb_notifications")
+    op.drop_column("services", "coalescing_window")
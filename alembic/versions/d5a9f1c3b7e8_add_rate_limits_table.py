@@ -0,0 +1,31 @@
+"""Add rate_limits table
+
+Revision ID: d5a9f1c3b7e8
+Revises: c7b3e5a90d12
+Create Date: 2026-10-18 17:08:31.274906
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "d5a9f1c3b7e8"
+down_revision = "c7b3e5a90d12"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "rate_limits",
+        sa.Column("key", sa.String(), nullable=False),
+        sa.Column("tokens", sa.Float(), nullable=False),
+        sa.Column("updated_at", sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint("key", name=op.f("pk_rate_limits")),
+    )
+
+
+def downgrade():
+    op.drop_table("rate_limits")
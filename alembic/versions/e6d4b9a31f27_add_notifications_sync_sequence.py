@@ -0,0 +1,70 @@
+"""Add notifications sync sequence
+
+Revision ID: e6d4b9a31f27
+Revises: 5c8a0e2f7d13
+Create Date: 2026-10-18 12:07:45.319862
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e6d4b9a31f27"
+down_revision = "5c8a0e2f7d13"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("users", sa.Column("sync_sequence", sa.Integer(), nullable=True))
+    users = sa.sql.table("users", sa.sql.column("sync_sequence"))
+    op.execute(users.update().values(sync_sequence=0))
+    op.alter_column("users", "sync_sequence", nullable=False)
+    op.add_column(
+        "users_notifications", sa.Column("sequence", sa.Integer(), nullable=True)
+    )
+    users_notifications = sa.sql.table("users_notifications", sa.sql.column("sequence"))
+    op.execute(users_notifications.update().values(sequence=0))
+    op.alter_column("users_notifications", "sequence", nullable=False)
+    op.create_index(
+        "ix_users_notifications_user_id_sequence",
+        "users_notifications",
+        ["user_id", "sequence"],
+        unique=False,
+    )
+    op.create_table(
+        "deleted_users_notifications",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("notification_id", sa.Integer(), nullable=False),
+        sa.Column("sequence", sa.Integer(), nullable=False),
+        sa.Column("deleted_at", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["user_id"],
+            ["users.id"],
+            name=op.f("fk_deleted_users_notifications_user_id_users"),
+        ),
+        sa.PrimaryKeyConstraint(
+            "user_id", "notification_id", name=op.f("pk_deleted_users_notifications")
+        ),
+    )
+    op.create_index(
+        "ix_deleted_users_notifications_user_id_sequence",
+        "deleted_users_notifications",
+        ["user_id", "sequence"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index(
+        "ix_deleted_users_notifications_user_id_sequence",
+        table_name="deleted_users_notifications",
+    )
+    op.drop_table("deleted_users_notifications")
+    op.drop_index(
+        "ix_users_notifications_user_id_sequence", table_name="users_notifications"
+    )
+    op.drop_column("users_notifications", "sequence")
+    op.drop_column("users", "sync_sequence")
@@ -0,0 +1,28 @@
+"""Add users sync_floor
+
+Revision ID: f2c8e4a6b1d9
+Revises: d5a9f1c3b7e8
+Create Date: 2026-10-18 19:42:13.806152
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "f2c8e4a6b1d9"
+down_revision = "d5a9f1c3b7e8"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "users",
+        sa.Column("sync_floor", sa.Integer(), server_default="0", nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_column("users", "sync_floor")
@@ -4,7 +4,7 @@ from fastapi import APIRouter, Depends, HTTPException, Response, Request, status
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.logger import logger
 from sqlalchemy.orm import Session
-from .. import deps, crud, utils, auth, schemas
+from .. import auth, crud, crud_async, deps, schemas, utils
 from ..settings import (
     ACCESS_TOKEN_EXPIRE_MINUTES,
     OIDC_CLIENT_SECRET,
@@ -130,4 +130,4 @@ async def open_id_connect(
                 status_code=exc.response.status_code, detail="Failed to get user info"
             )
         username = response.json()["preferred_username"].lower()
-    return create_access_token(db, username, response)
+    return await crud_async.run(create_access_token, db, username, response)
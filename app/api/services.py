@@ -1,19 +1,31 @@
+import math
 import uuid
 from fastapi import (
     APIRouter,
     Depends,
+    Request,
     Response,
-    BackgroundTasks,
     HTTPException,
     Header,
+    Query,
     status,
 )
+from fastapi.exceptions import RequestValidationError
 from fastapi.logger import logger
+from pydantic import Field, TypeAdapter, ValidationError
 from sqlalchemy.orm import Session
 from typing import List, Optional
-from .. import deps, crud, models, schemas, utils
+from typing_extensions import Annotated
+from .. import deps, crud, crud_async, metrics, models, ratelimit, schemas, utils
+from ..settings import NOTIFICATIONS_BATCH_MAX_BYTES, NOTIFICATIONS_BATCH_MAX_SIZE
 
 router = APIRouter()
+NotificationsBatch = TypeAdapter(
+    Annotated[
+        List[schemas.NotificationCreate],
+        Field(min_length=1, max_length=NOTIFICATIONS_BATCH_MAX_SIZE),
+    ]
+)
 
 
 @router.get("/", response_model=List[schemas.Service])
@@ -88,6 +100,20 @@ def read_service_notifications(
     return db_service.notifications
 
 
+def _check_rate_limit(
+    rate_limit: ratelimit.RateLimit, key: str, nb_notifications: int = 1
+) -> None:
+    retry_after = rate_limit.acquire(key, nb_notifications)
+    if retry_after:
+        logger.warning(f"Too many notifications created ({rate_limit.scope} {key})")
+        metrics.notifications_rate_limited.labels(scope=rate_limit.scope).inc()
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many notifications",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+
 @router.post(
     "/{service_id}/notifications",
     response_model=schemas.Notification,
@@ -96,24 +122,198 @@ def read_service_notifications(
 def create_notification_for_service(
     service_id: uuid.UUID,
     notification: schemas.NotificationCreate,
-    background_tasks: BackgroundTasks,
+    request: Request,
     db: Session = Depends(deps.get_db),
     x_forwarded_for: Optional[List[str]] = Header(None),
 ):
-    """Create a notification for the given service"""
+    """Create a notification for the given service
+
+    The notification is queued and sent to the subscribers by the push workers.
+    The number of notifications is limited per source IP and per service.
+    """
     if not utils.check_ips(x_forwarded_for):
         logger.warning(f"IP(s) {x_forwarded_for} not allowed to create a notification!")
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN, detail="IP address not allowed"
         )
+    _check_rate_limit(ratelimit.per_ip, utils.get_client_ip(request, x_forwarded_for))
     db_service = crud.get_service(db, service_id)
     if db_service is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Service not found"
         )
+    _check_rate_limit(ratelimit.per_service, str(service_id))
     db_notification = crud.create_service_notification(
         db=db, notification=notification, service=db_service
     )
-    # Send notification using background task
-    background_tasks.add_task(utils.send_notification, db_notification.id)
     return db_notification
+
+
+async def _read_body(request: Request, max_size: int) -> bytes:
+    """Return the body of the request, rejected if larger than max_size bytes
+
+    The Content-Length is checked first and the body is not read further than
+    max_size when streamed.
+    """
+    too_large = HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail="Request body too large",
+    )
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > max_size:
+        raise too_large
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > max_size:
+            raise too_large
+    return bytes(body)
+
+
+def _parse_notifications(
+    body: bytes, content_type: str
+) -> List[schemas.NotificationCreate]:
+    """Return the notifications sent as a JSON array or as NDJSON"""
+    if content_type.startswith("application/x-ndjson"):
+        lines = [line for line in body.splitlines() if line.strip()]
+        if len(lines) > NOTIFICATIONS_BATCH_MAX_SIZE:
+            raise RequestValidationError(
+                [
+                    {
+                        "type": "too_long",
+                        "loc": ("body",),
+                        "msg": f"List should have at most {NOTIFICATIONS_BATCH_MAX_SIZE}"
+                        f" items after validation, not {len(lines)}",
+                        "ctx": {
+                            "field_type": "List",
+                            "max_length": NOTIFICATIONS_BATCH_MAX_SIZE,
+                            "actual_length": len(lines),
+                        },
+                    }
+                ]
+            )
+        body = b"[" + b",".join(lines) + b"]"
+    try:
+        return NotificationsBatch.validate_json(body)
+    except ValidationError as e:
+        raise RequestValidationError(
+            [
+                {**error, "loc": ("body", *error["loc"])}
+                for error in e.errors(include_url=False)
+            ]
+        )
+
+
+@router.post(
+    "/{service_id}/notifications:batch",
+    response_model=List[schemas.Notification],
+    status_code=status.HTTP_201_CREATED,
+    # The body is parsed by the endpoint (JSON or NDJSON)
+    openapi_extra={
+        "requestBody": {
+            "content": {
+                content_type: {
+                    "schema": {
+                        "type": "array",
+                        "items": {"$ref": "#/components/schemas/NotificationCreate"},
+                    }
+                }
+                for content_type in ("application/json", "application/x-ndjson")
+            },
+            "required": True,
+        }
+    },
+)
+async def create_notifications_for_service(
+    service_id: uuid.UUID,
+    request: Request,
+    db: Session = Depends(deps.get_db),
+    x_forwarded_for: Optional[List[str]] = Header(None),
+):
+    """Create several notifications for the given service
+
+    The body is a JSON array of notifications or NDJSON (one notification
+    per line, with the application/x-ndjson content type).
+    The notifications are created in one transaction and pushed as one summary.
+    Each notification counts for the rate limits.
+    """
+    if not utils.check_ips(x_forwarded_for):
+        logger.warning(f"IP(s) {x_forwarded_for} not allowed to create a notification!")
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="IP address not allowed"
+        )
+    body = await _read_body(request, NOTIFICATIONS_BATCH_MAX_BYTES)
+    notifications = _parse_notifications(body, request.headers.get("content-type", ""))
+    # The database backend of the rate limits is blocking
+    await crud_async.run(
+        _check_rate_limit,
+        ratelimit.per_ip,
+        utils.get_client_ip(request, x_forwarded_for),
+        len(notifications),
+    )
+    db_service = await crud_async.get_service(db, service_id)
+    if db_service is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Service not found"
+        )
+    # Attributes are expired by the commit: don't load them in the event loop
+    category = db_service.category
+    await crud_async.run(
+        _check_rate_limit, ratelimit.per_service, str(service_id), len(notifications)
+    )
+    db_notifications = await crud_async.create_service_notifications(
+        db, notifications, db_service
+    )
+    logger.info(f"{len(db_notifications)} notifications created for '{category}'")
+    return db_notifications
+
+
+def _get_service_notification(
+    db: Session, service_id: uuid.UUID, notification_id: int
+) -> models.Notification:
+    db_notification = crud.get_notification(db, notification_id)
+    if db_notification is None or db_notification.service_id != service_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Notification not found"
+        )
+    return db_notification
+
+
+@router.get(
+    "/{service_id}/notifications/{notification_id}/deliveries",
+    response_model=List[schemas.Delivery],
+)
+def read_notification_deliveries(
+    service_id: uuid.UUID,
+    notification_id: int,
+    limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+    after: Optional[int] = None,
+    status: Optional[schemas.DeliveryStatus] = None,
+    db: Session = Depends(deps.get_db),
+    current_user: models.User = Depends(deps.get_current_admin_user),
+):
+    """Read the outcome of the notification for each device - admin only
+
+    Deliveries are ordered by id (limited to 100 by default).
+    Pass the id of the last one received as after to get the next page.
+    Use status (e.g. failure) to only get the deliveries that didn't succeed.
+    """
+    _get_service_notification(db, service_id, notification_id)
+    return crud.get_deliveries(
+        db, notification_id, limit=limit, after=after, status=status
+    )
+
+
+@router.get(
+    "/{service_id}/notifications/{notification_id}/deliveries/summary",
+    response_model=schemas.DeliverySummary,
+)
+def read_notification_delivery_summary(
+    service_id: uuid.UUID,
+    notification_id: int,
+    db: Session = Depends(deps.get_db),
+    current_user: models.User = Depends(deps.get_current_admin_user),
+):
+    """Read the number of deliveries per status and reason - admin only"""
+    _get_service_notification(db, service_id, notification_id)
+    return crud.get_delivery_summary(db, notification_id)
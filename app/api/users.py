@@ -1,7 +1,8 @@
-from fastapi import APIRouter, Depends, Response, HTTPException, status
+from fastapi import APIRouter, Depends, Query, Response, HTTPException, status
 from .._vendor.fastapi_versioning import version
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
+from typing_extensions import Annotated
 from .. import deps, crud, models, schemas
 
 router = APIRouter()
@@ -161,14 +162,49 @@ def update_current_user_services(
 def read_current_user_notifications(
     limit: int = 50,
     sort: schemas.SortOrder = schemas.SortOrder.asc,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
     db: Session = Depends(deps.get_db),
     current_user: models.User = Depends(deps.get_current_user),
 ):
     """Return the current user's notifications (limited to 50 by default)
 
     Notifications are sorted in ascending order by default
+
+    To page through the notifications, pass the id of the oldest notification
+    received as before (to get older ones) or the id of the newest one
+    as after (to get the ones received since).
     """
-    return crud.get_user_notifications(db, current_user, limit=limit, sort=sort)
+    return crud.get_user_notifications(
+        db, current_user, limit=limit, sort=sort, before=before, after=after
+    )
+
+
+@router.get("/user/notifications/sync", response_model=schemas.UserNotificationsSync)
+def sync_current_user_notifications(
+    sync_token: Optional[int] = None,
+    limit: Annotated[int, Query(ge=1, le=1000)] = 50,
+    cursor: Optional[int] = None,
+    db: Session = Depends(deps.get_db),
+    current_user: models.User = Depends(deps.get_current_user),
+):
+    """Return the current user's notifications changed since sync_token
+
+    Notifications created or with a read status changed are returned,
+    as well as the ids of the deleted ones.
+    All notifications are returned if no sync_token is passed, or with
+    full_resync set if the sync_token is too old: the client shall then replace
+    its list of notifications.
+    That full list is paginated (limit per page): while next_cursor is set,
+    pass it as cursor (without sync_token) to get the next page.
+    The sync_token of the response (of the first page) shall be passed
+    on the next call.
+    Notifications older than deleted_before were deleted by the retention
+    policy: the client shall drop them.
+    """
+    return crud.sync_user_notifications(
+        db, current_user, sync_token, limit=limit, cursor=cursor
+    )
 
 
 @router.patch("/user/notifications", status_code=status.HTTP_204_NO_CONTENT)
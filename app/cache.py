@@ -0,0 +1,97 @@
+"""Cache of the authenticated users
+
+Each API call authenticated with a bearer token has to resolve the user from
+the token subject (username). The identity of the user is kept in memory for a
+short time to avoid querying the users table on every call.
+The cache is local to each process: entries are invalidated when the user is
+updated or deleted by this process and expire after USER_CACHE_TTL seconds.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import NamedTuple, Optional, Tuple
+from sqlalchemy.orm import Session, make_transient_to_detached
+from . import models
+from .settings import USER_CACHE_SIZE, USER_CACHE_TTL
+
+
+class CachedUser(NamedTuple):
+    id: int
+    username: str
+    is_active: bool
+    is_admin: bool
+    login_token_expire_date: datetime
+
+    @classmethod
+    def from_user(cls, user: models.User) -> "CachedUser":
+        return cls(
+            id=user.id,
+            username=user.username,
+            is_active=user.is_active,
+            is_admin=user.is_admin,
+            login_token_expire_date=user.login_token_expire_date,
+        )
+
+    def to_user(self, db: Session) -> models.User:
+        """Return the user attached to the session without querying the database
+
+        Other attributes and relationships are loaded on access.
+        """
+        user = models.User(**self._asdict())
+        make_transient_to_detached(user)
+        return db.merge(user, load=False)
+
+
+class UserCache:
+    """LRU cache of the users identity with a time to live
+
+    A size or ttl of 0 disables the cache.
+    """
+
+    def __init__(self, size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._users: OrderedDict[str, Tuple[float, CachedUser]] = OrderedDict()
+        # Sync dependencies run in the threadpool
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0 and self.ttl > 0
+
+    def get(self, username: str) -> Optional[CachedUser]:
+        with self._lock:
+            try:
+                expire, user = self._users[username]
+            except KeyError:
+                return None
+            if expire < time.monotonic():
+                del self._users[username]
+                return None
+            self._users.move_to_end(username)
+            return user
+
+    def set(self, user: models.User) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._users[user.username] = (
+                time.monotonic() + self.ttl,
+                CachedUser.from_user(user),
+            )
+            self._users.move_to_end(user.username)
+            while len(self._users) > self.size:
+                self._users.popitem(last=False)
+
+    def invalidate(self, username: str) -> None:
+        with self._lock:
+            self._users.pop(username, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._users.clear()
+
+
+users = UserCache()
@@ -0,0 +1,226 @@
+"""Long-lived HTTP clients used to send push notifications
+
+Creating new clients for each notification means paying the TLS and HTTP/2
+handshakes every time. Instead, each process keeps a small pool of connections
+to APNs and FCM that are shared by all notifications.
+Both APNs and FCM support HTTP/2: many requests are multiplexed (as streams)
+on each connection.
+The pools are started and stopped by the push worker (see app.worker.main).
+When not started explicitly, a pool is opened on first use.
+"""
+
+import asyncio
+import contextlib
+import email.utils
+import httpx
+from datetime import datetime, timezone
+from typing import AsyncIterator, List, Optional
+from fastapi.logger import logger
+from .settings import (
+    PUSH_CONNECTIONS,
+    PUSH_MAX_STREAMS,
+    PUSH_KEEPALIVE_EXPIRY,
+    PUSH_HEALTH_CHECK_INTERVAL,
+    PUSH_MAX_TRANSPORT_ERRORS,
+)
+
+
+class Transport(httpx.AsyncHTTPTransport):
+    """Transport counting the consecutive errors (connection failures, timeouts...)"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.errors = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        try:
+            response = await super().handle_async_request(request)
+        except httpx.TransportError:
+            self.errors += 1
+            raise
+        self.errors = 0
+        return response
+
+
+class Connection:
+    """A client limited to one connection (with HTTP/2)
+
+    The number of concurrent requests (streams) is limited to max_streams.
+    """
+
+    def __init__(
+        self, client: httpx.AsyncClient, transport: Transport, max_streams: int
+    ):
+        self.client = client
+        self.transport = transport
+        self.streams = asyncio.Semaphore(max_streams)
+        self.in_flight = 0
+
+
+class ClientPool:
+    """Pool of long-lived HTTP clients
+
+    Requests are dispatched to the least busy connection.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        size: int = PUSH_CONNECTIONS,
+        max_streams: int = PUSH_MAX_STREAMS,
+        http2: bool = True,
+        http1: bool = True,
+        keepalive_expiry: float = PUSH_KEEPALIVE_EXPIRY,
+        health_check_interval: float = PUSH_HEALTH_CHECK_INTERVAL,
+        max_errors: int = PUSH_MAX_TRANSPORT_ERRORS,
+    ):
+        self.name = name
+        self.size = size
+        self.max_streams = max_streams
+        self.http2 = http2
+        # Disable HTTP/1.1 to use HTTP/2 without TLS (prior knowledge)
+        self.http1 = http1
+        self.keepalive_expiry = keepalive_expiry
+        self.health_check_interval = health_check_interval
+        self.max_errors = max_errors
+        self.connections: List[Connection] = []
+        # Connections replaced but still used by requests in flight
+        self._retired: List[Connection] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._health_check_task: Optional[asyncio.Task] = None
+
+    def _create_connection(self) -> Connection:
+        # Without HTTP/2, a connection can only handle one request at a time
+        max_connections = 1 if self.http2 else self.max_streams
+        transport = Transport(
+            http2=self.http2,
+            http1=self.http1,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+        )
+        return Connection(
+            httpx.AsyncClient(transport=transport), transport, self.max_streams
+        )
+
+    async def _open(self) -> None:
+        # Clients created in another event loop (they can't be reused)
+        old_connections = self.connections + self._retired
+        self._loop = asyncio.get_running_loop()
+        self.connections = [self._create_connection() for _ in range(self.size)]
+        self._retired = []
+        await self._close(old_connections)
+
+    async def _close(self, connections: List[Connection]) -> None:
+        for connection in connections:
+            try:
+                await connection.client.aclose()
+            except Exception as e:
+                logger.warning(f"Failed to close {self.name} client: {e!r}")
+
+    @property
+    def is_started(self) -> bool:
+        # Clients can't be shared between event loops
+        return bool(self.connections) and self._loop is asyncio.get_running_loop()
+
+    async def start(self) -> None:
+        """Open the connections and start the periodic health check"""
+        if not self.is_started:
+            await self._open()
+        if self._health_check_task is None:
+            self._health_check_task = asyncio.create_task(self._run_health_check())
+        logger.info(f"{self.name} client pool started ({self.size} connections)")
+
+    async def stop(self) -> None:
+        """Stop the health check and close all the connections"""
+        if self._health_check_task is not None:
+            self._health_check_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._health_check_task
+            self._health_check_task = None
+        await self._close(self.connections + self._retired)
+        self.connections = []
+        self._retired = []
+        self._loop = None
+
+    def is_healthy(self, connection: Connection) -> bool:
+        return (
+            not connection.client.is_closed
+            and connection.transport.errors < self.max_errors
+        )
+
+    async def check_health(self) -> None:
+        """Replace the clients that were closed or keep failing
+
+        A replaced client is closed once its requests in flight are done.
+        """
+        for index, connection in enumerate(self.connections):
+            if not self.is_healthy(connection):
+                logger.warning(
+                    f"{self.name} client closed or failing "
+                    f"({connection.transport.errors} errors). Opening a new one."
+                )
+                self.connections[index] = self._create_connection()
+                self._retired.append(connection)
+        idle = [connection for connection in self._retired if not connection.in_flight]
+        self._retired = [
+            connection for connection in self._retired if connection.in_flight
+        ]
+        await self._close(idle)
+
+    async def _run_health_check(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            await self.check_health()
+
+    @contextlib.asynccontextmanager
+    async def client(self) -> AsyncIterator[httpx.AsyncClient]:
+        """Return the client of the least busy connection
+
+        Wait if the maximum number of streams is reached on that connection.
+        The pool is opened on first use if it wasn't started.
+        """
+        if not self.is_started:
+            await self._open()
+        connection = min(self.connections, key=lambda c: c.in_flight)
+        connection.in_flight += 1
+        try:
+            async with connection.streams:
+                yield connection.client
+        finally:
+            connection.in_flight -= 1
+
+
+def get_retry_after(response: httpx.Response) -> Optional[float]:
+    """Return the delay in seconds sent in the Retry-After header (if any)
+
+    The header is either a number of seconds or an HTTP date.
+    """
+    value = response.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((date - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+apple = ClientPool("APNs", http2=True)
+firebase = ClientPool("FCM", http2=True)
+
+
+async def start() -> None:
+    await apple.start()
+    await firebase.start()
+
+
+async def stop() -> None:
+    await apple.stop()
+    await firebase.stop()
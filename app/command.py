@@ -1,6 +1,7 @@
+import logging
 import typer
 from app.database import engine
-from app import models, crud, database
+from app import models, crud, database, ratelimit, worker
 
 cli = typer.Typer()
 
@@ -17,12 +18,53 @@ def create_db():
 
 
 @cli.command()
-def delete_notifications(days: int = typer.Option(30, help="Number of days to keep")):
-    """Delete notifications older than X days"""
+def delete_notifications(
+    days: int = typer.Option(30, help="Number of days to keep"),
+    batch_size: int = typer.Option(
+        100, help="Number of notifications deleted per transaction"
+    ),
+    pause: float = typer.Option(0, help="Time in seconds to wait between batches"),
+    dry_run: bool = typer.Option(
+        False, "--dry-run", help="Only display the number of notifications to delete"
+    ),
+):
+    """Delete notifications older than X days
+
+    The stale rate limit buckets are deleted as well.
+    """
+    db = database.SessionLocal()
+    if dry_run:
+        nb_notifications, nb_users_notifications = crud.count_old_notifications(
+            db, days
+        )
+        typer.echo(
+            f"{nb_notifications} notification(s) older than {days} days "
+            f"({nb_users_notifications} users notifications) would be deleted"
+        )
+        db.close()
+        return
     typer.echo(f"Delete notifications older than {days} days...")
+    nb_deleted = crud.delete_notifications(
+        db,
+        days,
+        batch_size=batch_size,
+        pause=pause,
+        progress=lambda nb: typer.echo(f"{nb} notification(s) deleted"),
+    )
+    db.close()
+    typer.echo(f"Done. {nb_deleted} notification(s) deleted.")
+    nb_buckets = ratelimit.purge()
+    typer.echo(f"{nb_buckets} stale rate limit bucket(s) deleted.")
+
+
+@cli.command()
+def reconcile_unread_counts():
+    """Recompute the number of unread notifications of all users"""
+    typer.echo("Reconcile users unread notifications count...")
     db = database.SessionLocal()
-    crud.delete_notifications(db, days)
+    nb_users = crud.reconcile_unread_counts(db)
     db.close()
+    typer.echo(f"{nb_users} user(s) updated")
 
 
 @cli.command()
@@ -38,5 +80,25 @@ def delete_user(username: str = typer.Argument(..., help="The user to delete")):
     db.close()
 
 
+@cli.command()
+def push_worker(
+    shard: int = typer.Option(
+        0, help="Shard of the queue processed first by this worker"
+    ),
+    nb_shards: int = typer.Option(1, help="Total number of shards (optional)"),
+):
+    """Send the queued push notifications"""
+    if not 0 <= shard < nb_shards:
+        typer.secho(
+            f"Shard shall be between 0 and {nb_shards - 1}. Aborting.",
+            fg=typer.colors.RED,
+        )
+        raise typer.Exit(code=1)
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s"
+    )
+    worker.main(shard, nb_shards)
+
+
 if __name__ == "__main__":
     cli()
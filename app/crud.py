@@ -1,10 +1,12 @@
 import datetime
+import time
 import uuid
 from fastapi.logger import logger
-from sqlalchemy import desc
+from sqlalchemy import and_, asc, desc, false, func, literal, or_, select
 from sqlalchemy.orm import Session
-from typing import List, Optional
-from . import models, schemas
+from collections import defaultdict
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+from . import cache, metrics, models, schemas
 from .settings import ADMIN_USERS, DEMO_ACCOUNT_SERVICE
 
 
@@ -36,7 +38,20 @@ def create_user(db: Session, username: str):
 def create_user_device_token(
     db: Session, device_token: str, user: models.User
 ) -> models.User:
-    user.add_device_token(device_token)
+    db_device_token = (
+        db.query(models.DeviceToken)
+        .filter(models.DeviceToken.token == device_token)
+        .first()
+    )
+    if db_device_token is not None and db_device_token.user_id != user.id:
+        # A device token is unique: the device is now used by another user
+        logger.info(
+            f"Move device token {device_token[:10]}... from user "
+            f"{db_device_token.user.username} to {user.username}"
+        )
+        db_device_token.user = user
+    else:
+        user.add_device_token(device_token)
     db.commit()
     db.refresh(user)
     return user
@@ -50,6 +65,7 @@ def update_user(
             logger.info(f"Update {key} to {value} for user {user.username}")
             setattr(user, key, value)
     db.commit()
+    cache.users.invalidate(user.username)
     db.refresh(user)
     return user
 
@@ -62,13 +78,21 @@ def update_user_login_token_expire_date(
     )
     user.login_token_expire_date = expire_date
     db.commit()
+    cache.users.invalidate(user.username)
     db.refresh(user)
     return user
 
 
 def delete_user(db: Session, user: models.User):
+    db.query(models.DeletedUserNotification).filter(
+        models.DeletedUserNotification.user_id == user.id
+    ).delete(synchronize_session=False)
+    db.query(models.Delivery).filter(models.Delivery.user_id == user.id).delete(
+        synchronize_session=False
+    )
     db.delete(user)
     db.commit()
+    cache.users.invalidate(user.username)
 
 
 def remove_user_device_token(
@@ -80,6 +104,33 @@ def remove_user_device_token(
     return user
 
 
+def remove_device_tokens(
+    db: Session, device_tokens: List[str], chunk_size: int = 500
+) -> None:
+    """Delete the device tokens (whatever the user)"""
+    if not device_tokens:
+        return
+    for index in range(0, len(device_tokens), chunk_size):
+        db.query(models.DeviceToken).filter(
+            models.DeviceToken.token.in_(device_tokens[index : index + chunk_size])
+        ).delete(synchronize_session=False)
+    db.commit()
+
+
+def update_device_tokens_last_success(
+    db: Session, device_tokens: List[str], chunk_size: int = 500
+) -> None:
+    """Set the last success date of the device tokens to now"""
+    if not device_tokens:
+        return
+    now = models.utcnow()
+    for index in range(0, len(device_tokens), chunk_size):
+        db.query(models.DeviceToken).filter(
+            models.DeviceToken.token.in_(device_tokens[index : index + chunk_size])
+        ).update({models.DeviceToken.last_success_at: now}, synchronize_session=False)
+    db.commit()
+
+
 def get_service(db: Session, service_id: uuid.UUID):
     return db.query(models.Service).filter(models.Service.id == service_id).first()
 
@@ -124,10 +175,12 @@ def delete_service(db: Session, service: models.Service) -> None:
     service_notification_ids = db.query(models.Notification.id).filter(
         models.Notification.service_id == service.id
     )
-    # Delete the UserNotification linked to those notifications
-    db.query(models.UserNotification).filter(
-        models.UserNotification.notification_id.in_(service_notification_ids.subquery())
-    ).delete(synchronize_session=False)
+    # Delete the UserNotification, PushJob and Delivery linked to those notifications
+    _delete_users_notifications(db, service_notification_ids.subquery())
+    for model in (models.PushJob, models.Delivery):
+        db.query(model).filter(
+            model.notification_id.in_(service_notification_ids.subquery())
+        ).delete(synchronize_session=False)
     # Delete the notifications themselves
     service_notification_ids.delete(synchronize_session=False)
     db.delete(service)
@@ -168,18 +221,128 @@ def update_user_services(
 def create_service_notification(
     db: Session, notification: schemas.NotificationCreate, service: models.Service
 ):
-    db_notification = models.Notification(**notification.model_dump(), service=service)
-    db.add(db_notification)
-    for user in service.subscribers:
-        user.notifications.append(db_notification)
-    db.commit()
-    db.refresh(db_notification)
+    (db_notification,) = create_service_notifications(db, [notification], service)
     logger.info(
         f"New notification created for '{service.category}': {schemas.Notification.model_validate(db_notification).model_dump_json()}"
     )
     return db_notification
 
 
+def create_service_notifications(
+    db: Session,
+    notifications: List[schemas.NotificationCreate],
+    service: models.Service,
+) -> List[models.Notification]:
+    """Create notifications for the service in one transaction
+
+    The number of queries doesn't depend on the number of subscribers.
+    Several notifications are pushed by a single job, as one summary.
+    """
+    db_notifications = [
+        models.Notification(**notification.model_dump(), service=service)
+        for notification in notifications
+    ]
+    db.add_all(db_notifications)
+    db.flush()
+    notification_ids = [db_notification.id for db_notification in db_notifications]
+    # Link the notifications to all subscribers in one statement
+    # (without loading the subscribers)
+    subscriber_ids = select([models.users_services_table.c.user_id]).where(
+        models.users_services_table.c.service_id == service.id
+    )
+    _increment_sync_sequence(db, subscriber_ids, unread_delta=len(db_notifications))
+    subscribers = select(
+        [
+            models.User.id,
+            models.Notification.id,
+            false(),
+            models.User.sync_sequence,
+        ]
+    ).where(
+        and_(
+            models.User.id.in_(subscriber_ids),
+            models.Notification.id.in_(notification_ids),
+        )
+    )
+    db.execute(
+        models.UserNotification.__table__.insert().from_select(
+            ["user_id", "notification_id", "is_read", "sequence"], subscribers
+        )
+    )
+    # The push job is created in the same transaction as the notifications
+    # so that it can't be lost
+    _queue_push_job(db, db_notifications, service)
+    db.commit()
+    # Reload the notifications expired by the commit in one query
+    db_notifications = (
+        db.query(models.Notification)
+        .filter(models.Notification.id.in_(notification_ids))
+        .order_by(models.Notification.id)
+        .all()
+    )
+    metrics.notifications_created.labels(service=service.category).inc(
+        len(db_notifications)
+    )
+    return db_notifications
+
+
+def _queue_push_job(
+    db: Session, notifications: List[models.Notification], service: models.Service
+) -> None:
+    """Create the push job of new notifications
+
+    The job points to the last notification. If the service has a coalescing
+    window, the first notification of a burst is pushed right away. The next
+    ones created within the window are merged in one delayed job, pushed as a
+    summary at the end of the window.
+    """
+    notification = notifications[-1]
+    if service.coalescing_window:
+        # Lock the service row until the commit: concurrent requests of the same
+        # service see each other's notifications and share the same delayed job
+        db.query(models.Service.id).filter(
+            models.Service.id == service.id
+        ).with_for_update().one()
+        now = models.utcnow()
+        window = datetime.timedelta(seconds=service.coalescing_window)
+        previous = (
+            db.query(models.Notification.id)
+            .filter(
+                models.Notification.service_id == service.id,
+                models.Notification.id.notin_([n.id for n in notifications]),
+                models.Notification.timestamp > now - window,
+            )
+            .first()
+        )
+        if previous is not None:
+            job = (
+                db.query(models.PushJob)
+                .join(models.Notification)
+                .filter(
+                    models.Notification.service_id == service.id,
+                    models.PushJob.available_at > now,
+                    models.PushJob.locked_until.is_(None),
+                )
+                .with_for_update(of=models.PushJob)
+                .first()
+            )
+            if job is not None:
+                job.notification = notification
+                job.nb_notifications += len(notifications)
+            else:
+                db.add(
+                    models.PushJob(
+                        notification=notification,
+                        nb_notifications=len(notifications),
+                        available_at=now + window,
+                    )
+                )
+            return
+    db.add(
+        models.PushJob(notification=notification, nb_notifications=len(notifications))
+    )
+
+
 def get_notification(
     db: Session, notification_id: int
 ) -> Optional[models.Notification]:
@@ -190,12 +353,239 @@ def get_notification(
     )
 
 
+class Recipient(NamedTuple):
+    """User to send a notification to"""
+
+    user_id: int
+    username: str
+    nb_unread_notifications: int
+    ios_tokens: List[str]
+    android_tokens: List[str]
+
+
+def get_notification_recipients(
+    db: Session,
+    notification_id: int,
+    after_user_id: int = 0,
+    limit: Optional[int] = None,
+) -> List[Recipient]:
+    """Return the users to send the notification to with their device tokens
+
+    Only active and logged in users are returned, sorted by id.
+    Recipients can be paged: pass limit and the id of the last user
+    of the previous page as after_user_id.
+    The number of queries doesn't depend on the number of recipients:
+    one query for the users and their number of unread notifications
+    and one for their device tokens.
+    """
+    query = (
+        db.query(
+            models.User.id,
+            models.User.username,
+            models.User.unread_count,
+        )
+        .join(
+            models.UserNotification,
+            models.UserNotification.user_id == models.User.id,
+        )
+        .filter(
+            models.UserNotification.notification_id == notification_id,
+            models.User.is_active.is_(True),
+            models.User.login_token_expire_date > models.utcnow(),
+            models.User.id > after_user_id,
+        )
+        .order_by(models.User.id)
+    )
+    if limit is not None:
+        query = query.limit(limit)
+    users = query.all()
+    if not users:
+        return []
+    device_tokens = (
+        db.query(
+            models.DeviceToken.user_id,
+            models.DeviceToken.token,
+            models.DeviceToken.platform,
+        )
+        .filter(
+            models.DeviceToken.user_id.in_([user_id for user_id, _, _ in users]),
+            models.DeviceToken.platform.isnot(None),
+        )
+        .order_by(models.DeviceToken.id)
+        .all()
+    )
+    tokens: Dict[Tuple[int, str], List[str]] = defaultdict(list)
+    for user_id, token, platform in device_tokens:
+        tokens[(user_id, platform)].append(token)
+    return [
+        Recipient(
+            user_id=user_id,
+            username=username,
+            nb_unread_notifications=nb_unread_notifications,
+            ios_tokens=tokens[(user_id, schemas.Platform.ios)],
+            android_tokens=tokens[(user_id, schemas.Platform.android)],
+        )
+        for user_id, username, nb_unread_notifications in users
+    ]
+
+
+class PushResult(NamedTuple):
+    """Result of the sending of a notification to a device (see ios/firebase.send_push)"""
+
+    status: schemas.DeliveryStatus
+    status_code: Optional[int] = None
+    reason: Optional[str] = None
+    latency: float = 0.0
+    attempts: int = 1
+    # Delay in seconds requested by the server (Retry-After header)
+    retry_after: Optional[float] = None
+
+    @property
+    def success(self) -> bool:
+        return self.status == schemas.DeliveryStatus.success
+
+    @property
+    def is_transient(self) -> bool:
+        """Return True if the push failed for a temporary reason and can be retried
+
+        No response received, throttled (429) or server error (5xx).
+        """
+        return self.status == schemas.DeliveryStatus.failure and (
+            self.status_code is None
+            or self.status_code == 429
+            or self.status_code >= 500
+        )
+
+
+class Delivery(NamedTuple):
+    """Push result for a device of a recipient"""
+
+    user_id: int
+    token: str
+    platform: schemas.Platform
+    result: PushResult
+
+
+def create_deliveries(
+    db: Session, notification_id: int, deliveries: List[Delivery], chunk_size: int = 500
+) -> None:
+    """Save the outcome of the sending of the notification to each device
+
+    Rows are inserted with one statement per chunk of chunk_size deliveries.
+    """
+    if not deliveries:
+        return
+    now = models.utcnow()
+    rows = [
+        {
+            "notification_id": notification_id,
+            "user_id": delivery.user_id,
+            "token": delivery.token,
+            "platform": delivery.platform.value,
+            "status": delivery.result.status.value,
+            "status_code": delivery.result.status_code,
+            "reason": delivery.result.reason,
+            "latency": delivery.result.latency,
+            "attempts": delivery.result.attempts,
+            "created_at": now,
+        }
+        for delivery in deliveries
+    ]
+    for index in range(0, len(rows), chunk_size):
+        db.execute(models.Delivery.__table__.insert(), rows[index : index + chunk_size])
+    db.commit()
+
+
+def get_deliveries(
+    db: Session,
+    notification_id: int,
+    limit: int = 100,
+    after: Optional[int] = None,
+    status: Optional[schemas.DeliveryStatus] = None,
+) -> List[schemas.Delivery]:
+    """Return the outcome of the sending of the notification per device
+
+    Deliveries are ordered by id. Pass the id of the last one as after
+    to get the next page.
+    """
+    query = (
+        db.query(models.Delivery, models.User.username)
+        .join(models.User, models.User.id == models.Delivery.user_id)
+        .filter(models.Delivery.notification_id == notification_id)
+    )
+    if after is not None:
+        query = query.filter(models.Delivery.id > after)
+    if status is not None:
+        query = query.filter(models.Delivery.status == status.value)
+    deliveries = query.order_by(models.Delivery.id).limit(limit)
+    return [
+        schemas.Delivery(
+            id=delivery.id,
+            username=username,
+            token=delivery.token,
+            platform=delivery.platform,
+            status=delivery.status,
+            status_code=delivery.status_code,
+            reason=delivery.reason,
+            latency=delivery.latency,
+            attempts=delivery.attempts,
+            created_at=delivery.created_at,
+        )
+        for delivery, username in deliveries
+    ]
+
+
+def get_delivery_summary(db: Session, notification_id: int) -> schemas.DeliverySummary:
+    """Return the number of deliveries per status and the users reached"""
+    filters = [models.Delivery.notification_id == notification_id]
+    counts = dict(
+        db.query(models.Delivery.status, func.count())
+        .filter(*filters)
+        .group_by(models.Delivery.status)
+    )
+    nb_users, latency_max = (
+        db.query(
+            func.count(models.Delivery.user_id.distinct()),
+            func.max(models.Delivery.latency),
+        )
+        .filter(*filters)
+        .one()
+    )
+    nb_users_reached = (
+        db.query(func.count(models.Delivery.user_id.distinct()))
+        .filter(
+            *filters, models.Delivery.status == schemas.DeliveryStatus.success.value
+        )
+        .scalar()
+    )
+    reasons = dict(
+        db.query(func.coalesce(models.Delivery.reason, ""), func.count())
+        .filter(
+            *filters, models.Delivery.status != schemas.DeliveryStatus.success.value
+        )
+        .group_by(func.coalesce(models.Delivery.reason, ""))
+    )
+    return schemas.DeliverySummary(
+        notification_id=notification_id,
+        total=sum(counts.values()),
+        success=counts.get(schemas.DeliveryStatus.success.value, 0),
+        failure=counts.get(schemas.DeliveryStatus.failure.value, 0),
+        unregistered=counts.get(schemas.DeliveryStatus.unregistered.value, 0),
+        nb_users=nb_users,
+        nb_users_reached=nb_users_reached,
+        latency_max=latency_max,
+        reasons=reasons,
+    )
+
+
 def get_user_notifications(
     db: Session,
     user: models.User,
     limit: int = 0,
     filter_services_id: Optional[List[uuid.UUID]] = None,
     sort: schemas.SortOrder = schemas.SortOrder.desc,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
 ) -> List[schemas.UserNotification]:
     """Return the latest user's notifications sorted by timestamp
 
@@ -204,60 +594,502 @@ def get_user_notifications(
     If a list of services id is given, only notifcations part of those are returned.
     The newest notifications are always returned. Sorting by ascending order
     will just reverse that list.
+
+    before and after are cursors (notification id) used for keyset pagination
+    on (timestamp, id): only notifications older than before and/or newer
+    than after are returned. When only after is given, the notifications
+    right after the cursor are returned (and not the newest ones).
     """
     query = (
-        db.query(models.UserNotification)
-        .filter(
-            models.UserNotification.user_id == user.id,
+        db.query(models.Notification, models.UserNotification.is_read)
+        .join(
+            models.UserNotification,
+            models.UserNotification.notification_id == models.Notification.id,
         )
-        .join(models.Notification)
+        .filter(models.UserNotification.user_id == user.id)
     )
     if filter_services_id is not None:
         query = query.filter(models.Notification.service_id.in_(filter_services_id))
-    query = query.order_by(desc(models.Notification.timestamp))
-    query = query.limit(limit) if limit > 0 else query.all()
-    notifications = [un.to_user_notification() for un in query]
+    if before is not None:
+        query = query.filter(_notification_keyset(before, older=True))
+    if after is not None:
+        query = query.filter(_notification_keyset(after, older=False))
+    oldest_first = after is not None and before is None
+    order = asc if oldest_first else desc
+    query = query.order_by(
+        order(models.Notification.timestamp), order(models.Notification.id)
+    )
+    if limit > 0:
+        query = query.limit(limit)
+    notifications = [
+        _to_user_notification(notification, is_read) for notification, is_read in query
+    ]
     # Sorting in ascending order is mostly for backward compatibility
-    if sort == schemas.SortOrder.asc:
+    if (sort == schemas.SortOrder.asc) != oldest_first:
         notifications.reverse()
     return notifications
 
 
+def _to_user_notification(
+    notification: models.Notification, is_read: bool
+) -> schemas.UserNotification:
+    return schemas.UserNotification(
+        id=notification.id,
+        timestamp=notification.timestamp,
+        title=notification.title,
+        subtitle=notification.subtitle,
+        url=notification.url,
+        service_id=notification.service_id,
+        is_read=is_read,
+    )
+
+
+def _notification_keyset(cursor: int, older: bool):
+    """Return the condition to select the notifications older or newer than cursor
+
+    Notifications are ordered by (timestamp, id). An unknown cursor matches nothing.
+    """
+    timestamp = (
+        select([models.Notification.timestamp])
+        .where(models.Notification.id == cursor)
+        .as_scalar()
+    )
+    if older:
+        return or_(
+            models.Notification.timestamp < timestamp,
+            and_(
+                models.Notification.timestamp == timestamp,
+                models.Notification.id < cursor,
+            ),
+        )
+    return or_(
+        models.Notification.timestamp > timestamp,
+        and_(
+            models.Notification.timestamp == timestamp,
+            models.Notification.id > cursor,
+        ),
+    )
+
+
 def update_user_notifications(
     db: Session,
     updated_notifications: List[schemas.UserUpdateNotification],
     user: models.User,
 ) -> None:
-    # Build a dict to efficiently retrieve each notification by id in the loop
-    user_notifications_dict = {un.notification_id: un for un in user.user_notifications}
+    """Update the status of the user's notifications
+
+    Unknown notifications are skipped. Notifications are updated with one
+    conditional statement per status and the unread count is updated from the
+    number of rows actually changed, so that concurrent updates are counted once.
+    """
+    statuses = {}
     for updated_notification in updated_notifications:
-        try:
-            user_notification = user_notifications_dict[updated_notification.id]
-        except KeyError:
-            # Skip unknown notification
+        # Only the first status of a notification is applied
+        statuses.setdefault(updated_notification.id, updated_notification.status)
+    if not statuses:
+        return
+    # Incrementing the sequence first locks the user row until the commit
+    user.sync_sequence = models.User.sync_sequence + 1
+    db.flush()
+    sequence = user.sync_sequence
+    ids_by_status = defaultdict(list)
+    for notification_id, status in statuses.items():
+        ids_by_status[status].append(notification_id)
+
+    def user_notifications(status):
+        return db.query(models.UserNotification).filter(
+            models.UserNotification.user_id == user.id,
+            models.UserNotification.notification_id.in_(ids_by_status[status]),
+        )
+
+    unread_delta = 0
+    for status, is_read in (
+        (schemas.NotificationStatus.read, True),
+        (schemas.NotificationStatus.unread, False),
+    ):
+        if status not in ids_by_status:
             continue
-        if updated_notification.status == schemas.NotificationStatus.read:
-            user_notification.is_read = True
-        elif updated_notification.status == schemas.NotificationStatus.unread:
-            user_notification.is_read = False
-        elif updated_notification.status == schemas.NotificationStatus.deleted:
-            user.user_notifications.remove(user_notification)
+        nb_updated = (
+            user_notifications(status)
+            .filter(models.UserNotification.is_read.is_(not is_read))
+            .update(
+                {
+                    models.UserNotification.is_read: is_read,
+                    models.UserNotification.sequence: sequence,
+                },
+                synchronize_session=False,
+            )
+        )
+        unread_delta += -nb_updated if is_read else nb_updated
+    if schemas.NotificationStatus.deleted in ids_by_status:
+        deleted = user_notifications(schemas.NotificationStatus.deleted)
+        db.execute(
+            models.DeletedUserNotification.__table__.insert().from_select(
+                ["user_id", "notification_id", "sequence", "deleted_at"],
+                deleted.with_entities(
+                    models.UserNotification.user_id,
+                    models.UserNotification.notification_id,
+                    literal(sequence),
+                    literal(models.utcnow(), type_=models.TZDateTime),
+                ),
+            )
+        )
+        unread_delta -= deleted.filter(
+            models.UserNotification.is_read.is_(False)
+        ).delete(synchronize_session=False)
+        deleted.delete(synchronize_session=False)
+    if unread_delta:
+        user.unread_count = models.User.unread_count + unread_delta
     db.commit()
 
 
-def delete_notifications(db: Session, keep_days: int) -> None:
-    """Delete notifications older than X days"""
-    date_limit = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
-        days=keep_days
+def sync_user_notifications(
+    db: Session,
+    user: models.User,
+    sync_token: Optional[int] = None,
+    limit: int = 50,
+    cursor: Optional[int] = None,
+) -> schemas.UserNotificationsSync:
+    """Return the user's notifications changed since sync_token
+
+    Notifications created or updated (read status) after sync_token are returned
+    as well as the id of the notifications deleted.
+    All notifications are returned when no sync_token is given, or with
+    full_resync set when the deletions since sync_token are not known anymore.
+    That full list is paginated: limit notifications at most are returned with
+    next_cursor, to pass as cursor to get the next page, if there are more.
+    The new sync_token to pass on the next call is included, as well as the date
+    before which notifications were deleted without being returned in deleted
+    (retention): clients shall drop the older notifications themselves.
+    """
+    # Read the sequence first: changes committed in the meantime
+    # will be returned on the next call
+    sequence, sync_floor, deleted_before = (
+        db.query(
+            models.User.sync_sequence,
+            models.User.sync_floor,
+            models.User.notifications_deleted_before,
+        )
+        .filter(models.User.id == user.id)
+        .one()
     )
-    # First retrieve all notifications id to delete
-    old_notification_ids = db.query(models.Notification.id).filter(
-        models.Notification.timestamp < date_limit
+    # Some deletions since sync_token weren't recorded (or were purged)
+    full_resync = sync_token is not None and sync_token < sync_floor
+    if full_resync:
+        sync_token = None
+    query = (
+        db.query(models.Notification, models.UserNotification.is_read)
+        .join(
+            models.UserNotification,
+            models.UserNotification.notification_id == models.Notification.id,
+        )
+        .filter(
+            models.UserNotification.user_id == user.id,
+            models.UserNotification.sequence <= sequence,
+        )
+    )
+    deleted = []
+    if sync_token is not None:
+        query = query.filter(models.UserNotification.sequence > sync_token)
+        deleted = [
+            notification_id
+            for (notification_id,) in db.query(
+                models.DeletedUserNotification.notification_id
+            )
+            .filter(
+                models.DeletedUserNotification.user_id == user.id,
+                models.DeletedUserNotification.sequence > sync_token,
+                models.DeletedUserNotification.sequence <= sequence,
+            )
+            .order_by(models.DeletedUserNotification.notification_id)
+        ]
+    elif cursor is not None:
+        query = query.filter(_notification_keyset(cursor, older=False))
+    query = query.order_by(models.Notification.timestamp, models.Notification.id)
+    if sync_token is None:
+        # One more to know if there is a next page
+        query = query.limit(limit + 1)
+    notifications = [
+        _to_user_notification(notification, is_read) for notification, is_read in query
+    ]
+    next_cursor = None
+    if sync_token is None and len(notifications) > limit:
+        notifications = notifications[:limit]
+        next_cursor = notifications[-1].id
+    return schemas.UserNotificationsSync(
+        sync_token=sequence,
+        notifications=notifications,
+        deleted=deleted,
+        full_resync=full_resync,
+        next_cursor=next_cursor,
+        deleted_before=deleted_before,
     )
-    # Delete the UserNotification linked to those notifications
+
+
+def _increment_sync_sequence(db: Session, user_ids, unread_delta=0) -> None:
+    """Increment the sync sequence of the users in one statement
+
+    The unread count is updated at the same time by unread_delta
+    (a number or a correlated subquery).
+    """
+    db.query(models.User).filter(models.User.id.in_(user_ids)).update(
+        {
+            models.User.sync_sequence: models.User.sync_sequence + 1,
+            models.User.unread_count: models.User.unread_count + unread_delta,
+        },
+        synchronize_session=False,
+    )
+
+
+def _unread_notifications_count(notification_ids=None):
+    """Return the subquery counting the unread notifications of each user"""
+    user_notifications = models.UserNotification.__table__
+    condition = and_(
+        user_notifications.c.user_id == models.User.id,
+        user_notifications.c.is_read.is_(False),
+    )
+    if notification_ids is not None:
+        condition = and_(
+            condition, user_notifications.c.notification_id.in_(notification_ids)
+        )
+    return select([func.count()]).where(condition).as_scalar()
+
+
+def _delete_users_notifications(
+    db: Session,
+    notification_ids,
+    deleted_before: Optional[datetime.datetime] = None,
+) -> None:
+    """Remove the notifications from all users and record their deletion
+
+    Notifications deleted because older than deleted_before (retention) aren't
+    recorded one by one: clients drop the notifications older than that date.
+    """
+    user_notifications = models.UserNotification.__table__
+    user_ids = (
+        select([user_notifications.c.user_id])
+        .where(user_notifications.c.notification_id.in_(notification_ids))
+        .distinct()
+    )
+    unread_delta = -_unread_notifications_count(notification_ids)
+    if deleted_before is not None:
+        db.query(models.User).filter(models.User.id.in_(user_ids)).update(
+            {
+                models.User.unread_count: models.User.unread_count + unread_delta,
+                models.User.notifications_deleted_before: deleted_before,
+            },
+            synchronize_session=False,
+        )
+    else:
+        _increment_sync_sequence(db, user_ids, unread_delta=unread_delta)
+        deleted = select(
+            [
+                user_notifications.c.user_id,
+                user_notifications.c.notification_id,
+                models.User.sync_sequence,
+                literal(models.utcnow(), type_=models.TZDateTime),
+            ]
+        ).where(
+            and_(
+                user_notifications.c.user_id == models.User.id,
+                user_notifications.c.notification_id.in_(notification_ids),
+            )
+        )
+        db.execute(
+            models.DeletedUserNotification.__table__.insert().from_select(
+                ["user_id", "notification_id", "sequence", "deleted_at"], deleted
+            )
+        )
     db.query(models.UserNotification).filter(
-        models.UserNotification.notification_id.in_(old_notification_ids.subquery())
+        models.UserNotification.notification_id.in_(notification_ids)
     ).delete(synchronize_session=False)
-    # Delete the notifications themselves
-    old_notification_ids.delete(synchronize_session=False)
+
+
+def reconcile_unread_counts(db: Session) -> int:
+    """Recompute the users unread count from their notifications
+
+    Return the number of users whose count was wrong
+    """
+    unread_count = _unread_notifications_count()
+    nb_users = (
+        db.query(models.User)
+        .filter(models.User.unread_count != unread_count)
+        .update({models.User.unread_count: unread_count}, synchronize_session=False)
+    )
+    db.commit()
+    return nb_users
+
+
+def _notifications_date_limit(keep_days: int) -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+        days=keep_days
+    )
+
+
+def count_old_notifications(db: Session, keep_days: int) -> Tuple[int, int]:
+    """Return the number of notifications older than X days
+
+    The number of users notifications linked to them is returned as well.
+    """
+    old_notification_ids = db.query(models.Notification.id).filter(
+        models.Notification.timestamp < _notifications_date_limit(keep_days)
+    )
+    nb_users_notifications = (
+        db.query(func.count())
+        .select_from(models.UserNotification)
+        .filter(
+            models.UserNotification.notification_id.in_(old_notification_ids.subquery())
+        )
+        .scalar()
+    )
+    return old_notification_ids.count(), nb_users_notifications
+
+
+def delete_notifications(
+    db: Session,
+    keep_days: int,
+    batch_size: int = 100,
+    pause: float = 0,
+    progress: Optional[Callable[[int], None]] = None,
+) -> int:
+    """Delete notifications older than X days
+
+    Notifications are deleted by batches of batch_size (in id order) with a commit
+    after each batch, to avoid holding locks for a long time. The purge can be
+    throttled by waiting pause seconds between batches.
+    progress is called with the number of notifications deleted after each batch.
+    Return the total number of notifications deleted.
+    """
+    date_limit = _notifications_date_limit(keep_days)
+    nb_deleted = 0
+    while True:
+        notification_ids = [
+            notification_id
+            for (notification_id,) in db.query(models.Notification.id)
+            .filter(models.Notification.timestamp < date_limit)
+            .order_by(models.Notification.id)
+            .limit(batch_size)
+        ]
+        if not notification_ids:
+            break
+        # Delete the UserNotification, PushJob and Delivery linked to those notifications
+        # (no tombstones: clients drop the notifications older than date_limit)
+        _delete_users_notifications(db, notification_ids, deleted_before=date_limit)
+        for model in (models.PushJob, models.Delivery):
+            db.query(model).filter(model.notification_id.in_(notification_ids)).delete(
+                synchronize_session=False
+            )
+        # Delete the notifications themselves
+        db.query(models.Notification).filter(
+            models.Notification.id.in_(notification_ids)
+        ).delete(synchronize_session=False)
+        db.commit()
+        nb_deleted += len(notification_ids)
+        if progress is not None:
+            progress(nb_deleted)
+        if pause:
+            time.sleep(pause)
+    # Purge the deletions recorded more than keep_days ago: clients that didn't sync
+    # since have to reload all their notifications
+    while True:
+        tombstone_ids = [
+            notification_id
+            for (notification_id,) in db.query(
+                models.DeletedUserNotification.notification_id
+            )
+            .filter(models.DeletedUserNotification.deleted_at < date_limit)
+            .distinct()
+            .limit(batch_size)
+        ]
+        if not tombstone_ids:
+            break
+        tombstones = models.DeletedUserNotification.__table__
+        purged = and_(
+            tombstones.c.notification_id.in_(tombstone_ids),
+            tombstones.c.deleted_at < date_limit,
+        )
+        # Raise the users sync floor to the last purged deletion
+        purged_sequence = (
+            select([func.max(tombstones.c.sequence)])
+            .where(and_(tombstones.c.user_id == models.User.id, purged))
+            .as_scalar()
+        )
+        db.query(models.User).filter(
+            models.User.id.in_(select([tombstones.c.user_id]).where(purged)),
+            models.User.sync_floor < purged_sequence,
+        ).update({models.User.sync_floor: purged_sequence}, synchronize_session=False)
+        db.execute(tombstones.delete().where(purged))
+        db.commit()
+        if pause:
+            time.sleep(pause)
+    return nb_deleted
+
+
+def claim_push_jobs(
+    db: Session, limit: int, lease: int, shard: int = 0, nb_shards: int = 1
+) -> List[models.PushJob]:
+    """Reserve up to limit pending push jobs for lease seconds
+
+    Jobs are available if they were never claimed or if their lease expired
+    (the worker processing them died).
+    On PostgreSQL, rows locked by another worker are skipped: several workers
+    can claim jobs at the same time. A worker can also prefer a shard of the
+    queue: jobs of the other shards are only claimed when its shard is empty,
+    so that they are still processed if their worker is down.
+    Returned jobs are detached from the session.
+    """
+    now = models.utcnow()
+    query = db.query(models.PushJob).filter(
+        models.PushJob.available_at <= now,
+        or_(
+            models.PushJob.locked_until.is_(None),
+            models.PushJob.locked_until < now,
+        ),
+    )
+    order_by = [models.PushJob.id]
+    if nb_shards > 1:
+        order_by.insert(0, models.PushJob.id % nb_shards != shard)
+    jobs = (
+        query.order_by(*order_by).limit(limit).with_for_update(skip_locked=True).all()
+    )
+    for job in jobs:
+        job.locked_until = now + datetime.timedelta(seconds=lease)
+        job.attempts += 1
+    db.flush()
+    for job in jobs:
+        db.expunge(job)
+    db.commit()
+    return jobs
+
+
+def count_push_jobs(db: Session) -> int:
+    return db.query(func.count(models.PushJob.id)).scalar()
+
+
+def extend_push_jobs_lease(db: Session, job_ids: List[int], lease: int) -> None:
+    """Renew the lease of jobs still being processed"""
+    locked_until = models.utcnow() + datetime.timedelta(seconds=lease)
+    db.query(models.PushJob).filter(models.PushJob.id.in_(job_ids)).update(
+        {models.PushJob.locked_until: locked_until}, synchronize_session=False
+    )
+    db.commit()
+
+
+def delete_push_job(db: Session, job_id: int) -> None:
+    db.query(models.PushJob).filter(models.PushJob.id == job_id).delete(
+        synchronize_session=False
+    )
+    db.commit()
+
+
+def release_push_job(db: Session, job_id: int, delay: int) -> None:
+    """Make a job available again after delay seconds"""
+    db.query(models.PushJob).filter(models.PushJob.id == job_id).update(
+        {
+            models.PushJob.locked_until: None,
+            models.PushJob.available_at: models.utcnow()
+            + datetime.timedelta(seconds=delay),
+        },
+        synchronize_session=False,
+    )
     db.commit()
@@ -0,0 +1,42 @@
+"""Awaitable versions of the crud functions
+
+SQLAlchemy 1.3 doesn't support asyncio (no AsyncSession). To not block the
+event loop, async views and tasks await those functions that run the
+corresponding crud function in the threadpool.
+A session shall only be used by one function at a time: don't share it
+between concurrent tasks.
+"""
+
+import functools
+from typing import Any, Awaitable, Callable, TypeVar
+from starlette.concurrency import run_in_threadpool
+from . import crud
+
+T = TypeVar("T")
+
+
+async def run(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run the blocking function func in the threadpool"""
+    return await run_in_threadpool(func, *args, **kwargs)
+
+
+def awaitable(func: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> T:
+        return await run(func, *args, **kwargs)
+
+    return wrapper
+
+
+create_user = awaitable(crud.create_user)
+get_user_by_username = awaitable(crud.get_user_by_username)
+get_user_services = awaitable(crud.get_user_services)
+update_user_services = awaitable(crud.update_user_services)
+get_user_notifications = awaitable(crud.get_user_notifications)
+get_service = awaitable(crud.get_service)
+create_service_notifications = awaitable(crud.create_service_notifications)
+get_notification = awaitable(crud.get_notification)
+get_notification_recipients = awaitable(crud.get_notification_recipients)
+create_deliveries = awaitable(crud.create_deliveries)
+update_device_tokens_last_success = awaitable(crud.update_device_tokens_last_success)
+remove_device_tokens = awaitable(crud.remove_device_tokens)
@@ -1,16 +1,113 @@
+import threading
+import time
 from sqlalchemy import create_engine, MetaData
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from .settings import SQLALCHEMY_DATABASE_URL, SQLALCHEMY_DEBUG
+from sqlalchemy.pool import QueuePool, StaticPool
+from .settings import (
+    SQLALCHEMY_DATABASE_URL,
+    SQLALCHEMY_DEBUG,
+    SQLALCHEMY_POOL_SIZE,
+    SQLALCHEMY_MAX_OVERFLOW,
+    SQLALCHEMY_POOL_TIMEOUT,
+    SQLALCHEMY_POOL_RECYCLE,
+    SQLALCHEMY_POOL_PRE_PING,
+    SQLALCHEMY_STATEMENT_TIMEOUT,
+)
+
+
+class PoolStats:
+    """Statistics about the connections checked out from the pool"""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, wait_time: float, timeout: bool = False) -> None:
+        with self._lock:
+            if timeout:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool recording the time spent waiting for a connection"""
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
 
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.stats.record(time.perf_counter() - start, timeout=True)
+            raise
+        self.stats.record(time.perf_counter() - start)
+        return connection
+
+
+def get_pool_status(pool) -> dict:
+    """Return the status of the pool
+
+    Numbers are per process. Only an InstrumentedQueuePool (used with
+    PostgreSQL) reports the checkouts and wait times.
+    """
+    status = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            max_overflow=pool._max_overflow,
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=max(pool.overflow(), 0),
+        )
+    stats = getattr(pool, "stats", None)
+    if stats is not None:
+        status.update(
+            checkouts=stats.checkouts,
+            timeouts=stats.timeouts,
+            wait_time_total=stats.wait_time_total,
+            wait_time_max=stats.wait_time_max,
+        )
+    return status
+
+
+engine_args = {}
 if SQLALCHEMY_DATABASE_URL.startswith("sqlite:"):
-    connect_args = {"check_same_thread": False}
+    engine_args["connect_args"] = {"check_same_thread": False}
+    if SQLALCHEMY_DATABASE_URL in ("sqlite://", "sqlite:///:memory:"):
+        # Share the in-memory database with the threadpool (used for tests)
+        engine_args["poolclass"] = StaticPool
 else:
-    connect_args = {}
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args=connect_args, echo=SQLALCHEMY_DEBUG
-)
+    engine_args.update(
+        poolclass=InstrumentedQueuePool,
+        pool_size=SQLALCHEMY_POOL_SIZE,
+        max_overflow=SQLALCHEMY_MAX_OVERFLOW,
+        pool_timeout=SQLALCHEMY_POOL_TIMEOUT,
+        pool_recycle=SQLALCHEMY_POOL_RECYCLE,
+        pool_pre_ping=SQLALCHEMY_POOL_PRE_PING,
+    )
+    if SQLALCHEMY_STATEMENT_TIMEOUT and SQLALCHEMY_DATABASE_URL.startswith(
+        "postgresql"
+    ):
+        engine_args["connect_args"] = {
+            "options": f"-c statement_timeout={SQLALCHEMY_STATEMENT_TIMEOUT}"
+        }
+engine = create_engine(SQLALCHEMY_DATABASE_URL, echo=SQLALCHEMY_DEBUG, **engine_args)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 convention = {
     "ix": "ix_%(column_0_label)s",
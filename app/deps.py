@@ -1,3 +1,4 @@
+from typing import Optional
 from fastapi import Depends, HTTPException, status
 from starlette.requests import Request
 from fastapi.security import OAuth2PasswordBearer
@@ -5,7 +6,7 @@ from fastapi.logger import logger
 from sqlalchemy.orm import Session
 from jwt import PyJWTError, ExpiredSignatureError
 from authlib.integrations.starlette_client import OAuth
-from . import crud, models, utils
+from . import cache, crud, models, utils
 from .database import SessionLocal
 from .settings import (
     OIDC_NAME,
@@ -34,6 +35,17 @@ def get_db():
         db.close()
 
 
+def get_user_by_username(db: Session, username: str) -> Optional[models.User]:
+    """Return the user from the cache or from the database"""
+    cached_user = cache.users.get(username)
+    if cached_user is not None:
+        return cached_user.to_user(db)
+    user = crud.get_user_by_username(db, username)
+    if user is not None:
+        cache.users.set(user)
+    return user
+
+
 def get_current_user(
     request: Request, db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)
 ) -> models.User:
@@ -67,7 +79,7 @@ def get_current_user(
         logger.warning(msg)
         credentials_exception.detail = msg
         raise credentials_exception
-    user = crud.get_user_by_username(db, username)
+    user = get_user_by_username(db, username)
     if user is None:
         msg = f"Unknown user {username}"
         logger.warning(msg)
@@ -0,0 +1,188 @@
+"""Fan-out of a notification to the devices of its recipients
+
+Pushes are sent by a fixed number of worker coroutines fed by a bounded queue.
+The producer (see utils.send_notification) waits when the queue is full, so
+the memory used doesn't depend on the number of devices. The deliveries are
+collected by the producer as they complete (see FanOut.pop_deliveries).
+Pushes that failed with a transient error are queued again after a delay:
+waiting before a retry doesn't hold a worker.
+"""
+
+import asyncio
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Set
+from fastapi.logger import logger
+from . import clients, crud, schemas
+from .settings import (
+    NB_PARALLEL_PUSH,
+    PUSH_RETRY_MAX_RETRIES,
+    PUSH_RETRY_BASE_DELAY,
+    PUSH_RETRY_MAX_DELAY,
+)
+
+
+def retry_delay(
+    retry: int,
+    retry_after: Optional[float] = None,
+    base_delay: float = PUSH_RETRY_BASE_DELAY,
+    max_delay: float = PUSH_RETRY_MAX_DELAY,
+) -> Optional[float]:
+    """Return the delay in seconds before the retry number retry (starting at 1)
+
+    The delay requested by the server (Retry-After) is honoured. Otherwise it's
+    drawn between 0 and base_delay * 2 ** (retry - 1), capped at max_delay
+    (exponential backoff with full jitter).
+    Return None if the server asks to wait longer than max_delay.
+    """
+    if retry_after is not None:
+        return retry_after if retry_after <= max_delay else None
+    return random.uniform(0, min(base_delay * 2 ** (retry - 1), max_delay))
+
+
+class Push(NamedTuple):
+    """Push notification to send to a device"""
+
+    user_id: int
+    token: str
+    platform: schemas.Platform
+    pool: clients.ClientPool
+    send_push: Callable[..., Awaitable[crud.PushResult]]
+    args: tuple
+    kwargs: Dict[str, Any]
+    # Time the push was queued
+    start: float
+    attempts: int = 0
+    retries: int = 0
+
+
+class FanOut:
+    """Send pushes with nb_workers coroutines
+
+    To be used as an async context manager: the workers are started on enter
+    and cancelled on exit. Call join() to wait for all the pushes queued.
+    Permanent errors (e.g. unregistered or bad device token) aren't retried.
+    """
+
+    def __init__(
+        self,
+        nb_workers: int = NB_PARALLEL_PUSH,
+        queue_size: Optional[int] = None,
+        max_retries: int = PUSH_RETRY_MAX_RETRIES,
+    ):
+        self.nb_workers = nb_workers
+        self.max_retries = max_retries
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size or 2 * nb_workers)
+        self.deliveries: List[crud.Delivery] = []
+        self._workers: List[asyncio.Task] = []
+        self._retries: Set[asyncio.Task] = set()
+
+    async def __aenter__(self) -> "FanOut":
+        self._workers = [
+            asyncio.create_task(self._run_worker()) for _ in range(self.nb_workers)
+        ]
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        tasks = self._workers + list(self._retries)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._retries.clear()
+
+    async def put(
+        self,
+        user_id: int,
+        token: str,
+        platform: schemas.Platform,
+        pool: clients.ClientPool,
+        send_push: Callable[..., Awaitable[crud.PushResult]],
+        *args,
+        **kwargs,
+    ) -> None:
+        """Queue a call to send_push with a client from the pool
+
+        Wait if the queue is full.
+        """
+        await self.queue.put(
+            Push(
+                user_id,
+                token,
+                platform,
+                pool,
+                send_push,
+                args,
+                kwargs,
+                time.perf_counter(),
+            )
+        )
+
+    async def join(self) -> None:
+        """Wait until all the pushes queued (and their retries) are done"""
+        await self.queue.join()
+
+    def pop_deliveries(self) -> List[crud.Delivery]:
+        """Return the deliveries completed since the last call"""
+        deliveries, self.deliveries = self.deliveries, []
+        return deliveries
+
+    async def _send(self, push: Push) -> crud.PushResult:
+        async with push.pool.client() as client:
+            return await push.send_push(client, *push.args, **push.kwargs)
+
+    def _retry_delay(self, push: Push, result: crud.PushResult) -> Optional[float]:
+        if not result.is_transient or push.retries >= self.max_retries:
+            return None
+        delay = retry_delay(push.retries + 1, result.retry_after)
+        if delay is None:
+            logger.warning(
+                f"{push.pool.name} asked to retry in {result.retry_after} seconds. "
+                "Giving up."
+            )
+        else:
+            logger.info(f"Retrying push to {push.pool.name} in {delay:.2f} seconds")
+        return delay
+
+    async def _retry(self, push: Push, delay: float) -> None:
+        await asyncio.sleep(delay)
+        try:
+            await self.queue.put(push)
+        finally:
+            # The push is only done once queued again (see join)
+            self.queue.task_done()
+
+    async def _run_worker(self) -> None:
+        while True:
+            push = await self.queue.get()
+            try:
+                result = await self._send(push)
+            except Exception as e:
+                # Unexpected error: not retried
+                logger.exception(f"Failed to send push to {push.pool.name}")
+                result = crud.PushResult(schemas.DeliveryStatus.failure, reason=repr(e))
+                delay = None
+            else:
+                delay = self._retry_delay(push, result)
+            attempts = push.attempts + result.attempts
+            if delay is not None:
+                task = asyncio.create_task(
+                    self._retry(
+                        push._replace(attempts=attempts, retries=push.retries + 1),
+                        delay,
+                    )
+                )
+                self._retries.add(task)
+                task.add_done_callback(self._retries.discard)
+                continue
+            self.deliveries.append(
+                crud.Delivery(
+                    push.user_id,
+                    push.token,
+                    push.platform,
+                    result._replace(
+                        attempts=attempts, latency=time.perf_counter() - push.start
+                    ),
+                )
+            )
+            self.queue.task_done()
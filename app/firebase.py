@@ -1,69 +1,193 @@
+import asyncio
+import contextlib
 import httpx
+import time
+from datetime import datetime, timedelta, timezone
 from google.oauth2 import service_account
 from google.auth.transport.requests import Request as GoogleRequest
 from starlette.concurrency import run_in_threadpool
-from sqlalchemy.orm import Session
 from fastapi.logger import logger
-from typing import Dict
-from . import models, schemas, crud
-from .settings import GOOGLE_APPLICATION_CREDENTIALS, FIREBASE_PROJECT_ID
+from typing import Dict, Optional
+from . import clients, crud, metrics, schemas
+from .settings import (
+    GOOGLE_APPLICATION_CREDENTIALS,
+    GOOGLE_TOKEN_REFRESH_MARGIN,
+    FIREBASE_PROJECT_ID,
+    FCM_URL,
+)
 
 
-google_credentials = service_account.Credentials.from_service_account_file(
-    filename=str(GOOGLE_APPLICATION_CREDENTIALS),
-    scopes=["https://www.googleapis.com/auth/cloud-platform"],
-)
+def load_credentials() -> service_account.Credentials:
+    return service_account.Credentials.from_service_account_file(
+        filename=str(GOOGLE_APPLICATION_CREDENTIALS),
+        scopes=["https://www.googleapis.com/auth/cloud-platform"],
+    )
+
+
+class AccessToken:
+    """Cache of the Google access token used to authorize FCM requests
+
+    The service account key is only read on first use. The token is shared
+    by all notifications and refreshed refresh_margin seconds before it
+    expires. Concurrent callers wait for the same refresh.
+    When started, the token is refreshed in the background before
+    it expires, so that sending notifications doesn't wait for Google.
+    """
+
+    def __init__(self, refresh_margin: int = GOOGLE_TOKEN_REFRESH_MARGIN):
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self.credentials: Optional[service_account.Credentials] = None
+        self._refreshing: Optional[asyncio.Future] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    @property
+    def expiry(self) -> Optional[datetime]:
+        if self.credentials is None or self.credentials.expiry is None:
+            return None
+        # google-auth uses naive UTC datetimes
+        return self.credentials.expiry.replace(tzinfo=timezone.utc)
+
+    @property
+    def is_stale(self) -> bool:
+        return (
+            self.expiry is None
+            or self.credentials.token is None
+            or datetime.now(timezone.utc) + self.refresh_margin >= self.expiry
+        )
+
+    def refresh(self) -> None:
+        """Request a new token to Google (blocking)"""
+        if self.credentials is None:
+            self.credentials = load_credentials()
+        self.credentials.refresh(GoogleRequest())
+        logger.info("New Google access token retrieved")
+
+    async def _refresh(self) -> None:
+        """Refresh the token in the threadpool, once for concurrent callers"""
+        if (
+            self._refreshing is None
+            or self._refreshing.done()
+            or self._refreshing.get_loop() is not asyncio.get_running_loop()
+        ):
+            self._refreshing = asyncio.ensure_future(run_in_threadpool(self.refresh))
+        # A cancelled caller shouldn't cancel the refresh awaited by the others
+        await asyncio.shield(self._refreshing)
 
+    async def get(self) -> str:
+        """Return a valid access token"""
+        if self.is_stale:
+            await self._refresh()
+        return self.credentials.token
 
-def get_access_token() -> str:
-    """Retrieve a valid access token that can be used to authorize firebase requests."""
-    if google_credentials.valid:
-        return google_credentials.token
-    request = GoogleRequest()
-    google_credentials.refresh(request)
-    return google_credentials.token
+    async def _run_refresh(self) -> None:
+        while True:
+            try:
+                if self.is_stale:
+                    await self._refresh()
+            except Exception:
+                logger.exception("Failed to refresh the Google access token")
+                await asyncio.sleep(10)
+                continue
+            delay = self.expiry - self.refresh_margin - datetime.now(timezone.utc)
+            await asyncio.sleep(max(delay.total_seconds(), 1))
+
+    async def start(self) -> None:
+        """Start refreshing the token in the background"""
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._run_refresh())
+
+    async def stop(self) -> None:
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._refresh_task
+            self._refresh_task = None
+
+
+access_token = AccessToken()
 
 
 async def create_headers(request_id: str) -> Dict:
     """Prepare HTTP headers that will be used to request Firebase Cloud Messaging."""
-    access_token: str = await run_in_threadpool(get_access_token)
+    token = await access_token.get()
     return {
-        "Authorization": f"Bearer {access_token}",
+        "Authorization": f"Bearer {token}",
         "Content-Type": "application/json; UTF-8",
         "X-Request-Id": request_id,
     }
 
 
+def get_reason(response: httpx.Response) -> str:
+    """Return the error code sent by FCM"""
+    try:
+        error = response.json()["error"]
+    except Exception:
+        return ""
+    if not isinstance(error, dict):
+        return str(error)
+    for detail in error.get("details", []):
+        if "errorCode" in detail:
+            return detail["errorCode"]
+    return error.get("status", "")
+
+
 async def send_push(
     client: httpx.AsyncClient,
-    payload: schemas.AndroidPayload,
-    db: Session,
-    user: models.User,
-) -> bool:
+    device_token: str,
+    payload: bytes,
+    username: str,
+    headers: Optional[Dict[str, str]] = None,
+) -> crud.PushResult:
     """Send a push notification to Android
 
-    Return True in case of success
+    payload is the JSON body (see payloads.NotificationPayloads).
+    An invalid token is reported as unregistered (to be deleted by the caller).
     """
-    device_token = payload.message.token
-    logger.info(f"Send notification to {user.username} (token: {device_token[:10]}...)")
+    logger.info(f"Send notification to {username} (token: {device_token[:10]}...)")
+    start = time.perf_counter()
     try:
-        response = await client.post(
-            f"https://fcm.googleapis.com/v1/projects/{FIREBASE_PROJECT_ID}/messages:send",
-            json=payload.model_dump(),
-        )
+        with metrics.push_request_duration.labels(platform="android").time():
+            response = await client.post(
+                f"{FCM_URL}/v1/projects/{FIREBASE_PROJECT_ID}/messages:send",
+                content=payload,
+                headers=headers,
+            )
+        metrics.push_requests.labels(
+            platform="android", status_code=response.status_code
+        ).inc()
         response.raise_for_status()
     except httpx.RequestError as exc:
         logger.error(f"HTTP Exception for {exc.request.url} - {exc}")
-        return False
+        metrics.push_requests.labels(platform="android", status_code="error").inc()
+        metrics.pushes.labels(platform="android", result="failure").inc()
+        return crud.PushResult(
+            schemas.DeliveryStatus.failure,
+            reason=type(exc).__name__,
+            latency=time.perf_counter() - start,
+        )
     except httpx.HTTPStatusError as exc:
-        logger.warning(f"{exc}")
-        logger.warning(response.json())
+        # The body isn't always JSON (e.g. HTML error page of a proxy)
+        reason = get_reason(response)
+        logger.warning(f"{exc} ({reason or response.text[:200]})")
+        status = schemas.DeliveryStatus.failure
         # See https://firebase.google.com/docs/reference/fcm/rest/v1/ErrorCode
         if response.status_code == 404:
             logger.info(
-                f"Device token invalid or no longer active. Delete {device_token} for user {user.username}"
+                f"Device token {device_token} invalid or no longer active for user {username}"
             )
-            crud.remove_user_device_token(db, user, device_token)
-        return False
-    logger.info(f"Notification sent to user {user.username}")
-    return True
+            status = schemas.DeliveryStatus.unregistered
+        metrics.pushes.labels(platform="android", result="failure").inc()
+        return crud.PushResult(
+            status,
+            status_code=response.status_code,
+            reason=reason or None,
+            latency=time.perf_counter() - start,
+            retry_after=clients.get_retry_after(response),
+        )
+    logger.info(f"Notification sent to user {username}")
+    metrics.pushes.labels(platform="android", result="success").inc()
+    return crud.PushResult(
+        schemas.DeliveryStatus.success,
+        status_code=response.status_code,
+        latency=time.perf_counter() - start,
+    )
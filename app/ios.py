@@ -1,19 +1,28 @@
+import asyncio
+import contextlib
 import httpx
 import jwt
-from datetime import datetime
-from typing import Dict
-from sqlalchemy.orm import Session
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+from starlette.concurrency import run_in_threadpool
 from fastapi.logger import logger
-from . import models, schemas, crud
+from . import clients, crud, metrics, schemas
 from .settings import (
     APNS_ALGORITHM,
     APNS_AUTH_KEY,
     APNS_KEY_ID,
+    APNS_TOKEN_REFRESH_INTERVAL,
+    APNS_TOKEN_REFRESH_MARGIN,
     TEAM_ID,
     BUNDLE_ID,
     APPLE_SERVER,
 )
 
+# Apple throttles tokens refreshed more often than every 20 minutes
+# See https://developer.apple.com/documentation/usernotifications/establishing-a-token-based-connection-to-apns
+MIN_TOKEN_REFRESH_INTERVAL = timedelta(minutes=20)
+
 
 def create_headers(issued_at: datetime) -> Dict[str, str]:
     """Return the required headers to send an Apple push notification"""
@@ -28,41 +37,181 @@ def create_headers(issued_at: datetime) -> Dict[str, str]:
         "apns-priority": "10",
         "apns-topic": BUNDLE_ID,
         "authorization": "Bearer " + token,
+        "content-type": "application/json",
     }
 
 
+class ProviderToken:
+    """Cache of the APNs provider authentication token
+
+    Apple accepts a token for one hour. The token is signed once
+    and the headers are reused until refresh_interval is reached.
+    When started, the token is refreshed in the background refresh_margin
+    seconds before it becomes stale, so that no signing happens when sending
+    notifications.
+    """
+
+    def __init__(
+        self,
+        refresh_interval: int = APNS_TOKEN_REFRESH_INTERVAL,
+        refresh_margin: int = APNS_TOKEN_REFRESH_MARGIN,
+    ):
+        self.refresh_interval = max(
+            timedelta(seconds=refresh_interval), MIN_TOKEN_REFRESH_INTERVAL
+        )
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self.issued_at: Optional[datetime] = None
+        self._headers: Optional[Dict[str, str]] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    @property
+    def is_stale(self) -> bool:
+        return (
+            self.issued_at is None
+            or datetime.now(timezone.utc) - self.issued_at >= self.refresh_interval
+        )
+
+    def refresh(self) -> None:
+        """Sign a new token"""
+        issued_at = datetime.now(timezone.utc)
+        self._headers = create_headers(issued_at)
+        self.issued_at = issued_at
+        logger.info("New APNs provider token created")
+
+    def headers(self) -> Dict[str, str]:
+        """Return the headers including the current token"""
+        if self._headers is None or self.is_stale:
+            self.refresh()
+        return self._headers
+
+    def expire(self, headers: Dict[str, str]) -> None:
+        """Refresh the token if headers are still the current ones
+
+        To be called when Apple replies that the token has expired.
+        Concurrent requests that failed with the same token only trigger
+        one refresh.
+        """
+        if headers is self._headers:
+            self.refresh()
+
+    @property
+    def next_refresh(self) -> Optional[datetime]:
+        """Time of the background refresh, before the token is stale"""
+        if self.issued_at is None:
+            return None
+        return self.issued_at + max(
+            self.refresh_interval - self.refresh_margin, MIN_TOKEN_REFRESH_INTERVAL
+        )
+
+    async def _run_refresh(self) -> None:
+        while True:
+            try:
+                if self.is_stale or datetime.now(timezone.utc) >= self.next_refresh:
+                    await run_in_threadpool(self.refresh)
+            except Exception:
+                logger.exception("Failed to refresh the APNs provider token")
+                await asyncio.sleep(10)
+                continue
+            delay = self.next_refresh - datetime.now(timezone.utc)
+            await asyncio.sleep(max(delay.total_seconds(), 1))
+
+    async def start(self) -> None:
+        """Start refreshing the token in the background"""
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._run_refresh())
+
+    async def stop(self) -> None:
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._refresh_task
+            self._refresh_task = None
+
+
+provider_token = ProviderToken()
+
+
+def get_reason(response: httpx.Response) -> str:
+    """Return the reason of the error sent by APNs"""
+    try:
+        return response.json().get("reason", "")
+    except Exception:
+        return ""
+
+
 async def send_push(
     client: httpx.AsyncClient,
     apn: str,
-    payload: schemas.ApnPayload,
-    db: Session,
-    user: models.User,
-) -> bool:
+    payload: bytes,
+    username: str,
+) -> crud.PushResult:
     """Send a push notification to iOS
 
-    Return True in case of success
+    payload is the JSON body (see payloads.NotificationPayloads).
+    The request is retried once if the provider token was rejected.
+    A token no longer active is reported as unregistered (to be deleted by the caller).
     """
-    logger.info(f"Send notification to {user.username} (apn: {apn[:10]}...)")
-    try:
-        response = await client.post(
-            f"https://{APPLE_SERVER}/3/device/{apn}", json=payload.model_dump()
-        )
-        response.raise_for_status()
-    except httpx.RequestError as exc:
-        logger.error(f"HTTP Exception for {exc.request.url} - {exc}")
-        return False
-    except httpx.HTTPStatusError as exc:
-        logger.warning(f"{exc}")
+    logger.info(f"Send notification to {username} (apn: {apn[:10]}...)")
+    start = time.perf_counter()
+    attempts = 0
+    while True:
+        attempts += 1
+        headers = provider_token.headers()
         try:
-            logger.warning(f"response: {response.json()}")
-        except Exception:
-            logger.warning("No json response content")
-        # See https://developer.apple.com/documentation/usernotifications/setting_up_a_remote_notification_server/handling_notification_responses_from_apns
-        if response.status_code == 410:
-            logger.info(
-                f"Device token no longer active. Delete {apn} for user {user.username}"
+            with metrics.push_request_duration.labels(platform="ios").time():
+                response = await client.post(
+                    f"https://{APPLE_SERVER}/3/device/{apn}",
+                    content=payload,
+                    headers=headers,
+                )
+            metrics.push_requests.labels(
+                platform="ios", status_code=response.status_code
+            ).inc()
+            response.raise_for_status()
+        except httpx.RequestError as exc:
+            logger.error(f"HTTP Exception for {exc.request.url} - {exc}")
+            metrics.push_requests.labels(platform="ios", status_code="error").inc()
+            metrics.pushes.labels(platform="ios", result="failure").inc()
+            return crud.PushResult(
+                schemas.DeliveryStatus.failure,
+                reason=type(exc).__name__,
+                latency=time.perf_counter() - start,
+                attempts=attempts,
+            )
+        except httpx.HTTPStatusError as exc:
+            reason = get_reason(response)
+            # See https://developer.apple.com/documentation/usernotifications/setting_up_a_remote_notification_server/handling_notification_responses_from_apns
+            if attempts == 1 and reason == "ExpiredProviderToken":
+                logger.warning("APNs provider token expired. Retrying with a new one.")
+                provider_token.expire(headers)
+                continue
+            if attempts == 1 and reason == "TooManyProviderTokenUpdates":
+                # Refreshing the token again would make it worse
+                logger.warning("Too many APNs provider token updates. Retrying.")
+                continue
+            logger.warning(f"{exc}")
+            try:
+                logger.warning(f"response: {response.json()}")
+            except Exception:
+                logger.warning("No json response content")
+            status = schemas.DeliveryStatus.failure
+            if response.status_code == 410:
+                logger.info(f"Device token {apn} no longer active for user {username}")
+                status = schemas.DeliveryStatus.unregistered
+            metrics.pushes.labels(platform="ios", result="failure").inc()
+            return crud.PushResult(
+                status,
+                status_code=response.status_code,
+                reason=reason or None,
+                latency=time.perf_counter() - start,
+                attempts=attempts,
+                retry_after=clients.get_retry_after(response),
             )
-            crud.remove_user_device_token(db, user, apn)
-        return False
-    logger.info(f"Notification sent to user {user.username}")
-    return True
+        logger.info(f"Notification sent to user {username}")
+        metrics.pushes.labels(platform="ios", result="success").inc()
+        return crud.PushResult(
+            schemas.DeliveryStatus.success,
+            status_code=response.status_code,
+            latency=time.perf_counter() - start,
+            attempts=attempts,
+        )
@@ -69,6 +69,7 @@ app = FastAPI(
     docs_url=None,
     redoc_url=None,
 )
+app.add_middleware(monitoring.MetricsMiddleware)
 app.include_router(account.router)
 app.include_router(notifications.router, prefix="/notifications")
 app.include_router(settings.router, prefix="/settings")
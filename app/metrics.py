@@ -0,0 +1,50 @@
+"""Prometheus metrics
+
+The metrics are exposed under /-/metrics by the API and each push worker can serve
+its own metrics (see PUSH_WORKER_METRICS_PORT).
+When the PROMETHEUS_MULTIPROC_DIR environment variable is set, the values of all
+the processes using that directory (the gunicorn workers) are aggregated.
+"""
+
+from prometheus_client import Counter, Histogram
+
+notifications_created = Counter(
+    "notify_notifications_created_total",
+    "Number of notifications created",
+    ["service"],
+)
+push_requests = Counter(
+    "notify_push_requests_total",
+    "Number of requests sent to APNs and FCM by response status code",
+    ["platform", "status_code"],
+)
+pushes = Counter(
+    "notify_pushes_total",
+    "Number of push notifications sent to a device",
+    ["platform", "result"],
+)
+device_tokens_pruned = Counter(
+    "notify_device_tokens_pruned_total",
+    "Number of device tokens deleted because rejected by APNs or FCM",
+    ["platform"],
+)
+push_request_duration = Histogram(
+    "notify_push_request_duration_seconds",
+    "Duration of the requests sent to APNs and FCM",
+    ["platform"],
+)
+fanout_duration = Histogram(
+    "notify_fanout_duration_seconds",
+    "Time to send a notification to all its recipients",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+notifications_rate_limited = Counter(
+    "notify_notifications_rate_limited_total",
+    "Number of notifications rejected because of the rate limit",
+    ["scope"],
+)
+http_request_duration = Histogram(
+    "notify_http_request_duration_seconds",
+    "Duration of the HTTP requests",
+    ["method", "route", "status_code"],
+)
@@ -1,18 +1,19 @@
 from __future__ import annotations
 import datetime
 import uuid
-from typing import List
+from typing import List, Optional
 from sqlalchemy import (
     Table,
     Boolean,
     Column,
     ForeignKey,
+    Index,
     Integer,
     String,
     DateTime,
-    func,
+    Float,
 )
-from sqlalchemy.orm import relationship, backref, Session
+from sqlalchemy.orm import relationship, backref
 from sqlalchemy.types import TypeDecorator, CHAR
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.associationproxy import association_proxy
@@ -99,11 +100,20 @@ class User(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, unique=True, index=True)
-    # Store list of APN tokens as semi-colon separated string
-    _device_tokens = Column(String, default="")
     is_active = Column(Boolean, default=True, nullable=False)
     is_admin = Column(Boolean, default=False, nullable=False)
     login_token_expire_date = Column(TZDateTime, default=utcnow, nullable=False)
+    # Incremented each time the user's notifications change (see crud.sync_user_notifications)
+    sync_sequence = Column(Integer, default=0, nullable=False)
+    # Deletions up to this sequence aren't recorded anymore: clients with an older
+    # sync_token have to reload all their notifications
+    sync_floor = Column(Integer, default=0, nullable=False)
+    # Notifications older than this date were deleted (retention) without being
+    # recorded: clients drop them on sync
+    notifications_deleted_before = Column(TZDateTime, nullable=True)
+    # Number of unread notifications, maintained by the crud functions
+    # (see crud.reconcile_unread_counts to repair it)
+    unread_count = Column(Integer, default=0, nullable=False)
 
     services = relationship(
         "Service",
@@ -111,6 +121,12 @@ class User(Base):
         back_populates="subscribers",
         order_by="Service.category",
     )
+    tokens = relationship(
+        "DeviceToken",
+        backref="user",
+        cascade="all, delete-orphan",
+        order_by="DeviceToken.id",
+    )
     # association proxy of "user_notifications" collection
     # to "notification" attribute
     notifications = association_proxy(
@@ -120,30 +136,32 @@ class User(Base):
 
     @property
     def nb_unread_notifications(self) -> int:
-        session = Session.object_session(self)
-        query = session.query(UserNotification).filter(
-            UserNotification.user_id == self.id,
-            UserNotification.is_read.is_(False),
-        )
-        return query.with_entities(func.count()).scalar()
+        return self.unread_count
 
     @property
-    def device_tokens(self):
-        if not self._device_tokens:
-            return []
-        return [token for token in self._device_tokens.split(";")]
+    def device_tokens(self) -> List[str]:
+        return [device_token.token for device_token in self.tokens]
 
     @device_tokens.setter
     def device_tokens(self, value: List[str]):
-        self._device_tokens = ";".join(value)
+        existing = {device_token.token: device_token for device_token in self.tokens}
+        self.tokens = [existing.get(token) or DeviceToken(token) for token in value]
 
     @property
-    def ios_tokens(self):
-        return [token for token in self.device_tokens if len(token) == 64]
+    def ios_tokens(self) -> List[str]:
+        return [
+            device_token.token
+            for device_token in self.tokens
+            if device_token.platform == schemas.Platform.ios
+        ]
 
     @property
-    def android_tokens(self):
-        return [token for token in self.device_tokens if len(token) > 64]
+    def android_tokens(self) -> List[str]:
+        return [
+            device_token.token
+            for device_token in self.tokens
+            if device_token.platform == schemas.Platform.android
+        ]
 
     @property
     def is_logged_in(self):
@@ -152,18 +170,14 @@ class User(Base):
         )
 
     def add_device_token(self, value: str):
-        if value in self.device_tokens:
-            return
-        if not self._device_tokens:
-            self._device_tokens = value
-        else:
-            self._device_tokens += f";{value}"
+        if value not in self.device_tokens:
+            self.tokens.append(DeviceToken(value))
 
     def remove_device_token(self, value: str):
-        if value in self.device_tokens:
-            self.device_tokens = [
-                token for token in self.device_tokens if token != value
-            ]
+        for device_token in self.tokens:
+            if device_token.token == value:
+                self.tokens.remove(device_token)
+                return
 
     def subscribe(self, service: Service) -> None:
         if service not in self.services:
@@ -183,6 +197,36 @@ class User(Base):
         )
 
 
+def get_platform(token: str) -> Optional[schemas.Platform]:
+    """Return the platform of the device token based on its length"""
+    if len(token) == 64:
+        return schemas.Platform.ios
+    if len(token) > 64:
+        return schemas.Platform.android
+    return None
+
+
+class DeviceToken(Base):
+    __tablename__ = "device_tokens"
+    __table_args__ = (
+        Index("ix_device_tokens_user_id_platform", "user_id", "platform"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    token = Column(String, unique=True, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    # ios or android - None if the token format isn't recognized
+    # (no notification is sent to such token)
+    platform = Column(String)
+    created_at = Column(TZDateTime, default=utcnow, nullable=False)
+    # Last time a notification was successfully sent to the device
+    last_success_at = Column(TZDateTime)
+
+    def __init__(self, token: str, **kwargs):
+        platform = get_platform(token)
+        super().__init__(token=token, platform=platform and platform.value, **kwargs)
+
+
 class Service(Base):
     __tablename__ = "services"
 
@@ -190,6 +234,9 @@ class Service(Base):
     category = Column(String, index=True, nullable=False)
     color = Column(String)
     owner = Column(String)
+    # Notifications created within this number of seconds after the previous
+    # one are pushed together as one summary (0 to disable)
+    coalescing_window = Column(Integer, default=0, nullable=False)
 
     notifications = relationship(
         "Notification", backref="service", order_by="Notification.timestamp"
@@ -208,6 +255,8 @@ class Service(Base):
 
 class Notification(Base):
     __tablename__ = "notifications"
+    # Used for the keyset pagination of the user's notifications
+    __table_args__ = (Index("ix_notifications_timestamp_id", "timestamp", "id"),)
 
     id = Column(Integer, primary_key=True, index=True)
     timestamp = Column(TZDateTime, index=True, default=utcnow, nullable=False)
@@ -229,16 +278,50 @@ class Notification(Base):
             title=self.title, body=self.subtitle[:256], url=self.url
         )
 
+    def to_summary(self, nb_notifications: int) -> Notification:
+        """Return a notification (not saved) announcing the last nb_notifications
+
+        Used to push notifications coalesced by the service (see coalescing_window).
+        """
+        return Notification(
+            title=f"{nb_notifications} new notifications from {self.service.category}",
+            subtitle=self.title,
+            url=self.url,
+        )
+
+    def to_apn_payload(self, badge: int) -> schemas.ApnPayload:
+        aps = schemas.Aps(alert=self.to_alert(), badge=badge)
+        return schemas.ApnPayload(aps=aps)
+
+    def to_android_payload(self, token: str) -> schemas.AndroidPayload:
+        message = schemas.AndroidMessage(
+            token=token,
+            data=self.to_android_data(),
+        )
+        return schemas.AndroidPayload(message=message)
+
 
 class UserNotification(Base):
     __tablename__ = "users_notifications"
+    __table_args__ = (
+        Index("ix_users_notifications_user_id_sequence", "user_id", "sequence"),
+        # Removal of the notifications from all users (see crud.delete_notifications)
+        Index("ix_users_notifications_notification_id", "notification_id"),
+    )
     user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
     notification_id = Column(Integer, ForeignKey("notifications.id"), primary_key=True)
     is_read = Column(Boolean, default=False)
+    # User sync_sequence when the notification was created or last updated
+    sequence = Column(Integer, default=0, nullable=False)
 
     # bidirectional attribute/collection of "user"/"user_notifications"
     user = relationship(
-        User, backref=backref("user_notifications", cascade="all, delete-orphan")
+        User,
+        backref=backref(
+            "user_notifications",
+            cascade="all, delete-orphan",
+            order_by="UserNotification.notification_id",
+        ),
     )
     # reference to the "Notification" object
     notification = relationship("Notification", backref="users_notification")
@@ -257,14 +340,88 @@ class UserNotification(Base):
         )
 
     def to_apn_payload(self) -> schemas.ApnPayload:
-        aps = schemas.Aps(
-            alert=self.notification.to_alert(), badge=self.user.nb_unread_notifications
-        )
-        return schemas.ApnPayload(aps=aps)
+        return self.notification.to_apn_payload(self.user.nb_unread_notifications)
 
     def to_android_payload(self, token) -> schemas.AndroidPayload:
-        message = schemas.AndroidMessage(
-            token=token,
-            data=self.notification.to_android_data(),
-        )
-        return schemas.AndroidPayload(message=message)
+        return self.notification.to_android_payload(token)
+
+
+class DeletedUserNotification(Base):
+    """Notification removed from a user's list
+
+    Kept so that clients doing an incremental sync can remove it as well.
+    """
+
+    __tablename__ = "deleted_users_notifications"
+    __table_args__ = (
+        Index("ix_deleted_users_notifications_user_id_sequence", "user_id", "sequence"),
+        Index("ix_deleted_users_notifications_deleted_at", "deleted_at"),
+    )
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    # No foreign key: the notification itself might be deleted
+    notification_id = Column(Integer, primary_key=True)
+    sequence = Column(Integer, nullable=False)
+    deleted_at = Column(TZDateTime, default=utcnow, nullable=False)
+
+
+class PushJob(Base):
+    """Pending delivery of a notification to its recipients
+
+    Jobs are created in the same transaction as the notification
+    and processed by the push workers (see app.worker).
+    A job is only deleted once the notification has been sent.
+    If a worker dies while processing a job, the lease expires
+    and the job is claimed again by another worker.
+    """
+
+    __tablename__ = "push_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    notification_id = Column(Integer, ForeignKey("notifications.id"), nullable=False)
+    created_at = Column(TZDateTime, default=utcnow, nullable=False)
+    available_at = Column(TZDateTime, index=True, default=utcnow, nullable=False)
+    locked_until = Column(TZDateTime)
+    attempts = Column(Integer, default=0, nullable=False)
+    # Number of notifications of the service pushed by this job: the job
+    # points to the last one (see crud.create_service_notification)
+    nb_notifications = Column(Integer, default=1, nullable=False)
+
+    notification = relationship("Notification")
+
+
+class Delivery(Base):
+    """Outcome of the sending of a notification to a device
+
+    Written by the push workers (see crud.create_deliveries).
+    """
+
+    __tablename__ = "deliveries"
+
+    id = Column(Integer, primary_key=True, index=True)
+    notification_id = Column(
+        Integer, ForeignKey("notifications.id"), index=True, nullable=False
+    )
+    user_id = Column(Integer, ForeignKey("users.id"), index=True, nullable=False)
+    # No foreign key: the token might be deleted (e.g. rejected by APNs or FCM)
+    token = Column(String, nullable=False)
+    platform = Column(String, nullable=False)
+    status = Column(String, nullable=False)
+    # HTTP status code of the last request (None if no response was received)
+    status_code = Column(Integer)
+    # Error reason sent by APNs or FCM, or exception raised
+    reason = Column(String)
+    # Time in seconds to send the notification, including retries
+    latency = Column(Float, nullable=False)
+    attempts = Column(Integer, default=1, nullable=False)
+    created_at = Column(TZDateTime, default=utcnow, nullable=False)
+
+
+class RateLimit(Base):
+    """Token bucket shared by the API processes (see app.ratelimit)"""
+
+    __tablename__ = "rate_limits"
+
+    key = Column(String, primary_key=True)
+    tokens = Column(Float, nullable=False)
+    # Unix time of the last update
+    updated_at = Column(Float, nullable=False)
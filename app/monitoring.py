@@ -1,9 +1,119 @@
+import os
+import time
+from typing import Iterator
 from fastapi import APIRouter
-from fastapi.responses import PlainTextResponse
+from fastapi.logger import logger
+from fastapi.responses import PlainTextResponse, Response
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+)
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from . import crud, metrics
+from .database import SessionLocal, engine, get_pool_status
 
 router = APIRouter()
 
 
+def count_push_jobs() -> float:
+    db = SessionLocal()
+    try:
+        return crud.count_push_jobs(db)
+    except Exception as e:
+        logger.warning(f"Failed to count the push jobs: {e}")
+        return float("nan")
+    finally:
+        db.close()
+
+
+class PushJobsCollector(Collector):
+    """Number of push jobs in the queue, counted in the database on collection"""
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        yield GaugeMetricFamily(
+            "notify_push_jobs_queued",
+            "Number of push jobs in the queue",
+            value=count_push_jobs(),
+        )
+
+
+def create_registry() -> CollectorRegistry:
+    """Return the registry to collect
+
+    In multiprocess mode (PROMETHEUS_MULTIPROC_DIR set), the metrics of all
+    the processes are collected from the directory, otherwise the metrics of
+    this process. The push jobs are counted on each collection.
+    """
+    registry = CollectorRegistry()
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry.register(REGISTRY)
+    registry.register(PushJobsCollector())
+    return registry
+
+
 @router.get("/health")
 def health_check():
     return PlainTextResponse("OK")
+
+
+@router.get("/pool")
+def pool_status():
+    """Return the status of the database connection pool of this process"""
+    return get_pool_status(engine.pool)
+
+
+@router.get("/metrics")
+def get_metrics():
+    """Return the metrics in the Prometheus text format"""
+    return Response(generate_latest(create_registry()), media_type=CONTENT_TYPE_LATEST)
+
+
+class MetricsMiddleware:
+    """Record the duration of the HTTP requests per route"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The route is set in the scope by the (mounted) routers
+            route = scope.get("route")
+            if route is None:
+                route_path = "unmatched"
+            else:
+                route_path = scope.get("root_path", "") + getattr(route, "path", "")
+            metrics.http_request_duration.labels(
+                method=scope["method"], route=route_path, status_code=status_code
+            ).observe(time.perf_counter() - start)
+
+
+def start_metrics_server(port: int, host: str = "0.0.0.0"):
+    """Serve the metrics under /metrics for processes without API (push workers)
+
+    The server runs in a daemon thread. Return the server, to shut it down.
+    """
+    server, _ = start_http_server(port, host, registry=create_registry())
+    logger.info(f"Metrics served on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,55 @@
+"""Push payloads rendered once per notification
+
+The JSON bodies sent to APNs and FCM for a notification only differ by the
+badge (iOS) or the device token (Android) between recipients. The body is
+rendered once and the per-recipient value is spliced in the bytes, so that
+no model is built or serialized per device.
+"""
+
+import json
+import uuid
+from typing import Dict
+from . import models
+
+
+class Template:
+    """JSON body with one value to fill per recipient"""
+
+    def __init__(self, data: dict, placeholder: str):
+        body = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+        parts = body.split(json.dumps(placeholder).encode())
+        if len(parts) != 2:
+            raise ValueError("The placeholder should appear exactly once")
+        self.prefix, self.suffix = parts
+
+    def render(self, value: bytes) -> bytes:
+        """Return the body with value (already JSON encoded) in place"""
+        return self.prefix + value + self.suffix
+
+
+class NotificationPayloads:
+    """APNs and FCM bodies of a notification"""
+
+    def __init__(self, notification: models.Notification):
+        # Random placeholder that can't be part of the notification
+        placeholder = uuid.uuid4().hex
+        apn_payload = notification.to_apn_payload(0).model_dump()
+        apn_payload["aps"]["badge"] = placeholder
+        self._apn = Template(apn_payload, placeholder)
+        self._android = Template(
+            notification.to_android_payload(placeholder).model_dump(), placeholder
+        )
+        # Many recipients share the same badge
+        self._apn_bodies: Dict[int, bytes] = {}
+
+    def apn(self, badge: int) -> bytes:
+        """Return the APNs body with the given badge"""
+        body = self._apn_bodies.get(badge)
+        if body is None:
+            body = self._apn.render(str(int(badge)).encode())
+            self._apn_bodies[badge] = body
+        return body
+
+    def android(self, token: str) -> bytes:
+        """Return the FCM body for the given device token"""
+        return self._android.render(json.dumps(token).encode())
@@ -0,0 +1,215 @@
+"""Rate limiting of the notifications created
+
+Token buckets: each key (service or source IP) can create burst notifications
+at once, then rate notifications per second.
+The buckets are kept by a backend:
+
+- MemoryBackend (default): per process. With several gunicorn workers, the
+  actual limit is multiplied by the number of workers.
+- DatabaseBackend: in the rate_limits table, shared by all processes
+  (one more transaction per notification).
+"""
+
+import abc
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Tuple
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from . import models
+from .database import SessionLocal
+from .settings import (
+    NOTIFICATION_RATE_LIMIT_SERVICE,
+    NOTIFICATION_RATE_LIMIT_SERVICE_BURST,
+    NOTIFICATION_RATE_LIMIT_IP,
+    NOTIFICATION_RATE_LIMIT_IP_BURST,
+    RATE_LIMIT_BACKEND,
+    RATE_LIMIT_MEMORY_SIZE,
+)
+
+
+def take_token(
+    tokens: float, elapsed: float, rate: float, burst: int, cost: int = 1
+) -> Tuple[float, float]:
+    """Refill the bucket after elapsed seconds and take cost tokens
+
+    A cost above burst requires a full bucket and leaves it negative: the next
+    requests wait until it is paid back.
+    Return the tokens left and the time to wait in seconds before the tokens
+    are available (0 if they were taken).
+    """
+    tokens = min(tokens + elapsed * rate, burst)
+    needed = min(cost, burst)
+    if tokens >= needed:
+        return tokens - cost, 0
+    return tokens, (needed - tokens) / rate
+
+
+class Backend(abc.ABC):
+    @abc.abstractmethod
+    def acquire(self, key: str, rate: float, burst: int, cost: int = 1) -> float:
+        """Take cost tokens from the bucket of key
+
+        Return 0 if allowed, the time to wait in seconds otherwise.
+        """
+
+    @abc.abstractmethod
+    def purge(self, prefix: str, rate: float, burst: int) -> int:
+        """Delete the buckets of the keys starting with prefix full again at rate
+
+        Deleting them doesn't change the limit. All of them are deleted if the
+        rate is 0 (limit disabled).
+        Return the number of buckets deleted.
+        """
+
+    @abc.abstractmethod
+    def clear(self) -> None:
+        """Reset all the buckets"""
+
+
+class MemoryBackend(Backend):
+    def __init__(self, size: int = RATE_LIMIT_MEMORY_SIZE):
+        self.size = size
+        # tokens left and time of the last update per key
+        self._buckets: OrderedDict[str, Tuple[float, float]] = OrderedDict()
+        # Sync endpoints run in the threadpool
+        self._lock = threading.Lock()
+
+    def acquire(self, key: str, rate: float, burst: int, cost: int = 1) -> float:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens, delay = take_token(tokens, now - updated_at, rate, burst, cost)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.size:
+                self._buckets.popitem(last=False)
+        return delay
+
+    def purge(self, prefix: str, rate: float, burst: int) -> int:
+        now = time.monotonic()
+        with self._lock:
+            stale = [
+                key
+                for key, (tokens, updated_at) in self._buckets.items()
+                if key.startswith(prefix)
+                and (rate <= 0 or tokens + (now - updated_at) * rate >= burst)
+            ]
+            for key in stale:
+                del self._buckets[key]
+        return len(stale)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+
+
+class DatabaseBackend(Backend):
+    def __init__(self, session_factory: Callable[[], Session] = SessionLocal):
+        self.session_factory = session_factory
+
+    def _acquire(
+        self, db: Session, key: str, rate: float, burst: int, cost: int
+    ) -> float:
+        # Wall clock: the buckets are shared between processes
+        now = time.time()
+        bucket = (
+            db.query(models.RateLimit)
+            .filter(models.RateLimit.key == key)
+            .with_for_update()
+            .first()
+        )
+        if bucket is None:
+            bucket = models.RateLimit(key=key, tokens=burst, updated_at=now)
+            db.add(bucket)
+        bucket.tokens, delay = take_token(
+            bucket.tokens, max(now - bucket.updated_at, 0), rate, burst, cost
+        )
+        bucket.updated_at = now
+        db.commit()
+        return delay
+
+    def acquire(self, key: str, rate: float, burst: int, cost: int = 1) -> float:
+        db = self.session_factory()
+        try:
+            try:
+                return self._acquire(db, key, rate, burst, cost)
+            except IntegrityError:
+                # Bucket created at the same time by another process
+                db.rollback()
+                return self._acquire(db, key, rate, burst, cost)
+        finally:
+            db.close()
+
+    def purge(self, prefix: str, rate: float, burst: int) -> int:
+        db = self.session_factory()
+        try:
+            query = db.query(models.RateLimit).filter(
+                models.RateLimit.key.startswith(prefix)
+            )
+            if rate > 0:
+                query = query.filter(
+                    models.RateLimit.tokens
+                    + (time.time() - models.RateLimit.updated_at) * rate
+                    >= burst
+                )
+            nb_deleted = query.delete(synchronize_session=False)
+            db.commit()
+            return nb_deleted
+        finally:
+            db.close()
+
+    def clear(self) -> None:
+        db = self.session_factory()
+        try:
+            db.query(models.RateLimit).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+
+BACKENDS = {"memory": MemoryBackend, "database": DatabaseBackend}
+
+
+class RateLimit:
+    """Token bucket per key (a rate of 0 disables the limit)"""
+
+    def __init__(self, scope: str, rate: float, burst: int, backend: Backend):
+        self.scope = scope
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.backend = backend
+
+    def acquire(self, key: str, cost: int = 1) -> float:
+        """Take cost tokens (one per notification) from the bucket of key
+
+        Return 0 if allowed, the time to wait in seconds otherwise.
+        """
+        if self.rate <= 0:
+            return 0
+        return self.backend.acquire(f"{self.scope}:{key}", self.rate, self.burst, cost)
+
+    def purge(self) -> int:
+        """Delete the buckets full again (all of them if the limit is disabled)"""
+        return self.backend.purge(f"{self.scope}:", self.rate, self.burst)
+
+
+backend = BACKENDS[RATE_LIMIT_BACKEND]()
+per_service = RateLimit(
+    "service",
+    NOTIFICATION_RATE_LIMIT_SERVICE,
+    NOTIFICATION_RATE_LIMIT_SERVICE_BURST,
+    backend,
+)
+per_ip = RateLimit(
+    "ip", NOTIFICATION_RATE_LIMIT_IP, NOTIFICATION_RATE_LIMIT_IP_BURST, backend
+)
+
+
+def purge() -> int:
+    """Delete the stale buckets of the rate limits
+
+    Return the number of buckets deleted.
+    """
+    return per_service.purge() + per_ip.purge()
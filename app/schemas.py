@@ -3,9 +3,9 @@ import datetime
 import re
 import uuid
 from enum import Enum
-from typing import List, Optional
+from typing import Dict, List, Optional
 from typing_extensions import Annotated
-from pydantic import ConfigDict, BaseModel
+from pydantic import ConfigDict, BaseModel, NonNegativeInt
 from pydantic.functional_validators import AfterValidator
 from pydantic.functional_serializers import PlainSerializer
 
@@ -36,6 +36,11 @@ class SortOrder(str, Enum):
     desc = "desc"
 
 
+class Platform(str, Enum):
+    ios = "ios"
+    android = "android"
+
+
 class ApnToken(BaseModel):
     apn_token: str
 
@@ -70,6 +75,7 @@ class ServiceBase(BaseModel):
     category: str
     color: Color
     owner: str
+    coalescing_window: NonNegativeInt = 0
 
 
 class ServiceCreate(ServiceBase):
@@ -85,6 +91,7 @@ class ServiceUpdate(BaseModel):
     category: Optional[str] = None
     color: Optional[Color] = None
     owner: Optional[str] = None
+    coalescing_window: Optional[NonNegativeInt] = None
 
 
 class UserService(Service):
@@ -125,6 +132,18 @@ class UserNotification(Notification):
     is_read: bool
 
 
+class UserNotificationsSync(BaseModel):
+    sync_token: int
+    notifications: List[UserNotification]
+    deleted: List[int]
+    # All notifications are returned: the client shall replace its list
+    full_resync: bool = False
+    # Cursor of the next page of the full list
+    next_cursor: Optional[int] = None
+    # The client shall drop the notifications older than this date
+    deleted_before: Optional[NoTZDateTime] = None
+
+
 class NotificationStatus(str, Enum):
     read = "read"
     unread = "unread"
@@ -136,6 +155,39 @@ class UserUpdateNotification(BaseModel):
     status: NotificationStatus
 
 
+class DeliveryStatus(str, Enum):
+    success = "success"
+    failure = "failure"
+    # Token rejected by APNs or FCM (and deleted)
+    unregistered = "unregistered"
+
+
+class Delivery(BaseModel):
+    id: int
+    username: str
+    token: str
+    platform: Platform
+    status: DeliveryStatus
+    status_code: Optional[int] = None
+    reason: Optional[str] = None
+    latency: float
+    attempts: int
+    created_at: datetime.datetime
+
+
+class DeliverySummary(BaseModel):
+    notification_id: int
+    total: int
+    success: int
+    failure: int
+    unregistered: int
+    nb_users: int
+    nb_users_reached: int
+    latency_max: Optional[float] = None
+    # Number of failed deliveries per reason
+    reasons: Dict[str, int]
+
+
 class Alert(BaseModel):
     title: str
     subtitle: str
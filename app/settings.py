@@ -52,6 +52,21 @@ SQLALCHEMY_DATABASE_URL = config(
     "SQLALCHEMY_DATABASE_URL", cast=str, default="sqlite:///./sql_app.db"
 )
 SQLALCHEMY_DEBUG = config("SQLALCHEMY_DEBUG", cast=bool, default=False)
+# Database connection pool (per process - ignored with sqlite)
+# Each gunicorn worker and push worker opens up to
+# SQLALCHEMY_POOL_SIZE + SQLALCHEMY_MAX_OVERFLOW connections
+SQLALCHEMY_POOL_SIZE = config("SQLALCHEMY_POOL_SIZE", cast=int, default=5)
+SQLALCHEMY_MAX_OVERFLOW = config("SQLALCHEMY_MAX_OVERFLOW", cast=int, default=10)
+# Time in seconds to wait for a connection before giving up
+SQLALCHEMY_POOL_TIMEOUT = config("SQLALCHEMY_POOL_TIMEOUT", cast=float, default=30)
+# Time in seconds after which a connection is replaced (-1 to disable)
+SQLALCHEMY_POOL_RECYCLE = config("SQLALCHEMY_POOL_RECYCLE", cast=int, default=1800)
+# Test connections before using them
+SQLALCHEMY_POOL_PRE_PING = config("SQLALCHEMY_POOL_PRE_PING", cast=bool, default=True)
+# Maximum time in milliseconds for a statement (PostgreSQL only - 0 to disable)
+SQLALCHEMY_STATEMENT_TIMEOUT = config(
+    "SQLALCHEMY_STATEMENT_TIMEOUT", cast=int, default=0
+)
 # Session expiry time in seconds: 12 hours (12 * 60 * 60 = 43200)
 SESSION_MAX_AGE = config("SESSION_MAX_AGE", cast=int, default=43200)
 APNS_ALGORITHM = "ES256"
@@ -62,13 +77,29 @@ APPLE_SERVER = config(
     "APPLE_SERVER", cast=str, default="api.development.push.apple.com"
 )
 BUNDLE_ID = "eu.ess.ESS-Notify"
+# Time in seconds after which a new APNs provider token is signed
+# Apple rejects tokens older than one hour and throttles refreshes
+# more frequent than every 20 minutes
+APNS_TOKEN_REFRESH_INTERVAL = config(
+    "APNS_TOKEN_REFRESH_INTERVAL", cast=int, default=3000
+)
+# Push workers refresh the token in the background this number of seconds
+# before the refresh interval is reached
+APNS_TOKEN_REFRESH_MARGIN = config("APNS_TOKEN_REFRESH_MARGIN", cast=int, default=60)
 ALLOWED_NETWORKS = config("ALLOWED_NETWORKS", cast=CommaSeparatedStrings, default="")
 
 # Firebase settings
 FIREBASE_PROJECT_ID = config("FIREBASE_PROJECT_ID", cast=str, default="my-project")
+# Base URL of the FCM HTTP v1 API (can point to a local stand-in, see tests/fake_fcm.py)
+FCM_URL = config("FCM_URL", cast=str, default="https://fcm.googleapis.com")
 GOOGLE_APPLICATION_CREDENTIALS = config(
     "GOOGLE_APPLICATION_CREDENTIALS", cast=str, default="test-key.json"
 )
+# Google access tokens are valid one hour: they are refreshed this number
+# of seconds before they expire
+GOOGLE_TOKEN_REFRESH_MARGIN = config(
+    "GOOGLE_TOKEN_REFRESH_MARGIN", cast=int, default=300
+)
 
 # Secret key to generate jwt and encode cookies. To change in production!
 SECRET_KEY = config(
@@ -82,8 +113,85 @@ ACCESS_TOKEN_EXPIRE_MINUTES = config(
     "ACCESS_TOKEN_EXPIRE_MINUTES", cast=int, default=43200
 )
 
+# Cache of the users authenticated with a bearer token (per process)
+# Maximum number of users kept in the cache (0 to disable it)
+USER_CACHE_SIZE = config("USER_CACHE_SIZE", cast=int, default=1000)
+# Time in seconds a user is kept in the cache (0 to disable it)
+# Changes made by another process are only seen after that delay
+USER_CACHE_TTL = config("USER_CACHE_TTL", cast=float, default=60)
+
+# Rate limiting of the notifications created (token buckets)
+# Sustained number of notifications per second and burst allowed
+# per service and per source IP (a rate of 0 disables the limit)
+NOTIFICATION_RATE_LIMIT_SERVICE = config(
+    "NOTIFICATION_RATE_LIMIT_SERVICE", cast=float, default=5
+)
+NOTIFICATION_RATE_LIMIT_SERVICE_BURST = config(
+    "NOTIFICATION_RATE_LIMIT_SERVICE_BURST", cast=int, default=60
+)
+NOTIFICATION_RATE_LIMIT_IP = config(
+    "NOTIFICATION_RATE_LIMIT_IP", cast=float, default=20
+)
+NOTIFICATION_RATE_LIMIT_IP_BURST = config(
+    "NOTIFICATION_RATE_LIMIT_IP_BURST", cast=int, default=200
+)
+# Where the buckets are kept: "memory" (per process) or "database"
+# (shared by all the gunicorn workers)
+RATE_LIMIT_BACKEND = config("RATE_LIMIT_BACKEND", cast=str, default="memory")
+# Maximum number of buckets kept in memory (least recently used are dropped)
+RATE_LIMIT_MEMORY_SIZE = config("RATE_LIMIT_MEMORY_SIZE", cast=int, default=10000)
+
+# Maximum number of notifications created by one batch request
+NOTIFICATIONS_BATCH_MAX_SIZE = config(
+    "NOTIFICATIONS_BATCH_MAX_SIZE", cast=int, default=1000
+)
+# Maximum size in bytes of the body of a batch request
+NOTIFICATIONS_BATCH_MAX_BYTES = config(
+    "NOTIFICATIONS_BATCH_MAX_BYTES", cast=int, default=1024 * 1024
+)
+
 # Number of push notifications sent in parallel
 NB_PARALLEL_PUSH = config("NB_PARALLEL_PUSH", cast=int, default=50)
+# Number of recipients read from the database at once when sending a notification
+PUSH_RECIPIENTS_PAGE_SIZE = config("PUSH_RECIPIENTS_PAGE_SIZE", cast=int, default=1000)
+
+# Retries of the pushes that failed with a transient error
+# (no response, 429 or 5xx from APNs or FCM)
+# Maximum number of retries per device token
+PUSH_RETRY_MAX_RETRIES = config("PUSH_RETRY_MAX_RETRIES", cast=int, default=3)
+# Base delay in seconds of the exponential backoff (with random jitter)
+PUSH_RETRY_BASE_DELAY = config("PUSH_RETRY_BASE_DELAY", cast=float, default=1)
+# Maximum delay in seconds before a retry
+# The push isn't retried if the server asks to wait longer (Retry-After)
+PUSH_RETRY_MAX_DELAY = config("PUSH_RETRY_MAX_DELAY", cast=float, default=30)
+
+# Long-lived HTTP clients used to send push notifications
+# Number of connections opened to each push service (APNs and FCM)
+PUSH_CONNECTIONS = config("PUSH_CONNECTIONS", cast=int, default=2)
+# Maximum number of concurrent requests (HTTP/2 streams) per connection
+PUSH_MAX_STREAMS = config("PUSH_MAX_STREAMS", cast=int, default=100)
+# Time in seconds an idle connection is kept open
+PUSH_KEEPALIVE_EXPIRY = config("PUSH_KEEPALIVE_EXPIRY", cast=float, default=300)
+# Time in seconds between two health checks of the clients
+PUSH_HEALTH_CHECK_INTERVAL = config(
+    "PUSH_HEALTH_CHECK_INTERVAL", cast=float, default=60
+)
+# Number of consecutive transport errors (connection failures, timeouts)
+# after which a client is replaced by the health check
+PUSH_MAX_TRANSPORT_ERRORS = config("PUSH_MAX_TRANSPORT_ERRORS", cast=int, default=3)
+
+# Push workers (notify-server push-worker)
+# Delay in seconds between two polls of the queue when it's empty
+PUSH_WORKER_POLL_INTERVAL = config("PUSH_WORKER_POLL_INTERVAL", cast=float, default=1)
+# Maximum number of jobs claimed (and processed in parallel) by a worker
+PUSH_WORKER_BATCH_SIZE = config("PUSH_WORKER_BATCH_SIZE", cast=int, default=10)
+# Time in seconds a claimed job is reserved for a worker
+# The lease is renewed while the job is processed
+PUSH_JOB_LEASE = config("PUSH_JOB_LEASE", cast=int, default=300)
+# Jobs failing more than this number of times are dropped
+PUSH_JOB_MAX_ATTEMPTS = config("PUSH_JOB_MAX_ATTEMPTS", cast=int, default=5)
+# Port used by each push worker to serve its metrics under /metrics (0 to disable)
+PUSH_WORKER_METRICS_PORT = config("PUSH_WORKER_METRICS_PORT", cast=int, default=0)
 
 # Sentry Data Source Name
 # Leave it empty to disable it
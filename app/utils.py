@@ -1,19 +1,30 @@
-import asyncio
 import base64
-import httpx
+import bisect
 import ipaddress
 import uuid
 import jwt
-from datetime import datetime, timezone
-from typing import List, Optional, Dict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from fastapi import Request
 from fastapi.logger import logger
+from sqlalchemy.orm import Session
 from .database import SessionLocal
-from . import crud, ios, firebase
+from . import (
+    clients,
+    crud,
+    crud_async,
+    fanout,
+    ios,
+    firebase,
+    metrics,
+    payloads,
+    schemas,
+)
 from .settings import (
     ALLOWED_NETWORKS,
     SECRET_KEY,
     JWT_ALGORITHM,
-    NB_PARALLEL_PUSH,
+    PUSH_RECIPIENTS_PAGE_SIZE,
 )
 
 
@@ -28,96 +39,208 @@ def decode_access_token(encoded_token: str) -> Dict:
     return jwt.decode(encoded_token, str(SECRET_KEY), algorithms=[JWT_ALGORITHM])
 
 
+class NetworkMatcher:
+    """Networks parsed once to check if IP addresses belong to them
+
+    The networks (IPv4 and IPv6) are merged into sorted, non-overlapping
+    ranges of addresses: checking an address is a binary search.
+    """
+
+    def __init__(self, networks: Iterable[str]):
+        parsed = [ipaddress.ip_network(network) for network in networks]
+        # Start and end (as integers) of the ranges per IP version
+        self._ranges: Dict[int, Tuple[List[int], List[int]]] = {}
+        for version in (4, 6):
+            starts: List[int] = []
+            ends: List[int] = []
+            for network in ipaddress.collapse_addresses(
+                network for network in parsed if network.version == version
+            ):
+                start = int(network.network_address)
+                end = int(network.broadcast_address)
+                if ends and start == ends[-1] + 1:
+                    # Adjacent networks that don't form a bigger one
+                    ends[-1] = end
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self._ranges[version] = (starts, ends)
+        self.nb_ranges = sum(len(starts) for starts, _ in self._ranges.values())
+
+    def __bool__(self) -> bool:
+        return self.nb_ranges > 0
+
+    def __contains__(self, ip: str) -> bool:
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            # Invalid IP
+            return False
+        starts, ends = self._ranges[addr.version]
+        value = int(addr)
+        index = bisect.bisect_right(starts, value) - 1
+        return index >= 0 and value <= ends[index]
+
+
+# Parsed at startup: an invalid network in the settings is reported right away
+allowed_networks_matcher = NetworkMatcher(ALLOWED_NETWORKS)
+
+
 def check_ips(
-    ips: Optional[List[str]] = None, allowed_networks: List[str] = ALLOWED_NETWORKS
+    ips: Optional[List[str]] = None,
+    allowed_networks: Union[NetworkMatcher, List[str]] = allowed_networks_matcher,
 ) -> bool:
     """Return True if all ip addresses are in the list of allowed networks
 
     Any IP is allowed if the list is empty
     """
+    if not isinstance(allowed_networks, NetworkMatcher):
+        allowed_networks = NetworkMatcher(allowed_networks)
     if not allowed_networks:
         return True
     if ips is None or not ips:
         # No IP to check
         return False
-    return all([is_ip_allowed(ip, allowed_networks) for ip in ips])
+    return all(ip in allowed_networks for ip in ips)
+
+
+def get_client_ip(request: Request, x_forwarded_for: Optional[List[str]]) -> str:
+    """Return the IP of the client, as seen by the proxy if any
+
+    Only the last address of X-Forwarded-For, added by the trusted proxy, is used:
+    the previous ones are set by the client and can be forged.
+    """
+    if x_forwarded_for:
+        return x_forwarded_for[-1].split(",")[-1].strip()
+    if request.client is None:
+        return ""
+    return request.client.host
 
 
-def is_ip_allowed(ip: str, allowed_networks: List[str]) -> bool:
+def is_ip_allowed(ip: str, allowed_networks: Union[NetworkMatcher, List[str]]) -> bool:
     """Return True if the ip is in the list of allowed networks
 
     Any IP is allowed if the list is empty
     """
+    if not isinstance(allowed_networks, NetworkMatcher):
+        allowed_networks = NetworkMatcher(allowed_networks)
     if not allowed_networks:
         return True
-    try:
-        addr = ipaddress.ip_address(ip)
-    except ValueError:
-        # Invalid IP
-        return False
-    for allowed_network in allowed_networks:
-        if addr in ipaddress.ip_network(allowed_network):
-            return True
-    return False
+    return ip in allowed_networks
 
 
-async def gather_with_concurrency(n: int, *tasks, return_exceptions=True):
-    """Gather all the tasks with a maximum of n in parallel"""
-    semaphore = asyncio.Semaphore(n)
+async def queue_pushes(
+    fan_out: fanout.FanOut,
+    notification_payloads: payloads.NotificationPayloads,
+    recipient: crud.Recipient,
+    android_headers: Dict[str, str],
+) -> None:
+    """Queue the pushes to all the devices of the recipient"""
+    if recipient.ios_tokens:
+        apn_payload = notification_payloads.apn(recipient.nb_unread_notifications)
+        for ios_token in recipient.ios_tokens:
+            await fan_out.put(
+                recipient.user_id,
+                ios_token,
+                schemas.Platform.ios,
+                clients.apple,
+                ios.send_push,
+                ios_token,
+                apn_payload,
+                recipient.username,
+            )
+    for android_token in recipient.android_tokens:
+        await fan_out.put(
+            recipient.user_id,
+            android_token,
+            schemas.Platform.android,
+            clients.firebase,
+            firebase.send_push,
+            android_token,
+            notification_payloads.android(android_token),
+            recipient.username,
+            headers=android_headers,
+        )
+
 
-    async def sem_task(task):
-        async with semaphore:
-            return await task
+async def save_deliveries(
+    db: Session, notification_id: int, deliveries: List[crud.Delivery]
+) -> None:
+    """Save the deliveries and update the device tokens accordingly
 
-    return await asyncio.gather(
-        *(sem_task(task) for task in tasks), return_exceptions=return_exceptions
+    Tokens rejected by APNs or FCM are deleted in bulk.
+    """
+    await crud_async.create_deliveries(db, notification_id, deliveries)
+    await crud_async.update_device_tokens_last_success(
+        db,
+        [delivery.token for delivery in deliveries if delivery.result.success],
     )
+    unregistered = [
+        delivery
+        for delivery in deliveries
+        if delivery.result.status == schemas.DeliveryStatus.unregistered
+    ]
+    if unregistered:
+        logger.info(f"Delete {len(unregistered)} device token(s) no longer active")
+        await crud_async.remove_device_tokens(
+            db, [delivery.token for delivery in unregistered]
+        )
+        for delivery in unregistered:
+            metrics.device_tokens_pruned.labels(platform=delivery.platform.value).inc()
 
 
-async def send_notification(notification_id: int) -> None:
-    """Send the notification to all subscribers"""
-    tasks = []
-    ios_headers = ios.create_headers(datetime.now(timezone.utc))
-    ios_client = httpx.AsyncClient(http2=True, headers=ios_headers)
+async def send_notification(
+    notification_id: int,
+    page_size: int = PUSH_RECIPIENTS_PAGE_SIZE,
+    nb_notifications: int = 1,
+) -> None:
+    """Send the notification to all subscribers
+
+    With nb_notifications > 1, the last notifications of the service were
+    coalesced: one summary is pushed instead (see crud.create_service_notification).
+    Recipients are read by pages of page_size users and their devices are fed
+    to a fixed number of workers (see app.fanout): the memory used doesn't
+    depend on the number of recipients.
+    The outcome for each device is saved as a delivery.
+    The session is only used by this coroutine, never by the concurrent pushes.
+    """
     android_headers = await firebase.create_headers(str(uuid.uuid4()))
-    android_client = httpx.AsyncClient(headers=android_headers)
     try:
         db = SessionLocal()
-        notification = crud.get_notification(db, notification_id)
+        notification = await crud_async.get_notification(db, notification_id)
         if notification is None:
             logger.warning(
                 f"Can't send notification! Notification {notification_id} not found."
             )
             return
-        for user_notification in notification.users_notification:
-            user = user_notification.user
-            if not user.is_logged_in or not user.is_active:
-                continue
-            ios_tokens = user.ios_tokens
-            if ios_tokens:
-                apn_payload = user_notification.to_apn_payload()
-                for ios_token in ios_tokens:
-                    tasks.append(
-                        ios.send_push(
-                            ios_client,
-                            ios_token,
-                            apn_payload,
-                            db,
-                            user,
-                        )
-                    )
-            for android_token in user.android_tokens:
-                tasks.append(
-                    firebase.send_push(
-                        android_client,
-                        user_notification.to_android_payload(android_token),
-                        db,
-                        user,
+        if nb_notifications > 1:
+            # Loading the service queries the database
+            notification = await crud_async.run(
+                notification.to_summary, nb_notifications
+            )
+        # Bodies rendered once for all recipients
+        notification_payloads = payloads.NotificationPayloads(notification)
+        with metrics.fanout_duration.time():
+            async with fanout.FanOut() as fan_out:
+                after_user_id = 0
+                while True:
+                    # Users, device tokens and badges are retrieved in two queries
+                    recipients = await crud_async.get_notification_recipients(
+                        db, notification_id, after_user_id, page_size
                     )
-                )
-        await gather_with_concurrency(NB_PARALLEL_PUSH, *tasks, return_exceptions=True)
-        await ios_client.aclose()
-        await android_client.aclose()
+                    for recipient in recipients:
+                        await queue_pushes(
+                            fan_out, notification_payloads, recipient, android_headers
+                        )
+                    if len(recipients) < page_size:
+                        break
+                    after_user_id = recipients[-1].user_id
+                    if len(fan_out.deliveries) >= page_size:
+                        await save_deliveries(
+                            db, notification_id, fan_out.pop_deliveries()
+                        )
+                await fan_out.join()
+        await save_deliveries(db, notification_id, fan_out.pop_deliveries())
     finally:
         db.close()
 
@@ -5,7 +5,7 @@ from starlette.requests import Request
 from sqlalchemy.orm import Session
 from authlib.integrations.base_client.errors import OAuthError
 from . import templates
-from .. import deps, crud, auth, models
+from .. import auth, crud_async, deps, models
 from ..settings import APP_NAME, OIDC_ENABLED
 
 router = APIRouter()
@@ -63,9 +63,9 @@ async def login_post(
         result["error"] = "Invalid Username/Password"
         return templates.TemplateResponse("login.html", result)
     logger.info(f"User {username} successfully logged in")
-    db_user = crud.get_user_by_username(db, username.lower())
+    db_user = await crud_async.get_user_by_username(db, username.lower())
     if db_user is None:
-        db_user = crud.create_user(db, username.lower())
+        db_user = await crud_async.create_user(db, username.lower())
 
     resp = RedirectResponse("/", status_code=status.HTTP_302_FOUND)
     request.session["user_id"] = db_user.id
@@ -85,9 +85,9 @@ async def oidc_auth(
     user_info = token["userinfo"]
     if user_info:
         username = user_info["preferred_username"].lower()
-        db_user = crud.get_user_by_username(db, username)
+        db_user = await crud_async.get_user_by_username(db, username)
         if db_user is None:
-            db_user = crud.create_user(db, username)
+            db_user = await crud_async.create_user(db, username)
         request.session["user_id"] = db_user.id
         return RedirectResponse(url=request.session.pop("next", "/"))
     return RedirectResponse(url="/login")
@@ -3,7 +3,7 @@ from starlette.responses import HTMLResponse
 from starlette.requests import Request
 from sqlalchemy.orm import Session
 from . import templates
-from .. import deps, models, crud, schemas
+from .. import crud_async, deps, models, schemas
 
 router = APIRouter()
 
@@ -19,14 +19,14 @@ async def notifications_get(
     except KeyError:
         notifications_limit = 50
         request.session["notifications_limit"] = notifications_limit
-    services = crud.get_user_services(db, current_user)
+    services = await crud_async.get_user_services(db, current_user)
     categories = {service.id: service.category for service in services}
     selected_services = [
         schemas.UserServiceForm.from_user_service(service)
         for service in services
         if service.is_subscribed
     ]
-    notifications = crud.get_user_notifications(
+    notifications = await crud_async.get_user_notifications(
         db, current_user, limit=notifications_limit
     )
     request.session["selected_categories"] = [
@@ -56,7 +56,7 @@ async def notifications_post(
     selected_categories = [key for key in form if key != "notifications_limit"]
     request.session["selected_categories"] = selected_categories
     request.session["notifications_limit"] = notifications_limit
-    user_services = crud.get_user_services(db, current_user)
+    user_services = await crud_async.get_user_services(db, current_user)
     selected_services = [
         schemas.UserServiceForm.from_user_service(service)
         for service in user_services
@@ -73,7 +73,7 @@ async def notifications_post(
         for service in user_services
         if service.category in selected_categories
     ]
-    notifications = crud.get_user_notifications(
+    notifications = await crud_async.get_user_notifications(
         db,
         current_user,
         limit=notifications_limit,
@@ -97,7 +97,7 @@ async def notifications_update(
     db: Session = Depends(deps.get_db),
     current_user: models.User = Depends(deps.get_current_user_from_session),
 ):
-    user_services = crud.get_user_services(db, current_user)
+    user_services = await crud_async.get_user_services(db, current_user)
     categories = {service.id: service.category for service in user_services}
     selected_categories = request.session.get("selected_categories", [])
     selected_services_id = [
@@ -105,7 +105,7 @@ async def notifications_update(
         for service in user_services
         if service.category in selected_categories
     ]
-    notifications = crud.get_user_notifications(
+    notifications = await crud_async.get_user_notifications(
         db,
         current_user,
         limit=request.session["notifications_limit"],
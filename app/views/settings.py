@@ -3,7 +3,7 @@ from starlette.responses import HTMLResponse
 from starlette.requests import Request
 from sqlalchemy.orm import Session
 from . import templates
-from .. import crud, deps, models, schemas
+from .. import crud_async, deps, models, schemas
 
 router = APIRouter()
 
@@ -14,7 +14,7 @@ async def settings_get(
     db: Session = Depends(deps.get_db),
     current_user: models.User = Depends(deps.get_current_user_from_session),
 ):
-    services = crud.get_user_services(db, current_user)
+    services = await crud_async.get_user_services(db, current_user)
     return templates.TemplateResponse(
         "settings.html",
         {"request": request, "current_user": current_user, "services": services},
@@ -29,7 +29,7 @@ async def settings_post(
 ):
     form = await request.form()
     selected_categories = list(form.keys())
-    services = crud.get_user_services(db, current_user)
+    services = await crud_async.get_user_services(db, current_user)
     updated_services = []
     for service in services:
         if service.category in selected_categories:
@@ -41,7 +41,7 @@ async def settings_post(
                 id=service.id, is_subscribed=service.is_subscribed
             )
         )
-    crud.update_user_services(db, updated_services, current_user)
+    await crud_async.update_user_services(db, updated_services, current_user)
     return templates.TemplateResponse(
         "settings.html",
         {"request": request, "current_user": current_user, "services": services},
@@ -0,0 +1,145 @@
+"""Push workers
+
+Notifications aren't sent by the process handling the API request.
+A job is stored in the push_jobs table with each new notification
+and processed by dedicated workers (notify-server push-worker).
+Several workers can run in parallel: jobs locked by a worker are skipped
+by the others.
+"""
+
+import asyncio
+import contextlib
+import signal
+from typing import Any, Callable, Collection, Dict, Optional
+from fastapi.logger import logger
+from starlette.concurrency import run_in_threadpool
+from . import clients, crud, firebase, ios, models, monitoring, utils
+from .database import SessionLocal
+from .settings import (
+    PUSH_WORKER_POLL_INTERVAL,
+    PUSH_WORKER_BATCH_SIZE,
+    PUSH_JOB_LEASE,
+    PUSH_JOB_MAX_ATTEMPTS,
+    PUSH_WORKER_METRICS_PORT,
+)
+
+
+def _with_session(func: Callable, *args) -> Any:
+    db = SessionLocal()
+    try:
+        return func(db, *args)
+    finally:
+        db.close()
+
+
+async def run_db(func: Callable, *args) -> Any:
+    """Run the crud function func with a new session in the threadpool"""
+    return await run_in_threadpool(_with_session, func, *args)
+
+
+async def renew_lease(job_ids: Collection[int]) -> None:
+    """Renew the lease of the jobs being processed until cancelled
+
+    job_ids is a live view updated as jobs are claimed and completed.
+    """
+    while True:
+        await asyncio.sleep(PUSH_JOB_LEASE / 2)
+        if job_ids:
+            await run_db(crud.extend_push_jobs_lease, list(job_ids), PUSH_JOB_LEASE)
+
+
+async def process_job(job: models.PushJob) -> None:
+    """Send the notification and remove the job from the queue"""
+    if job.attempts > PUSH_JOB_MAX_ATTEMPTS:
+        logger.error(
+            f"Dropping push job {job.id} (notification {job.notification_id}) "
+            f"after {job.attempts - 1} attempts"
+        )
+        await run_db(crud.delete_push_job, job.id)
+        return
+    try:
+        await utils.send_notification(
+            job.notification_id, nb_notifications=job.nb_notifications
+        )
+    except Exception:
+        delay = 2**job.attempts
+        logger.exception(
+            f"Failed to process push job {job.id} (notification {job.notification_id}). "
+            f"Retrying in {delay} seconds."
+        )
+        await run_db(crud.release_push_job, job.id, delay)
+        return
+    await run_db(crud.delete_push_job, job.id)
+
+
+async def run(
+    shard: int = 0, nb_shards: int = 1, stop: Optional[asyncio.Event] = None
+) -> None:
+    """Process the push jobs until stop is set
+
+    Up to PUSH_WORKER_BATCH_SIZE jobs are processed in parallel. New jobs are
+    claimed as soon as some complete: a long job (e.g. a broadcast to all users)
+    doesn't hold the other slots.
+    """
+    if stop is None:
+        stop = asyncio.Event()
+    if nb_shards > 1:
+        logger.info(f"Push worker started (preferred shard {shard + 1}/{nb_shards})")
+    else:
+        logger.info("Push worker started")
+    running: Dict[int, asyncio.Task] = {}
+    renewer = asyncio.create_task(renew_lease(running.keys()))
+    try:
+        while not stop.is_set():
+            if len(running) >= PUSH_WORKER_BATCH_SIZE:
+                await asyncio.wait(
+                    running.values(), return_when=asyncio.FIRST_COMPLETED
+                )
+                continue
+            jobs = await run_db(
+                crud.claim_push_jobs,
+                PUSH_WORKER_BATCH_SIZE - len(running),
+                PUSH_JOB_LEASE,
+                shard,
+                nb_shards,
+            )
+            for job in jobs:
+                task = asyncio.create_task(process_job(job))
+                running[job.id] = task
+                task.add_done_callback(lambda _, job_id=job.id: running.pop(job_id))
+            if not jobs:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(stop.wait(), PUSH_WORKER_POLL_INTERVAL)
+        # Jobs already claimed are always completed before stopping
+        if running:
+            await asyncio.wait(running.values())
+    finally:
+        renewer.cancel()
+    logger.info("Push worker stopped")
+
+
+def main(shard: int = 0, nb_shards: int = 1) -> None:
+    """Run a push worker until SIGINT or SIGTERM is received"""
+
+    async def _main():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        metrics_server = None
+        if PUSH_WORKER_METRICS_PORT:
+            metrics_server = monitoring.start_metrics_server(PUSH_WORKER_METRICS_PORT)
+        await clients.start()
+        await ios.provider_token.start()
+        await firebase.access_token.start()
+        try:
+            await run(shard, nb_shards, stop)
+        finally:
+            await firebase.access_token.stop()
+            await ios.provider_token.stop()
+            await clients.stop()
+            if metrics_server is not None:
+                metrics_server.shutdown()
+                metrics_server.server_close()
+
+    asyncio.run(_main())
@@ -0,0 +1,84 @@
+"""Benchmark the sending of push notifications to FCM
+
+Send pushes to a local stand-in FCM server (tests/fake_fcm.py) through the
+fan-out, with an HTTP/1.1 client pool (previous FCM client) and an HTTP/2
+one (requests multiplexed on each connection).
+The server runs in the same process: timings include its CPU time.
+
+    python -m benchmarks.fcm
+    python -m benchmarks.fcm --devices 1000 10000 --latency 0.02 --workers 200
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from app import clients, fanout, firebase, schemas
+from app.settings import NB_PARALLEL_PUSH
+from tests import fake_fcm
+
+
+async def run(
+    http2: bool, nb_devices: int, nb_workers: int, latency: float, repeat: int
+) -> tuple:
+    server = fake_fcm.FakeFCM(latency=latency)
+    await server.start()
+    firebase.FCM_URL = server.url
+    pool = clients.ClientPool("FCM", size=2, http2=http2, http1=not http2)
+    headers = {"Authorization": "Bearer token"}
+    bodies = [
+        (f"token{nb}", json.dumps({"message": {"token": f"token{nb}"}}).encode())
+        for nb in range(nb_devices)
+    ]
+    timings = []
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            async with fanout.FanOut(nb_workers=nb_workers) as fan_out:
+                for nb, (token, body) in enumerate(bodies):
+                    await fan_out.put(
+                        nb,
+                        token,
+                        schemas.Platform.android,
+                        pool,
+                        firebase.send_push,
+                        token,
+                        body,
+                        "bench",
+                        headers=headers,
+                    )
+                await fan_out.join()
+            timings.append(time.perf_counter() - start)
+            assert all(d.result.success for d in fan_out.pop_deliveries())
+    finally:
+        await pool.stop()
+        await server.stop()
+    return timings, server.nb_connections
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, nargs="+", default=[500, 2000])
+    parser.add_argument("--workers", type=int, default=NB_PARALLEL_PUSH)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    print(
+        f"{'devices':>10} {'protocol':>9} {'median (ms)':>12} {'min (ms)':>10} "
+        f"{'connections':>12}"
+    )
+    for nb_devices in args.devices:
+        for name, http2 in (("HTTP/1.1", False), ("HTTP/2", True)):
+            timings, nb_connections = asyncio.run(
+                run(http2, nb_devices, args.workers, args.latency, args.repeat)
+            )
+            print(
+                f"{nb_devices:>10} {name:>9} "
+                f"{statistics.median(timings) * 1000:>12.1f} "
+                f"{min(timings) * 1000:>10.1f} {nb_connections:>12}"
+            )
+
+
+if __name__ == "__main__":
+    main()
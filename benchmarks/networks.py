@@ -0,0 +1,103 @@
+"""Benchmark the check of the IP addresses allowed to create notifications
+
+Compare utils.NetworkMatcher (networks parsed once, binary search) to the
+previous implementation parsing every network for each IP checked.
+Half of the networks are IPv4, half IPv6. Half of the addresses checked are
+allowed (IPv4 and IPv6), the others are not part of any network.
+
+    python -m benchmarks.networks
+    python -m benchmarks.networks --networks 10 1000 --ips 1000
+"""
+
+import argparse
+import ipaddress
+import random
+import statistics
+import time
+from app import utils
+
+
+def legacy_is_ip_allowed(ip, allowed_networks):
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    for allowed_network in allowed_networks:
+        if addr in ipaddress.ip_network(allowed_network):
+            return True
+    return False
+
+
+def legacy(networks, ips):
+    return [legacy_is_ip_allowed(ip, networks) for ip in ips]
+
+
+def matcher(network_matcher, ips):
+    return [ip in network_matcher for ip in ips]
+
+
+def make_networks(nb_networks: int, rng: random.Random) -> list:
+    networks = []
+    for nb in range(nb_networks):
+        if nb % 2:
+            networks.append(f"2001:db8:{nb:x}::/48")
+        else:
+            networks.append(f"10.{nb // 256 % 256}.{nb % 256}.0/24")
+    rng.shuffle(networks)
+    return networks
+
+
+def make_ips(nb_ips: int, networks: list, rng: random.Random) -> list:
+    ips = []
+    for nb in range(nb_ips):
+        if nb % 2:
+            network = ipaddress.ip_network(rng.choice(networks))
+            ips.append(str(network.network_address + rng.randrange(256)))
+        elif nb % 4:
+            ips.append(f"192.168.{rng.randrange(256)}.{rng.randrange(256)}")
+        else:
+            ips.append(f"2001:db9::{rng.randrange(65536):x}")
+    return ips
+
+
+def run(check, allowed_networks, ips, repeat: int) -> list:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        check(allowed_networks, ips)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--networks", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--ips", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    rng = random.Random(42)
+    print(
+        f"{'networks':>10} {'implementation':>15} {'median (ms)':>12} "
+        f"{'min (ms)':>10} {'us per ip':>10}"
+    )
+    for nb_networks in args.networks:
+        networks = make_networks(nb_networks, rng)
+        ips = make_ips(args.ips, networks, rng)
+        # Parsed once at startup: not part of the timings
+        network_matcher = utils.NetworkMatcher(networks)
+        assert legacy(networks, ips) == matcher(network_matcher, ips)
+        for name, check, allowed_networks in (
+            ("legacy", legacy, networks),
+            ("matcher", matcher, network_matcher),
+        ):
+            timings = run(check, allowed_networks, ips, args.repeat)
+            print(
+                f"{nb_networks:>10} {name:>15} "
+                f"{statistics.median(timings) * 1000:>12.1f} "
+                f"{min(timings) * 1000:>10.1f} "
+                f"{statistics.median(timings) / len(ips) * 1e6:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
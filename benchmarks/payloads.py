@@ -0,0 +1,75 @@
+"""Benchmark the rendering of the push payloads of a notification
+
+Compare payloads.NotificationPayloads (body rendered once per notification)
+to the previous implementation building and serializing the Pydantic models
+for each device (as done by httpx with json=payload.model_dump()).
+
+    python -m benchmarks.payloads
+    python -m benchmarks.payloads --devices 1000 50000
+"""
+
+import argparse
+import json
+import secrets
+import statistics
+import time
+from app import models, payloads
+
+
+def legacy_render(notification, devices):
+    bodies = []
+    for badge, ios_token, android_token in devices:
+        bodies.append(json.dumps(notification.to_apn_payload(badge).model_dump()))
+        bodies.append(
+            json.dumps(notification.to_android_payload(android_token).model_dump())
+        )
+    return bodies
+
+
+def prerendered(notification, devices):
+    notification_payloads = payloads.NotificationPayloads(notification)
+    bodies = []
+    for badge, ios_token, android_token in devices:
+        bodies.append(notification_payloads.apn(badge))
+        bodies.append(notification_payloads.android(android_token))
+    return bodies
+
+
+def run(render, notification, devices, repeat: int) -> list:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        render(notification, devices)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, nargs="+", default=[100, 10000, 50000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    notification = models.Notification(
+        title="Beam permit lost",
+        subtitle="The beam permit was lost at 10:42. " * 10,
+        url="https://example.org/alarms/42",
+    )
+    print(
+        f"{'devices':>12} {'implementation':>15} {'median (ms)':>12} {'min (ms)':>10}"
+    )
+    for nb_devices in args.devices:
+        # One iOS and one Android token per recipient, badges between 0 and 9
+        devices = [
+            (nb % 10, secrets.token_hex(32), secrets.token_hex(76))
+            for nb in range(nb_devices // 2)
+        ]
+        for name, render in (("legacy", legacy_render), ("prerendered", prerendered)):
+            timings = run(render, notification, devices, args.repeat)
+            print(
+                f"{nb_devices:>12} {name:>15} "
+                f"{statistics.median(timings) * 1000:>12.1f} {min(timings) * 1000:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
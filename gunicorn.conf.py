@@ -0,0 +1,23 @@
+"""Gunicorn hooks for the Prometheus multiprocess mode
+
+Loaded by gunicorn from the current directory.
+See https://prometheus.github.io/client_python/multiprocess/
+"""
+
+import glob
+import os
+from prometheus_client import multiprocess
+
+
+def on_starting(server):
+    """Create the metrics directory or remove the metrics of a previous run"""
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, "*.db")):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
@@ -2,7 +2,8 @@ import json
 import uuid
 import pytest
 from fastapi.testclient import TestClient
-from app import models, schemas
+from prometheus_client import REGISTRY
+from app import crud, models, schemas
 from ..utils import no_tz_isoformat
 
 
@@ -109,7 +110,13 @@ def test_update_service_invalid_color(
 
 
 @pytest.mark.parametrize(
-    "data", [{"category": "New service"}, {"color": "00FF00"}, {"owner": "Jane"}]
+    "data",
+    [
+        {"category": "New service"},
+        {"color": "00FF00"},
+        {"owner": "Jane"},
+        {"coalescing_window": 30},
+    ],
 )
 def test_update_service(
     data, client: TestClient, service_factory, admin_token_headers, api_version
@@ -126,7 +133,7 @@ def test_update_service(
         json=data,
     )
     assert response.status_code == 200
-    new_data = {**original_data, **data}
+    new_data = {**original_data, "coalescing_window": 0, **data}
     new_data["id"] = str(service.id)
     assert response.json() == new_data
 
@@ -246,7 +253,7 @@ def test_create_notification_for_service(
     api_version,
 ):
     mocker.patch("app.api.services.utils.check_ips", return_value=True)
-    mock_send_notification = mocker.patch("app.api.services.utils.send_notification")
+    mock_send_notification = mocker.patch("app.utils.send_notification")
     response = client.post(
         f"/api/{api_version}/services/{service.id}/notifications",
         headers=user_token_headers,
@@ -254,7 +261,10 @@ def test_create_notification_for_service(
     )
     assert response.status_code == 201
     db_notification = db.query(models.Notification).first()
-    mock_send_notification.assert_called_once_with(db_notification.id)
+    # The notification isn't sent by the API but queued for the push workers
+    assert not mock_send_notification.called
+    push_job = db.query(models.PushJob).one()
+    assert push_job.notification_id == db_notification.id
     assert response.json() == {
         "id": db_notification.id,
         "service_id": str(service.id),
@@ -263,3 +273,302 @@ def test_create_notification_for_service(
         "title": sample_notification["title"],
         "url": sample_notification["url"],
     }
+
+
+def test_create_notifications_for_service(
+    client: TestClient,
+    db,
+    user,
+    service,
+    user_token_headers,
+    sample_notification,
+    mocker,
+    api_version,
+):
+    mocker.patch("app.api.services.utils.check_ips", return_value=True)
+    user.subscribe(service)
+    db.commit()
+    data = [{**sample_notification, "title": f"Alert {nb}"} for nb in range(3)]
+    response = client.post(
+        f"/api/{api_version}/services/{service.id}/notifications:batch",
+        headers=user_token_headers,
+        json=data,
+    )
+    assert response.status_code == 201
+    db_notifications = db.query(models.Notification).order_by(models.Notification.id)
+    assert response.json() == [
+        {
+            "id": db_notification.id,
+            "service_id": str(service.id),
+            "subtitle": sample_notification["subtitle"],
+            "timestamp": no_tz_isoformat(db_notification.timestamp),
+            "title": f"Alert {nb}",
+            "url": sample_notification["url"],
+        }
+        for nb, db_notification in enumerate(db_notifications)
+    ]
+    db.refresh(user)
+    assert user.unread_count == 3
+    push_job = db.query(models.PushJob).one()
+    assert push_job.nb_notifications == 3
+
+
+def test_create_notifications_for_service_ndjson(
+    client: TestClient, db, service, user_token_headers, mocker, api_version
+):
+    mocker.patch("app.api.services.utils.check_ips", return_value=True)
+    body = '{"title": "Alert 1"}\n\n{"title": "Alert 2", "subtitle": "error"}\n'
+    response = client.post(
+        f"/api/{api_version}/services/{service.id}/notifications:batch",
+        headers={**user_token_headers, "Content-Type": "application/x-ndjson"},
+        content=body,
+    )
+    assert response.status_code == 201
+    assert [notification["title"] for notification in response.json()] == [
+        "Alert 1",
+        "Alert 2",
+    ]
+    assert db.query(models.Notification).count() == 2
+
+
+@pytest.mark.parametrize(
+    "data,loc",
+    [
+        ([{"title": "Alert 1"}, {"subtitle": "no title"}], ["body", 1, "title"]),
+        ([], ["body"]),
+        ({"title": "Alert"}, ["body"]),
+    ],
+)
+def test_create_notifications_for_service_invalid(
+    client: TestClient, db, service, user_token_headers, mocker, api_version, data, loc
+):
+    mocker.patch("app.api.services.utils.check_ips", return_value=True)
+    response = client.post(
+        f"/api/{api_version}/services/{service.id}/notifications:batch",
+        headers=user_token_headers,
+        json=data,
+    )
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["loc"] == loc
+    assert db.query(models.Notification).count() == 0
+
+
+def test_create_notifications_for_service_too_many(
+    client: TestClient, db, service, user_token_headers, mocker, api_version
+):
+    mocker.patch("app.api.services.utils.check_ips", return_value=True)
+    response = client.post(
+        f"/api/{api_version}/services/{service.id}/notifications:batch",
+        headers=user_token_headers,
+        json=[{"title": "Alert"}] * 1001,
+    )
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["type"] == "too_long"
+
+
+def test_create_notifications_for_service_too_many_ndjson(
+    client: TestClient, db, service, user_token_headers, mocker, api_version
+):
+    mocker.patch("app.api.services.utils.check_ips", return_value=True)
+    mocker.patch("app.api.services.NOTIFICATIONS_BATCH_MAX_SIZE", 2)
+    response = client.post(
+        f"/api/{api_version}/services/{service.id}/notifications:batch",
+        headers={**user_token_headers, "Content-Type": "application/x-ndjson"},
+        content='{"title": "Alert"}\n' * 3,
+    )
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["type"] == "too_long"
+    assert db.query(models.Notification).count() == 0
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_create_notifications_for_service_too_large(
+    client: TestClient, db, service, user_token_headers, mocker, api_version, chunked
+):
+    mocker.patch("app.api.services.utils.check_ips", return_value=True)
+    mocker.patch("app.api.services.NOTIFICATIONS_BATCH_MAX_BYTES", 100)
+    body = json.dumps([{"title": f"Alert {nb}"} for nb in range(10)]).encode()
+    # A generator is sent without Content-Length
+    chunks = (body[i : i + 50] for i in range(0, len(body), 50))
+    content = chunks if chunked else body
+    response = client.post(
+        f"/api/{api_version}/services/{service.id}/notifications:batch",
+        headers={**user_token_headers, "Content-Type": "application/json"},
+        content=content,
+    )
+    assert response.status_code == 413
+    assert db.query(models.Notification).count() == 0
+
+
+def test_create_notifications_for_service_rate_limited(
+    client: TestClient, db, service, user_token_headers, mocker, api_version
+):
+    mocker.patch("app.api.services.utils.check_ips", return_value=True)
+    mocker.patch.multiple("app.ratelimit.per_service", rate=1, burst=5)
+
+    def create_notifications(nb):
+        return client.post(
+            f"/api/{api_version}/services/{service.id}/notifications:batch",
+            headers=user_token_headers,
+            json=[{"title": "Alert"}] * nb,
+        )
+
+    assert create_notifications(3).status_code == 201
+    # Each notification takes a token
+    response = create_notifications(3)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+    assert create_notifications(2).status_code == 201
+    assert db.query(models.Notification).count() == 5
+
+
+@pytest.mark.parametrize("scope", ["service", "ip"])
+def test_create_notification_for_service_rate_limited(
+    client: TestClient,
+    db,
+    service_factory,
+    user_token_headers,
+    sample_notification,
+    mocker,
+    api_version,
+    scope,
+):
+    mocker.patch("app.api.services.utils.check_ips", return_value=True)
+    mocker.patch.multiple(f"app.ratelimit.per_{scope}", rate=0.1, burst=2)
+    nb_rate_limited = (
+        REGISTRY.get_sample_value(
+            "notify_notifications_rate_limited_total", {"scope": scope}
+        )
+        or 0
+    )
+    service1 = service_factory()
+    service2 = service_factory()
+    headers = {**user_token_headers, "X-Forwarded-For": "192.0.2.1, 10.0.0.1"}
+
+    def create_notification(service, headers=headers):
+        return client.post(
+            f"/api/{api_version}/services/{service.id}/notifications",
+            headers=headers,
+            json=sample_notification,
+        )
+
+    assert create_notification(service1).status_code == 201
+    assert create_notification(service1).status_code == 201
+    response = create_notification(service1)
+    assert response.status_code == 429
+    assert response.json() == {"detail": "Too many notifications"}
+    assert response.headers["Retry-After"] == "10"
+    # Rejected before creating the notification
+    assert db.query(models.Notification).count() == 2
+    assert (
+        REGISTRY.get_sample_value(
+            "notify_notifications_rate_limited_total", {"scope": scope}
+        )
+        == nb_rate_limited + 1
+    )
+    if scope == "service":
+        # Other services aren't limited
+        assert create_notification(service2).status_code == 201
+    else:
+        # Requests from other clients aren't limited (the first addresses
+        # of X-Forwarded-For are set by the client and ignored)
+        other_client = {**user_token_headers, "X-Forwarded-For": "192.0.2.1, 10.0.0.2"}
+        assert create_notification(service1, other_client).status_code == 201
+
+
+def test_read_notification_deliveries(
+    client: TestClient,
+    db,
+    admin_token_headers,
+    user_token_headers,
+    user,
+    service,
+    notification_factory,
+    api_version,
+):
+    notification = notification_factory(service=service)
+    crud.create_deliveries(
+        db,
+        notification.id,
+        [
+            crud.Delivery(
+                user.id,
+                "android-token",
+                schemas.Platform.android,
+                crud.PushResult(
+                    schemas.DeliveryStatus.failure,
+                    status_code=500,
+                    reason="INTERNAL",
+                    latency=0.25,
+                ),
+            )
+        ],
+    )
+    url = f"/api/{api_version}/services/{service.id}/notifications/{notification.id}/deliveries"
+    response = client.get(url, headers=admin_token_headers)
+    assert response.status_code == 200
+    deliveries = response.json()
+    assert len(deliveries) == 1
+    assert deliveries[0]["created_at"]
+    del deliveries[0]["created_at"]
+    delivery_id = deliveries[0].pop("id")
+    assert deliveries == [
+        {
+            "username": user.username,
+            "token": "android-token",
+            "platform": "android",
+            "status": "failure",
+            "status_code": 500,
+            "reason": "INTERNAL",
+            "latency": 0.25,
+            "attempts": 1,
+        }
+    ]
+    # Paginated and filtered by status
+    for params, expected in (
+        ({"status": "failure"}, [delivery_id]),
+        ({"status": "success"}, []),
+        ({"after": delivery_id}, []),
+        ({"limit": 1}, [delivery_id]),
+    ):
+        response = client.get(url, headers=admin_token_headers, params=params)
+        assert response.status_code == 200
+        assert [delivery["id"] for delivery in response.json()] == expected
+    for params in ({"limit": 0}, {"limit": 1001}, {"status": "unknown"}):
+        response = client.get(url, headers=admin_token_headers, params=params)
+        assert response.status_code == 422
+    response = client.get(f"{url}/summary", headers=admin_token_headers)
+    assert response.status_code == 200
+    assert response.json() == {
+        "notification_id": notification.id,
+        "total": 1,
+        "success": 0,
+        "failure": 1,
+        "unregistered": 0,
+        "nb_users": 1,
+        "nb_users_reached": 0,
+        "latency_max": 0.25,
+        "reasons": {"INTERNAL": 1},
+    }
+    # Admin only
+    response = client.get(url, headers=user_token_headers)
+    assert response.status_code == 403
+
+
+def test_read_notification_deliveries_unknown_notification(
+    client: TestClient,
+    admin_token_headers,
+    service_factory,
+    notification_factory,
+    api_version,
+):
+    service = service_factory()
+    # Notification of another service
+    notification = notification_factory()
+    for notification_id in (notification.id, notification.id + 1):
+        response = client.get(
+            f"/api/{api_version}/services/{service.id}/notifications/{notification_id}/deliveries/summary",
+            headers=admin_token_headers,
+        )
+        assert response.status_code == 404
+        assert response.json() == {"detail": "Notification not found"}
@@ -1,7 +1,7 @@
 import pytest
 from datetime import datetime, timedelta, timezone
 from fastapi.testclient import TestClient
-from app import schemas, models, utils
+from app import crud, schemas, models, utils
 from ..utils import no_tz_isoformat
 
 
@@ -189,6 +189,7 @@ def test_read_current_user_services(
                 "category": service1.category,
                 "color": service1.color,
                 "owner": service1.owner,
+                "coalescing_window": 0,
                 "is_subscribed": True,
             },
             {
@@ -196,6 +197,7 @@ def test_read_current_user_services(
                 "category": service2.category,
                 "color": service2.color,
                 "owner": service2.owner,
+                "coalescing_window": 0,
                 "is_subscribed": False,
             },
         ],
@@ -277,6 +279,92 @@ def test_read_current_user_notifications(
     assert response.json() == expected_response
 
 
+def test_read_current_user_notifications_cursor(
+    client: TestClient, db, user, notification_factory, api_version
+):
+    notifications = [notification_factory() for _ in range(5)]
+    for notification in notifications:
+        user.notifications.append(notification)
+    db.commit()
+    ids = [notification.id for notification in notifications]
+    response = client.get(
+        f"/api/{api_version}/users/user/notifications",
+        params={"limit": 2, "sort": "desc", "before": ids[3]},
+        headers=user_authorization_headers(user.username),
+    )
+    assert response.status_code == 200
+    assert [n["id"] for n in response.json()] == [ids[2], ids[1]]
+    response = client.get(
+        f"/api/{api_version}/users/user/notifications",
+        params={"after": ids[2]},
+        headers=user_authorization_headers(user.username),
+    )
+    assert response.status_code == 200
+    assert [n["id"] for n in response.json()] == [ids[3], ids[4]]
+
+
+def test_sync_current_user_notifications(
+    client: TestClient, db, user, service, api_version
+):
+    user.subscribe(service)
+    db.commit()
+    notification1 = crud.create_service_notification(
+        db, schemas.NotificationCreate(title="message1"), service
+    )
+    response = client.get(
+        f"/api/{api_version}/users/user/notifications/sync",
+        headers=user_authorization_headers(user.username),
+    )
+    assert response.status_code == 200
+    result = response.json()
+    assert [n["id"] for n in result["notifications"]] == [notification1.id]
+    assert result["deleted"] == []
+    sync_token = result["sync_token"]
+    notification2 = crud.create_service_notification(
+        db, schemas.NotificationCreate(title="message2"), service
+    )
+    crud.update_user_notifications(
+        db,
+        [schemas.UserUpdateNotification(id=notification1.id, status="deleted")],
+        user,
+    )
+    response = client.get(
+        f"/api/{api_version}/users/user/notifications/sync",
+        params={"sync_token": sync_token},
+        headers=user_authorization_headers(user.username),
+    )
+    assert response.status_code == 200
+    result = response.json()
+    assert [n["id"] for n in result["notifications"]] == [notification2.id]
+    assert result["deleted"] == [notification1.id]
+    assert result["sync_token"] > sync_token
+
+
+def test_sync_current_user_notifications_pages(
+    client: TestClient, db, user, service, api_version
+):
+    user.subscribe(service)
+    db.commit()
+    for nb in range(3):
+        crud.create_service_notification(
+            db, schemas.NotificationCreate(title=f"message{nb}"), service
+        )
+    url = f"/api/{api_version}/users/user/notifications/sync"
+    headers = user_authorization_headers(user.username)
+    response = client.get(url, params={"limit": 2}, headers=headers)
+    assert response.status_code == 200
+    result = response.json()
+    assert [n["title"] for n in result["notifications"]] == ["message0", "message1"]
+    response = client.get(
+        url, params={"limit": 2, "cursor": result["next_cursor"]}, headers=headers
+    )
+    result = response.json()
+    assert [n["title"] for n in result["notifications"]] == ["message2"]
+    assert result["next_cursor"] is None
+    response = client.get(url, params={"limit": 0}, headers=headers)
+    assert response.status_code == 422
+
+
 def test_update_current_user_notifications(
     client: TestClient, db, user, notification_factory, api_version
 ):
@@ -286,8 +374,10 @@ def test_update_current_user_notifications(
     user.notifications.append(notification1)
     user.notifications.append(notification2)
     user.notifications.append(notification3)
-    assert user.nb_unread_notifications == 3
     db.commit()
+    # Notifications weren't added by create_service_notification
+    crud.reconcile_unread_counts(db)
+    assert user.nb_unread_notifications == 3
     response = client.patch(
         f"/api/{api_version}/users/user/notifications",
         headers=user_authorization_headers(user.username),
@@ -360,6 +450,33 @@ def test_update_user(
     }
 
 
+def test_current_user_cache(client: TestClient, db, user_factory, mocker):
+    user = user_factory()
+    admin = user_factory(is_admin=True)
+    db.commit()
+    spy = mocker.spy(crud, "get_user_by_username")
+    for _ in range(3):
+        response = client.get(
+            "/api/v2/users/user/profile",
+            headers=user_authorization_headers(user.username),
+        )
+        assert response.status_code == 200
+    # The user is only retrieved from the database once
+    assert spy.call_count == 1
+    # Updating the user invalidates the cache
+    response = client.patch(
+        f"/api/v2/users/{user.id}",
+        headers=user_authorization_headers(admin.username),
+        json={"is_active": False},
+    )
+    assert response.status_code == 200
+    response = client.get(
+        "/api/v2/users/user/profile",
+        headers=user_authorization_headers(user.username),
+    )
+    assert response.status_code == 403
+
+
 def test_update_user_invalid_id(client: TestClient, admin_token_headers):
     response = client.patch(
         "/api/v2/users/1234",
@@ -28,7 +28,7 @@ environ["GOOGLE_APPLICATION_CREDENTIALS"] = "test-key.json"
 
 from app.main import original_api, app  # noqa E402
 from app.database import Base, engine  # noqa E402
-from app import deps  # noqa E402
+from app import cache, deps, ratelimit  # noqa E402
 from app.utils import create_access_token  # noqa E402
 from . import factories  # noqa E402
 
@@ -54,6 +54,8 @@ def db(connection) -> Generator:
     factories.ServiceFactory._meta.sqlalchemy_session = session
     factories.NotificationFactory._meta.sqlalchemy_session = session
     original_api.dependency_overrides[deps.get_db] = lambda: session
+    cache.users.clear()
+    ratelimit.backend.clear()
     yield session
     session.close()
     transaction.rollback()
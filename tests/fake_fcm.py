@@ -0,0 +1,235 @@
+"""Local stand-in for the FCM HTTP v1 API
+
+Answers POST /v1/projects/<project>/messages:send like FCM does, depending
+on the device token of the message:
+
+- starting with "unregistered": 404 UNREGISTERED
+- starting with "throttled": 429 QUOTA_EXCEEDED with Retry-After
+- starting with "unavailable": 503 UNAVAILABLE
+- otherwise: 200 with the message name
+
+Requests without bearer token get a 401.
+Connections are served with HTTP/2 without TLS (prior knowledge, as sent by
+a ClientPool with http1=False) or HTTP/1.1. Responses can be delayed to
+simulate the network latency. Used by the tests and the benchmarks:
+
+    python -m tests.fake_fcm --port 8090 --latency 0.02
+    FCM_URL=http://127.0.0.1:8090 notify-server push-worker
+"""
+
+import argparse
+import asyncio
+import json
+import re
+from typing import Dict, List, Optional, Tuple
+import h11
+import h2.config
+import h2.connection
+import h2.events
+import h2.exceptions
+
+H2_PREFACE = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+RE_PATH = re.compile(r"^/v1/projects/(?P<project>[^/]+)/messages:send$")
+
+Response = Tuple[int, List[Tuple[str, str]], bytes]
+
+
+def error(status_code: int, status: str, error_code: Optional[str] = None) -> Response:
+    body = {"code": status_code, "message": status, "status": status}
+    if error_code is not None:
+        body["details"] = [
+            {
+                "@type": "type.googleapis.com/google.firebase.fcm.v1.FcmError",
+                "errorCode": error_code,
+            }
+        ]
+    return status_code, [], json.dumps({"error": body}).encode()
+
+
+class FakeFCM:
+    def __init__(self, latency: float = 0, retry_after: int = 1):
+        self.latency = latency
+        self.retry_after = retry_after
+        self.nb_connections = 0
+        self.nb_requests = 0
+        # Maximum number of requests being handled at the same time
+        # on one connection
+        self.max_concurrent_streams = 0
+        self.tokens: List[str] = []
+        self._server: Optional[asyncio.Server] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        self._server = await asyncio.start_server(self._handle, host, port)
+
+    async def stop(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def __aenter__(self) -> "FakeFCM":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.stop()
+
+    async def respond(
+        self, method: str, path: str, headers: Dict[str, str], body: bytes
+    ) -> Response:
+        self.nb_requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        match = RE_PATH.match(path)
+        if method != "POST" or match is None:
+            return error(404, "NOT_FOUND")
+        if not headers.get("authorization", "").startswith("Bearer "):
+            return error(401, "UNAUTHENTICATED")
+        try:
+            token = json.loads(body)["message"]["token"]
+        except (ValueError, KeyError, TypeError):
+            return error(400, "INVALID_ARGUMENT", "INVALID_ARGUMENT")
+        self.tokens.append(token)
+        if token.startswith("unregistered"):
+            return error(404, "NOT_FOUND", "UNREGISTERED")
+        if token.startswith("throttled"):
+            status_code, response_headers, response_body = error(
+                429, "RESOURCE_EXHAUSTED", "QUOTA_EXCEEDED"
+            )
+            response_headers.append(("retry-after", str(self.retry_after)))
+            return status_code, response_headers, response_body
+        if token.startswith("unavailable"):
+            return error(503, "UNAVAILABLE", "UNAVAILABLE")
+        name = f"projects/{match['project']}/messages/{self.nb_requests}"
+        return 200, [], json.dumps({"name": name}).encode()
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self.nb_connections += 1
+        try:
+            data = await reader.read(65535)
+            if data.startswith(H2_PREFACE[: len(data)]):
+                await self._handle_h2(reader, writer, data)
+            else:
+                await self._handle_h11(reader, writer, data)
+        except (ConnectionError, h2.exceptions.ProtocolError, h11.ProtocolError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_h2(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, data: bytes
+    ) -> None:
+        connection = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=False, header_encoding="utf-8")
+        )
+        connection.initiate_connection()
+        requests: Dict[int, Tuple[Dict[str, str], bytearray]] = {}
+        tasks = set()
+
+        async def handle_stream(stream_id: int) -> None:
+            headers, body = requests.pop(stream_id)
+            status_code, response_headers, response_body = await self.respond(
+                headers[":method"], headers[":path"], headers, bytes(body)
+            )
+            connection.send_headers(
+                stream_id,
+                [
+                    (":status", str(status_code)),
+                    ("content-type", "application/json; charset=UTF-8"),
+                    ("content-length", str(len(response_body))),
+                ]
+                + response_headers,
+            )
+            connection.send_data(stream_id, response_body, end_stream=True)
+            writer.write(connection.data_to_send())
+
+        while data:
+            for event in connection.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    requests[event.stream_id] = (dict(event.headers), bytearray())
+                elif isinstance(event, h2.events.DataReceived):
+                    requests[event.stream_id][1].extend(event.data)
+                    connection.acknowledge_received_data(
+                        event.flow_controlled_length, event.stream_id
+                    )
+                elif isinstance(event, h2.events.StreamEnded):
+                    task = asyncio.create_task(handle_stream(event.stream_id))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    self.max_concurrent_streams = max(
+                        self.max_concurrent_streams, len(tasks)
+                    )
+                elif isinstance(event, h2.events.ConnectionTerminated):
+                    return
+            writer.write(connection.data_to_send())
+            await writer.drain()
+            data = await reader.read(65535)
+
+    async def _handle_h11(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, data: bytes
+    ) -> None:
+        connection = h11.Connection(h11.SERVER)
+        connection.receive_data(data)
+        while True:
+            request = None
+            body = bytearray()
+            while True:
+                event = connection.next_event()
+                if event is h11.NEED_DATA:
+                    data = await reader.read(65535)
+                    if not data:
+                        return
+                    connection.receive_data(data)
+                elif isinstance(event, h11.Request):
+                    request = event
+                elif isinstance(event, h11.Data):
+                    body.extend(event.data)
+                elif isinstance(event, h11.EndOfMessage):
+                    break
+                else:
+                    # ConnectionClosed
+                    return
+            headers = {
+                name.decode().lower(): value.decode() for name, value in request.headers
+            }
+            self.max_concurrent_streams = max(self.max_concurrent_streams, 1)
+            status_code, response_headers, response_body = await self.respond(
+                request.method.decode(), request.target.decode(), headers, bytes(body)
+            )
+            writer.write(
+                connection.send(
+                    h11.Response(
+                        status_code=status_code,
+                        headers=[
+                            ("content-type", "application/json; charset=UTF-8"),
+                            ("content-length", str(len(response_body))),
+                        ]
+                        + response_headers,
+                    )
+                )
+            )
+            writer.write(connection.send(h11.Data(data=response_body)))
+            writer.write(connection.send(h11.EndOfMessage()))
+            await writer.drain()
+            connection.start_next_cycle()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0)
+    args = parser.parse_args()
+    server = FakeFCM(latency=args.latency)
+    await server.start(args.host, args.port)
+    print(f"Fake FCM listening on {server.url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,67 @@
+import pytest
+from sqlalchemy import event
+from app import cache, models
+from app.database import engine
+
+
+def test_user_cache(db, user_factory):
+    user_cache = cache.UserCache(size=2, ttl=60)
+    user1 = user_factory()
+    user2 = user_factory()
+    user3 = user_factory()
+    assert user_cache.get(user1.username) is None
+    user_cache.set(user1)
+    user_cache.set(user2)
+    assert user_cache.get(user1.username) == cache.CachedUser.from_user(user1)
+    # The least recently used user is evicted
+    user_cache.set(user3)
+    assert user_cache.get(user2.username) is None
+    assert user_cache.get(user1.username).id == user1.id
+    assert user_cache.get(user3.username).id == user3.id
+    user_cache.invalidate(user1.username)
+    assert user_cache.get(user1.username) is None
+    # Invalidating an unknown user doesn't raise any error
+    user_cache.invalidate("unknown")
+    user_cache.clear()
+    assert user_cache.get(user3.username) is None
+
+
+def test_user_cache_ttl(db, user, mocker):
+    mock_monotonic = mocker.patch("time.monotonic", return_value=100)
+    user_cache = cache.UserCache(size=2, ttl=60)
+    user_cache.set(user)
+    mock_monotonic.return_value = 160
+    assert user_cache.get(user.username) is not None
+    mock_monotonic.return_value = 160.1
+    assert user_cache.get(user.username) is None
+
+
+@pytest.mark.parametrize("size, ttl", [(0, 60), (10, 0)])
+def test_user_cache_disabled(db, user, size, ttl):
+    user_cache = cache.UserCache(size=size, ttl=ttl)
+    user_cache.set(user)
+    assert user_cache.get(user.username) is None
+
+
+def test_cached_user_to_user(db, user_factory):
+    user = user_factory(is_admin=True, device_tokens=["my-token"])
+    db.commit()
+    cached_user = cache.CachedUser.from_user(user)
+    db.expunge_all()
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count_statement)
+    try:
+        db_user = cached_user.to_user(db)
+        assert db_user.username == user.username
+        assert db_user.is_admin
+        assert statements == []
+        # Other attributes are loaded on access
+        assert db_user.device_tokens == ["my-token"]
+        assert db_user.unread_count == 0
+    finally:
+        event.remove(engine, "before_cursor_execute", count_statement)
+    assert db_user is db.query(models.User).get(user.id)
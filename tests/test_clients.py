@@ -0,0 +1,136 @@
+import asyncio
+import email.utils
+import httpx
+import pytest
+from datetime import datetime, timedelta, timezone
+from app import clients
+
+
+@pytest.mark.asyncio
+async def test_client_pool_start_stop():
+    pool = clients.ClientPool("test", size=2, max_streams=10)
+    await pool.start()
+    assert pool.is_started
+    assert len(pool.connections) == 2
+    client_objects = [connection.client for connection in pool.connections]
+    await pool.stop()
+    assert not pool.is_started
+    assert all(client.is_closed for client in client_objects)
+
+
+@pytest.mark.asyncio
+async def test_client_pool_reuses_clients():
+    pool = clients.ClientPool("test", size=1, max_streams=10)
+    async with pool.client() as client1:
+        pass
+    async with pool.client() as client2:
+        pass
+    # The pool is opened on first use and the same client is reused
+    assert client1 is client2
+    assert not client1.is_closed
+    await pool.stop()
+
+
+@pytest.mark.asyncio
+async def test_client_pool_least_busy_connection():
+    pool = clients.ClientPool("test", size=2, max_streams=10)
+    async with pool.client() as client1, pool.client() as client2:
+        assert client1 is not client2
+        assert [c.in_flight for c in pool.connections] == [1, 1]
+    assert [c.in_flight for c in pool.connections] == [0, 0]
+    await pool.stop()
+
+
+@pytest.mark.asyncio
+async def test_client_pool_max_streams():
+    pool = clients.ClientPool("test", size=1, max_streams=2)
+    in_flight = []
+    release = asyncio.Event()
+
+    async def request():
+        async with pool.client():
+            in_flight.append(pool.connections[0].in_flight)
+            await release.wait()
+
+    tasks = [asyncio.create_task(request()) for _ in range(3)]
+    await asyncio.sleep(0.01)
+    # Only 2 requests can run at the same time on the connection
+    assert len(in_flight) == 2
+    release.set()
+    await asyncio.gather(*tasks)
+    assert len(in_flight) == 3
+    await pool.stop()
+
+
+@pytest.mark.asyncio
+async def test_client_pool_check_health():
+    pool = clients.ClientPool("test", size=2, max_streams=10)
+    await pool.start()
+    closed_client = pool.connections[0].client
+    healthy_client = pool.connections[1].client
+    await closed_client.aclose()
+    await pool.check_health()
+    # The closed client was replaced
+    assert pool.connections[0].client is not closed_client
+    assert not pool.connections[0].client.is_closed
+    assert pool.connections[1].client is healthy_client
+    await pool.stop()
+
+
+@pytest.mark.asyncio
+async def test_client_pool_check_health_errors():
+    pool = clients.ClientPool("test", size=1, max_streams=10, max_errors=2)
+    await pool.start()
+    failing = pool.connections[0]
+    # Nothing listens on that port
+    for _ in range(2):
+        with pytest.raises(httpx.ConnectError):
+            async with pool.client() as client:
+                await client.get("http://127.0.0.1:1")
+    assert failing.transport.errors == 2
+    async with pool.client():
+        await pool.check_health()
+        # Replaced but kept open for the request in flight
+        assert pool.connections[0] is not failing
+        assert not failing.client.is_closed
+    await pool.check_health()
+    assert failing.client.is_closed
+    await pool.stop()
+
+
+def test_client_pool_new_event_loop():
+    pool = clients.ClientPool("test", size=1, max_streams=10)
+
+    async def get_client():
+        async with pool.client() as client:
+            return client
+
+    client1 = asyncio.run(get_client())
+    client2 = asyncio.run(get_client())
+    # The client of the previous event loop was closed
+    assert client1 is not client2
+    assert client1.is_closed
+    asyncio.run(pool.stop())
+
+
+@pytest.mark.parametrize(
+    "headers,expected",
+    [
+        ({}, None),
+        ({"Retry-After": "120"}, 120),
+        ({"Retry-After": "-1"}, 0),
+        ({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}, 0),
+        ({"Retry-After": "foo"}, None),
+    ],
+)
+def test_get_retry_after(headers, expected):
+    response = httpx.Response(503, headers=headers)
+    assert clients.get_retry_after(response) == expected
+
+
+def test_get_retry_after_date():
+    date = datetime.now(timezone.utc) + timedelta(seconds=60)
+    response = httpx.Response(
+        429, headers={"Retry-After": email.utils.format_datetime(date, usegmt=True)}
+    )
+    assert 55 < clients.get_retry_after(response) <= 60
@@ -9,3 +9,46 @@ def test_cli():
     assert result.exit_code == 0
     assert "create-db" in result.output
     assert "delete-notifications" in result.output
+    assert "push-worker" in result.output
+    assert "reconcile-unread-counts" in result.output
+
+
+def test_push_worker_invalid_shard():
+    result = runner.invoke(cli, ["push-worker", "--shard", "2", "--nb-shards", "2"])
+    assert result.exit_code == 1
+    assert "Shard shall be between 0 and 1" in result.output
+
+
+def test_delete_notifications_dry_run(mocker):
+    mock_count = mocker.patch("app.crud.count_old_notifications", return_value=(3, 12))
+    mock_delete = mocker.patch("app.crud.delete_notifications")
+    result = runner.invoke(cli, ["delete-notifications", "--days", "10", "--dry-run"])
+    assert result.exit_code == 0
+    assert mock_count.call_args.args[1] == 10
+    assert not mock_delete.called
+    assert (
+        "3 notification(s) older than 10 days (12 users notifications) would be deleted"
+        in result.output
+    )
+
+
+def test_delete_notifications(mocker):
+    def delete_notifications(db, days, batch_size, pause, progress):
+        progress(50)
+        progress(60)
+        return 60
+
+    mock_delete = mocker.patch(
+        "app.crud.delete_notifications", side_effect=delete_notifications
+    )
+    mock_purge = mocker.patch("app.ratelimit.purge", return_value=2)
+    result = runner.invoke(
+        cli, ["delete-notifications", "--batch-size", "50", "--pause", "0.1"]
+    )
+    assert result.exit_code == 0
+    assert mock_delete.call_args.kwargs["batch_size"] == 50
+    assert mock_delete.call_args.kwargs["pause"] == 0.1
+    assert "50 notification(s) deleted" in result.output
+    assert "Done. 60 notification(s) deleted." in result.output
+    assert mock_purge.called
+    assert "2 stale rate limit bucket(s) deleted." in result.output
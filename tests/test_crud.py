@@ -2,7 +2,9 @@ import datetime
 import pytest
 import uuid
 from operator import attrgetter
+from sqlalchemy import event
 from app import crud, models, schemas
+from app.database import engine
 
 
 def test_create_user(db):
@@ -172,6 +174,31 @@ def test_create_service_notification(db, user_factory, service):
     assert notification.users_notification == [user1.user_notifications[0]]
 
 
+def test_create_service_notifications(db, user_factory, service):
+    user1 = user_factory()
+    user2 = user_factory()
+    user1.subscribe(service)
+    db.commit()
+    notifications = crud.create_service_notifications(
+        db,
+        [schemas.NotificationCreate(title=f"message{nb}") for nb in range(3)],
+        service=service,
+    )
+    assert [notification.title for notification in notifications] == [
+        "message0",
+        "message1",
+        "message2",
+    ]
+    assert service.notifications == notifications
+    assert user1.notifications == notifications
+    assert user1.unread_count == 3
+    assert user2.notifications == []
+    # One job to push a summary of the notifications
+    push_job = db.query(models.PushJob).one()
+    assert push_job.notification_id == notifications[-1].id
+    assert push_job.nb_notifications == 3
+
+
 def test_get_user_notifications(db, user, service):
     user.subscribe(service)
     db.commit()
@@ -243,6 +270,39 @@ def test_get_user_notifications_limit(db, user, service, limit, sort):
     assert user_notifications == sorted_user_notifications
 
 
+def test_get_user_notifications_cursor(db, user, service):
+    user.subscribe(service)
+    db.commit()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    notifications = []
+    for nb in range(10):
+        notification = crud.create_service_notification(
+            db, schemas.NotificationCreate(title=f"message{nb}"), service
+        )
+        # Notifications 4 and 5 have the same timestamp
+        notification.timestamp = now - datetime.timedelta(minutes=10 - min(nb, 4))
+        notifications.append(notification)
+    db.commit()
+    ids = [notification.id for notification in notifications]
+
+    def get_ids(**kwargs):
+        return [n.id for n in crud.get_user_notifications(db, user, **kwargs)]
+
+    # Page from the newest to the oldest
+    assert get_ids(limit=4) == ids[9:5:-1]
+    assert get_ids(limit=4, before=ids[6]) == ids[5:1:-1]
+    assert get_ids(limit=4, before=ids[2]) == ids[1::-1]
+    assert get_ids(limit=4, before=ids[0]) == []
+    # Notifications received after the cursor (the closest ones first)
+    assert get_ids(limit=3, after=ids[3]) == ids[6:3:-1]
+    assert get_ids(limit=3, after=ids[3], sort="asc") == ids[4:7]
+    assert get_ids(after=ids[9]) == []
+    # Both cursors
+    assert get_ids(before=ids[8], after=ids[4]) == ids[7:4:-1]
+    # Unknown cursor
+    assert get_ids(before=ids[9] + 1) == []
+
+
 def test_get_user_notifications_filter_services_id(db, user, service_factory):
     # Create some notifications
     service1 = service_factory()
@@ -388,6 +448,301 @@ def test_remove_user_device_token(db, user_factory, initial_tokens, removed, exp
     assert user.device_tokens == expected
 
 
+def test_create_user_device_token(db, user_factory):
+    user1 = user_factory()
+    user2 = user_factory()
+    crud.create_user_device_token(db, "my-token", user1)
+    assert user1.device_tokens == ["my-token"]
+    # Adding an existing token doesn't create a new one
+    crud.create_user_device_token(db, "my-token", user1)
+    assert user1.device_tokens == ["my-token"]
+    # A token registered by another user is moved to this user
+    crud.create_user_device_token(db, "my-token", user2)
+    db.expire_all()
+    assert user1.device_tokens == []
+    assert user2.device_tokens == ["my-token"]
+    assert db.query(models.DeviceToken).count() == 1
+
+
+def test_remove_device_tokens(db, user_factory):
+    user1 = user_factory(device_tokens=["token1", "token2", "token3"])
+    user2 = user_factory(device_tokens=["token4", "token5"])
+    db.commit()
+    # Non existing tokens are ignored
+    crud.remove_device_tokens(db, ["token1", "foo", "token3", "token4"], chunk_size=2)
+    crud.remove_device_tokens(db, [])
+    db.expire_all()
+    assert user1.device_tokens == ["token2"]
+    assert user2.device_tokens == ["token5"]
+
+
+def test_update_device_tokens_last_success(db, user_factory):
+    user = user_factory(device_tokens=["token1", "token2", "token3"])
+    db.commit()
+    assert all(token.last_success_at is None for token in user.tokens)
+    crud.update_device_tokens_last_success(db, ["token1", "token3"], chunk_size=1)
+    db.expire_all()
+    token1, token2, token3 = user.tokens
+    assert token1.last_success_at is not None
+    assert token2.last_success_at is None
+    assert token3.last_success_at is not None
+
+
+def test_sync_user_notifications(db, user, user_factory, service_factory):
+    service1 = service_factory()
+    service2 = service_factory()
+    user.subscribe(service1)
+    user.subscribe(service2)
+    other_user = user_factory()
+    other_user.subscribe(service1)
+    db.commit()
+    sync = crud.sync_user_notifications(db, user)
+    assert sync == schemas.UserNotificationsSync(
+        sync_token=0, notifications=[], deleted=[]
+    )
+    notification1 = crud.create_service_notification(
+        db, schemas.NotificationCreate(title="message1"), service1
+    )
+    notification2 = crud.create_service_notification(
+        db, schemas.NotificationCreate(title="message2"), service2
+    )
+    sync = crud.sync_user_notifications(db, user, 0)
+    assert sync.sync_token == 2
+    assert [n.id for n in sync.notifications] == [notification1.id, notification2.id]
+    assert sync.deleted == []
+    # Nothing changed
+    assert crud.sync_user_notifications(db, user, 2) == schemas.UserNotificationsSync(
+        sync_token=2, notifications=[], deleted=[]
+    )
+    crud.update_user_notifications(
+        db,
+        [
+            schemas.UserUpdateNotification(id=notification1.id, status="read"),
+            schemas.UserUpdateNotification(id=notification2.id, status="deleted"),
+        ],
+        user,
+    )
+    notification3 = crud.create_service_notification(
+        db, schemas.NotificationCreate(title="message3"), service1
+    )
+    sync = crud.sync_user_notifications(db, user, 2)
+    assert sync.sync_token == 4
+    assert [(n.id, n.is_read) for n in sync.notifications] == [
+        (notification1.id, True),
+        (notification3.id, False),
+    ]
+    assert sync.deleted == [notification2.id]
+    # A full sync only returns the existing notifications
+    sync = crud.sync_user_notifications(db, user)
+    assert sync.sync_token == 4
+    assert [n.id for n in sync.notifications] == [notification1.id, notification3.id]
+    assert sync.deleted == []
+    # Deleting the service removes its notifications from the users
+    deleted_ids = [notification1.id, notification3.id]
+    crud.delete_service(db, service1)
+    sync = crud.sync_user_notifications(db, user, 4)
+    assert sync.sync_token == 5
+    assert sync.notifications == []
+    assert sync.deleted == deleted_ids
+    # Other users have their own sequence
+    sync = crud.sync_user_notifications(db, other_user, 0)
+    assert sync.sync_token == 3
+    assert sync.notifications == []
+    assert sync.deleted == deleted_ids
+
+
+def test_delete_notifications_sync(db, user, service, notification_date):
+    user.subscribe(service)
+    db.commit()
+    notification1 = crud.create_service_notification(
+        db, schemas.NotificationCreate(title="message1"), service
+    )
+    crud.create_service_notification(
+        db, schemas.NotificationCreate(title="message2"), service
+    )
+    notification1.timestamp = notification_date(40)
+    db.commit()
+    assert crud.sync_user_notifications(db, user).deleted_before is None
+    crud.delete_notifications(db, 30)
+    # No tombstone nor full resync for old notifications:
+    # clients drop the ones older than deleted_before
+    assert db.query(models.DeletedUserNotification).count() == 0
+    sync = crud.sync_user_notifications(db, user, 2)
+    assert sync == schemas.UserNotificationsSync(
+        sync_token=2,
+        notifications=[],
+        deleted=[],
+        deleted_before=user.notifications_deleted_before,
+    )
+    assert notification_date(31) < sync.deleted_before < notification_date(29)
+    assert user.unread_count == 1
+
+
+def test_sync_user_notifications_pages(db, user, service):
+    user.subscribe(service)
+    db.commit()
+    notification_ids = [
+        crud.create_service_notification(
+            db, schemas.NotificationCreate(title=f"message{nb}"), service
+        ).id
+        for nb in range(5)
+    ]
+    sync = crud.sync_user_notifications(db, user, limit=2)
+    assert sync.sync_token == 5
+    assert [n.id for n in sync.notifications] == notification_ids[:2]
+    assert sync.next_cursor == notification_ids[1]
+    sync = crud.sync_user_notifications(db, user, limit=2, cursor=sync.next_cursor)
+    assert [n.id for n in sync.notifications] == notification_ids[2:4]
+    sync = crud.sync_user_notifications(db, user, limit=2, cursor=sync.next_cursor)
+    assert [n.id for n in sync.notifications] == notification_ids[4:]
+    assert sync.next_cursor is None
+    # Changes since a sync_token aren't paginated
+    sync = crud.sync_user_notifications(db, user, 0, limit=2)
+    assert len(sync.notifications) == 5
+    assert sync.next_cursor is None
+
+
+def test_delete_notifications_tombstones(db, user, service, notification_date):
+    user.subscribe(service)
+    db.commit()
+    notification1 = crud.create_service_notification(
+        db, schemas.NotificationCreate(title="message1"), service
+    )
+    notification2 = crud.create_service_notification(
+        db, schemas.NotificationCreate(title="message2"), service
+    )
+    notification1_id = notification1.id
+    notification2_id = notification2.id
+    crud.update_user_notifications(
+        db,
+        [schemas.UserUpdateNotification(id=notification1_id, status="deleted")],
+        user,
+    )
+    crud.update_user_notifications(
+        db,
+        [schemas.UserUpdateNotification(id=notification2_id, status="read")],
+        user,
+    )
+    # Deletions are only kept for keep_days
+    crud.delete_notifications(db, 30)
+    assert db.query(models.DeletedUserNotification).count() == 1
+    assert crud.sync_user_notifications(db, user, 1).deleted == [notification1_id]
+    db.query(models.DeletedUserNotification).update(
+        {models.DeletedUserNotification.deleted_at: notification_date(40)}
+    )
+    crud.delete_notifications(db, 30)
+    assert db.query(models.DeletedUserNotification).count() == 0
+    assert user.sync_floor == 3
+    sync = crud.sync_user_notifications(db, user, 2)
+    assert sync.full_resync
+    assert [(n.id, n.is_read) for n in sync.notifications] == [(notification2_id, True)]
+    # Clients that synced after the purged deletion keep syncing incrementally
+    sync = crud.sync_user_notifications(db, user, 3)
+    assert not sync.full_resync
+    assert [n.id for n in sync.notifications] == [notification2_id]
+
+
+def test_unread_count(db, user, user_factory, service_factory, notification_date):
+    service1 = service_factory()
+    service2 = service_factory()
+    user.subscribe(service1)
+    user.subscribe(service2)
+    other_user = user_factory()
+    other_user.subscribe(service2)
+    db.commit()
+    assert user.unread_count == 0
+    notification1 = crud.create_service_notification(
+        db, schemas.NotificationCreate(title="message1"), service1
+    )
+    notification2 = crud.create_service_notification(
+        db, schemas.NotificationCreate(title="message2"), service1
+    )
+    notification3 = crud.create_service_notification(
+        db, schemas.NotificationCreate(title="message3"), service2
+    )
+    notification4 = crud.create_service_notification(
+        db, schemas.NotificationCreate(title="message4"), service2
+    )
+    assert user.unread_count == 4
+    assert other_user.unread_count == 2
+    crud.update_user_notifications(
+        db,
+        [
+            schemas.UserUpdateNotification(id=notification1.id, status="read"),
+            schemas.UserUpdateNotification(id=notification2.id, status="read"),
+            schemas.UserUpdateNotification(id=notification3.id, status="deleted"),
+        ],
+        user,
+    )
+    assert user.unread_count == 1
+    # Only actual changes are counted
+    crud.update_user_notifications(
+        db,
+        [
+            schemas.UserUpdateNotification(id=notification1.id, status="unread"),
+            schemas.UserUpdateNotification(id=notification2.id, status="deleted"),
+            schemas.UserUpdateNotification(id=notification4.id, status="unread"),
+        ],
+        user,
+    )
+    assert user.unread_count == 2
+    notification4.timestamp = notification_date(40)
+    db.commit()
+    crud.delete_notifications(db, 30)
+    assert user.unread_count == 1
+    assert other_user.unread_count == 1
+    crud.delete_service(db, service1)
+    assert user.unread_count == 0
+    assert other_user.unread_count == 1
+    assert crud.reconcile_unread_counts(db) == 0
+
+
+def test_unread_count_concurrent_update(db, user, service):
+    user.subscribe(service)
+    db.commit()
+    notification = crud.create_service_notification(
+        db, schemas.NotificationCreate(title="message"), service
+    )
+    # Load the notification as unread
+    assert not user.user_notifications[0].is_read
+    # Marked as read by another request in the meantime
+    db.execute(
+        models.UserNotification.__table__.update().values(is_read=True, sequence=1)
+    )
+    db.execute(models.User.__table__.update().values(unread_count=0))
+    crud.update_user_notifications(
+        db, [schemas.UserUpdateNotification(id=notification.id, status="read")], user
+    )
+    assert user.unread_count == 0
+    crud.update_user_notifications(
+        db,
+        [schemas.UserUpdateNotification(id=notification.id, status="deleted")],
+        user,
+    )
+    assert user.unread_count == 0
+    assert crud.reconcile_unread_counts(db) == 0
+
+
+def test_reconcile_unread_counts(db, user_factory, notification_factory):
+    user1 = user_factory()
+    user2 = user_factory()
+    user3 = user_factory()
+    notification1 = notification_factory()
+    notification2 = notification_factory()
+    user1.notifications.append(notification1)
+    user1.notifications.append(notification2)
+    user2.notifications.append(notification1)
+    db.commit()
+    user2.user_notifications[0].is_read = True
+    user3.unread_count = 5
+    db.commit()
+    assert crud.reconcile_unread_counts(db) == 2
+    assert user1.unread_count == 2
+    assert user2.unread_count == 0
+    assert user3.unread_count == 0
+    assert crud.reconcile_unread_counts(db) == 0
+
+
 def test_delete_notifications(db, notification_factory, notification_date):
     notification1 = notification_factory(timestamp=notification_date(60))
     notification2 = notification_factory(timestamp=notification_date(40))
@@ -413,6 +768,35 @@ def test_delete_notifications(db, notification_factory, notification_date):
     ]
 
 
+def test_delete_notifications_batches(db, user, service, notification_date, mocker):
+    mock_sleep = mocker.patch("time.sleep")
+    user.subscribe(service)
+    db.commit()
+    for nb in range(7):
+        notification = crud.create_service_notification(
+            db, schemas.NotificationCreate(title=f"message{nb}"), service
+        )
+        if nb < 5:
+            notification.timestamp = notification_date(40)
+    db.commit()
+    assert crud.count_old_notifications(db, 30) == (5, 5)
+    progress = []
+    nb_deleted = crud.delete_notifications(
+        db, 30, batch_size=2, pause=0.5, progress=progress.append
+    )
+    assert nb_deleted == 5
+    assert progress == [2, 4, 5]
+    # One pause per batch
+    assert mock_sleep.call_count == 3
+    mock_sleep.assert_called_with(0.5)
+    assert db.query(models.Notification).count() == 2
+    assert db.query(models.UserNotification).count() == 2
+    assert db.query(models.DeletedUserNotification).count() == 0
+    assert user.unread_count == 2
+    assert crud.count_old_notifications(db, 30) == (0, 0)
+    assert crud.delete_notifications(db, 30) == 0
+
+
 def test_delete_notifications_with_user(db, user, service_factory, notification_date):
     service1 = service_factory()
     service2 = service_factory()
@@ -457,3 +841,296 @@ def test_delete_notifications_with_user(db, user, service_factory, notification_
     ]
     # Check that old UserNotifications have also been deleted
     assert user.notifications == [notification4]
+
+
+def test_create_service_notification_push_job(db, service):
+    notification = crud.create_service_notification(
+        db, schemas.NotificationCreate(title="message"), service
+    )
+    push_job = db.query(models.PushJob).one()
+    assert push_job.notification_id == notification.id
+    assert push_job.locked_until is None
+    assert push_job.attempts == 0
+
+
+def test_create_service_notification_coalescing(db, service_factory):
+    service = service_factory(coalescing_window=60)
+    notifications = [
+        crud.create_service_notification(
+            db, schemas.NotificationCreate(title=f"alarm{nb}"), service
+        )
+        for nb in range(5)
+    ]
+    # The first notification is pushed right away, the next ones
+    # are merged in one job delayed by the window
+    push_job1, push_job2 = db.query(models.PushJob).order_by(models.PushJob.id)
+    assert push_job1.notification_id == notifications[0].id
+    assert push_job1.nb_notifications == 1
+    assert push_job2.notification_id == notifications[-1].id
+    assert push_job2.nb_notifications == 4
+    assert push_job2.available_at > models.utcnow() + datetime.timedelta(seconds=50)
+    (job,) = crud.claim_push_jobs(db, limit=10, lease=60)
+    assert job.id == push_job1.id
+    # A job being processed isn't updated anymore
+    db.query(models.PushJob).update(
+        {models.PushJob.available_at: models.utcnow()}, synchronize_session=False
+    )
+    db.commit()
+    (job,) = crud.claim_push_jobs(db, limit=10, lease=60)
+    assert job.id == push_job2.id
+    notification = crud.create_service_notification(
+        db, schemas.NotificationCreate(title="alarm5"), service
+    )
+    push_job3 = db.query(models.PushJob).order_by(models.PushJob.id.desc()).first()
+    assert push_job3.notification_id == notification.id
+    assert push_job3.nb_notifications == 1
+    assert push_job3.available_at > models.utcnow()
+
+
+def test_create_service_notification_coalescing_disabled(db, service):
+    assert service.coalescing_window == 0
+    for nb in range(3):
+        crud.create_service_notification(
+            db, schemas.NotificationCreate(title=f"alarm{nb}"), service
+        )
+    assert len(crud.claim_push_jobs(db, limit=10, lease=60)) == 3
+
+
+def test_claim_push_jobs(db, service):
+    notifications = [
+        crud.create_service_notification(
+            db, schemas.NotificationCreate(title=f"message{nb}"), service
+        )
+        for nb in range(3)
+    ]
+    jobs = crud.claim_push_jobs(db, limit=2, lease=60)
+    assert [job.notification_id for job in jobs] == [
+        notifications[0].id,
+        notifications[1].id,
+    ]
+    assert all(job.attempts == 1 for job in jobs)
+    # Claimed jobs aren't returned again until their lease expires
+    jobs = crud.claim_push_jobs(db, limit=2, lease=60)
+    assert [job.notification_id for job in jobs] == [notifications[2].id]
+    assert crud.claim_push_jobs(db, limit=2, lease=60) == []
+    db.query(models.PushJob).update(
+        {models.PushJob.locked_until: models.utcnow() - datetime.timedelta(seconds=1)}
+    )
+    db.commit()
+    jobs = crud.claim_push_jobs(db, limit=10, lease=60)
+    assert len(jobs) == 3
+    assert all(job.attempts == 2 for job in jobs)
+
+
+def test_claim_push_jobs_shards(db, service):
+    for nb in range(4):
+        crud.create_service_notification(
+            db, schemas.NotificationCreate(title=f"message{nb}"), service
+        )
+    jobs0 = crud.claim_push_jobs(db, limit=2, lease=60, shard=0, nb_shards=2)
+    jobs1 = crud.claim_push_jobs(db, limit=1, lease=60, shard=1, nb_shards=2)
+    assert len(jobs0) == 2
+    assert len(jobs1) == 1
+    assert all(job.id % 2 == 0 for job in jobs0)
+    assert all(job.id % 2 == 1 for job in jobs1)
+    # Jobs of another shard are claimed when there are none left in the shard
+    # (e.g. if the worker of shard 1 is down)
+    (job,) = crud.claim_push_jobs(db, limit=10, lease=60, shard=0, nb_shards=2)
+    assert job.id % 2 == 1
+
+
+def test_release_and_delete_push_job(db, service):
+    crud.create_service_notification(
+        db, schemas.NotificationCreate(title="message"), service
+    )
+    (job,) = crud.claim_push_jobs(db, limit=10, lease=60)
+    crud.release_push_job(db, job.id, delay=60)
+    # Not available before the delay
+    assert crud.claim_push_jobs(db, limit=10, lease=60) == []
+    crud.delete_push_job(db, job.id)
+    assert db.query(models.PushJob).count() == 0
+
+
+def test_get_notification_recipients(
+    db, user_factory, notification_factory, make_device_token
+):
+    expire_date = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+        minutes=60
+    )
+    ios_token = make_device_token(64)
+    android_token = make_device_token(128)
+    notification1 = notification_factory()
+    notification2 = notification_factory()
+    user1 = user_factory(
+        login_token_expire_date=expire_date,
+        device_tokens=[ios_token, android_token, "invalid"],
+    )
+    user2 = user_factory(login_token_expire_date=expire_date)
+    # Not logged in
+    user3 = user_factory()
+    # Inactive
+    user4 = user_factory(login_token_expire_date=expire_date, is_active=False)
+    user1.notifications.append(notification1)
+    user1.notifications.append(notification2)
+    user2.notifications.append(notification1)
+    user3.notifications.append(notification1)
+    user4.notifications.append(notification1)
+    db.commit()
+    user2.user_notifications[0].is_read = True
+    db.commit()
+    # Notifications weren't added by create_service_notification
+    crud.reconcile_unread_counts(db)
+    recipient1 = crud.Recipient(
+        user_id=user1.id,
+        username=user1.username,
+        nb_unread_notifications=2,
+        ios_tokens=[ios_token],
+        android_tokens=[android_token],
+    )
+    recipient2 = crud.Recipient(
+        user_id=user2.id,
+        username=user2.username,
+        nb_unread_notifications=0,
+        ios_tokens=[],
+        android_tokens=[],
+    )
+    assert crud.get_notification_recipients(db, notification1.id) == [
+        recipient1,
+        recipient2,
+    ]
+    assert crud.get_notification_recipients(db, notification2.id) == [recipient1]
+    # Paging
+    assert crud.get_notification_recipients(db, notification1.id, limit=1) == [
+        recipient1
+    ]
+    assert crud.get_notification_recipients(
+        db, notification1.id, after_user_id=user1.id, limit=1
+    ) == [recipient2]
+    assert (
+        crud.get_notification_recipients(
+            db, notification1.id, after_user_id=user2.id, limit=1
+        )
+        == []
+    )
+
+
+@pytest.mark.parametrize("nb_subscribers", [0, 1, 20])
+def test_create_service_notification_bulk_insert(
+    db, user_factory, service, nb_subscribers
+):
+    users = [user_factory(username=f"user{nb}") for nb in range(nb_subscribers)]
+    for user in users:
+        user.subscribe(service)
+    db.commit()
+    service_id = service.id
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count_statement)
+    try:
+        notification = crud.create_service_notification(
+            db,
+            schemas.NotificationCreate(title="message"),
+            crud.get_service(db, service_id),
+        )
+    finally:
+        event.remove(engine, "before_cursor_execute", count_statement)
+    # The UserNotification are created in one statement:
+    # the number of queries doesn't depend on the number of subscribers
+    nb_inserts = len([s for s in statements if s.startswith("INSERT")])
+    assert nb_inserts == 3
+    for user in users:
+        assert user.notifications == [notification]
+        assert not user.user_notifications[0].is_read
+
+
+def test_deliveries(db, user_factory, notification_factory):
+    notification_id = notification_factory().id
+    user1 = user_factory()
+    user2 = user_factory()
+    deliveries = [
+        crud.Delivery(
+            user1.id,
+            "ios-token",
+            schemas.Platform.ios,
+            crud.PushResult(
+                schemas.DeliveryStatus.success, status_code=200, latency=0.2
+            ),
+        ),
+        crud.Delivery(
+            user1.id,
+            "android-token1",
+            schemas.Platform.android,
+            crud.PushResult(
+                schemas.DeliveryStatus.unregistered,
+                status_code=404,
+                reason="UNREGISTERED",
+                latency=0.1,
+            ),
+        ),
+        crud.Delivery(
+            user2.id,
+            "android-token2",
+            schemas.Platform.android,
+            crud.PushResult(
+                schemas.DeliveryStatus.failure, reason="ConnectError", latency=0.5
+            ),
+        ),
+    ]
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count_statement)
+    try:
+        crud.create_deliveries(db, notification_id, deliveries, chunk_size=2)
+    finally:
+        event.remove(engine, "before_cursor_execute", count_statement)
+    # One insert per chunk
+    assert len(statements) == 2
+    result = crud.get_deliveries(db, notification_id)
+    assert [
+        (d.username, d.token, d.platform, d.status, d.status_code, d.reason)
+        for d in result
+    ] == [
+        (user1.username, "ios-token", "ios", "success", 200, None),
+        (
+            user1.username,
+            "android-token1",
+            "android",
+            "unregistered",
+            404,
+            "UNREGISTERED",
+        ),
+        (user2.username, "android-token2", "android", "failure", None, "ConnectError"),
+    ]
+    assert result[0].attempts == 1
+    # Paginated by id and filtered by status
+    page = crud.get_deliveries(db, notification_id, limit=2)
+    assert [d.id for d in page] == [d.id for d in result[:2]]
+    page = crud.get_deliveries(db, notification_id, limit=2, after=page[-1].id)
+    assert [d.id for d in page] == [result[2].id]
+    failures = crud.get_deliveries(
+        db, notification_id, status=schemas.DeliveryStatus.failure
+    )
+    assert [d.token for d in failures] == ["android-token2"]
+    assert crud.get_delivery_summary(db, notification_id) == schemas.DeliverySummary(
+        notification_id=notification_id,
+        total=3,
+        success=1,
+        failure=1,
+        unregistered=1,
+        nb_users=2,
+        nb_users_reached=1,
+        latency_max=0.5,
+        reasons={"UNREGISTERED": 1, "ConnectError": 1},
+    )
+    # Deliveries are deleted with the user and the notification
+    crud.delete_user(db, user2)
+    assert len(crud.get_deliveries(db, notification_id)) == 2
+    crud.delete_notifications(db, -1)
+    assert db.query(models.Delivery).count() == 0
+    assert crud.get_delivery_summary(db, notification_id).total == 0
@@ -0,0 +1,17 @@
+import threading
+import pytest
+from app import crud, crud_async
+
+
+@pytest.mark.asyncio
+async def test_run_in_threadpool():
+    assert await crud_async.run(threading.get_ident) != threading.get_ident()
+
+
+@pytest.mark.asyncio
+async def test_awaitable_crud_function(db, user_factory):
+    user = user_factory(username="johndoe")
+    db.commit()
+    assert await crud_async.get_user_by_username(db, "johndoe") == user
+    assert await crud_async.get_user_by_username(db, "unknown") is None
+    assert crud_async.get_user_by_username.__doc__ == crud.get_user_by_username.__doc__
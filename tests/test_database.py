@@ -0,0 +1,61 @@
+import sqlite3
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from app.database import InstrumentedQueuePool, get_pool_status
+
+
+@pytest.fixture
+def pool_engine():
+    engine = create_engine(
+        "sqlite://",
+        creator=lambda: sqlite3.connect(":memory:", check_same_thread=False),
+        poolclass=InstrumentedQueuePool,
+        pool_size=1,
+        max_overflow=1,
+        pool_timeout=0.1,
+    )
+    yield engine
+    engine.dispose()
+
+
+def test_instrumented_pool(pool_engine):
+    pool = pool_engine.pool
+    assert get_pool_status(pool) == {
+        "pool": "InstrumentedQueuePool",
+        "size": 1,
+        "max_overflow": 1,
+        "checked_in": 0,
+        "checked_out": 0,
+        "overflow": 0,
+        "checkouts": 0,
+        "timeouts": 0,
+        "wait_time_total": 0.0,
+        "wait_time_max": 0.0,
+    }
+    connection1 = pool_engine.connect()
+    connection2 = pool_engine.connect()
+    status = get_pool_status(pool)
+    assert status["checked_out"] == 2
+    assert status["overflow"] == 1
+    assert status["checkouts"] == 2
+    # No connection available
+    with pytest.raises(PoolTimeoutError):
+        pool_engine.connect()
+    status = get_pool_status(pool)
+    assert status["timeouts"] == 1
+    assert status["wait_time_max"] >= 0.1
+    assert status["wait_time_total"] >= status["wait_time_max"]
+    connection1.close()
+    connection2.close()
+    status = get_pool_status(pool)
+    assert status["checked_out"] == 0
+    assert status["checked_in"] == 1
+
+
+def test_instrumented_pool_recreate(pool_engine):
+    pool_engine.connect().close()
+    stats = pool_engine.pool.stats
+    pool_engine.dispose()
+    assert pool_engine.pool.stats is stats
+    assert get_pool_status(pool_engine.pool)["checkouts"] == 1
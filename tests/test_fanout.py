@@ -0,0 +1,149 @@
+import httpx
+import pytest
+import pytest_asyncio
+from app import clients, crud, fanout, schemas
+
+
+@pytest_asyncio.fixture
+async def pool():
+    pool = clients.ClientPool("test", size=1)
+    yield pool
+    await pool.stop()
+
+
+def push_result(status_code, retry_after=None):
+    if status_code == 200:
+        status = schemas.DeliveryStatus.success
+    elif status_code == 410:
+        status = schemas.DeliveryStatus.unregistered
+    else:
+        status = schemas.DeliveryStatus.failure
+    return crud.PushResult(status, status_code=status_code, retry_after=retry_after)
+
+
+@pytest.mark.parametrize("retry", [1, 2, 3, 10])
+def test_retry_delay(retry):
+    for _ in range(20):
+        delay = fanout.retry_delay(retry, base_delay=1, max_delay=5)
+        assert 0 <= delay <= min(2 ** (retry - 1), 5)
+
+
+def test_retry_delay_retry_after():
+    assert fanout.retry_delay(1, retry_after=3, max_delay=5) == 3
+    # Don't wait longer than max_delay
+    assert fanout.retry_delay(1, retry_after=10, max_delay=5) is None
+
+
+@pytest.mark.asyncio
+async def test_fan_out(pool):
+    calls = []
+
+    async def send_push(client, token, name):
+        assert isinstance(client, httpx.AsyncClient)
+        calls.append((token, name))
+        return push_result(200)
+
+    async with fanout.FanOut(nb_workers=2) as fan_out:
+        for nb in range(10):
+            await fan_out.put(
+                nb,
+                f"token{nb}",
+                schemas.Platform.ios,
+                pool,
+                send_push,
+                f"token{nb}",
+                "foo",
+            )
+            # The producer waits when the queue is full
+            assert fan_out.queue.qsize() <= 4
+        await fan_out.join()
+    assert calls == [(f"token{nb}", "foo") for nb in range(10)]
+    deliveries = fan_out.pop_deliveries()
+    assert sorted(delivery.user_id for delivery in deliveries) == list(range(10))
+    assert all(delivery.result.success for delivery in deliveries)
+    assert fan_out.pop_deliveries() == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "results,expected_attempts,expected_status_code",
+    [
+        ([200], 1, 200),
+        ([None, 200], 2, 200),
+        ([503, 429, 200], 3, 200),
+        # Permanent errors aren't retried
+        ([400], 1, 400),
+        ([410], 1, 410),
+        # Retry budget exhausted
+        ([500, 500, 500], 3, 500),
+    ],
+)
+async def test_fan_out_retry(
+    pool, mocker, results, expected_attempts, expected_status_code
+):
+    mocker.patch("app.fanout.retry_delay", return_value=0)
+    send_push = mocker.AsyncMock(side_effect=[push_result(code) for code in results])
+    async with fanout.FanOut(nb_workers=1, max_retries=2) as fan_out:
+        await fan_out.put(1, "token", schemas.Platform.android, pool, send_push, "foo")
+        await fan_out.join()
+    assert send_push.call_count == expected_attempts
+    assert send_push.call_args.args[1:] == ("foo",)
+    (delivery,) = fan_out.pop_deliveries()
+    assert delivery.result.attempts == expected_attempts
+    assert delivery.result.status_code == expected_status_code
+
+
+@pytest.mark.asyncio
+async def test_fan_out_too_long_retry_after(pool, mocker):
+    send_push = mocker.AsyncMock(return_value=push_result(429, retry_after=3600))
+    async with fanout.FanOut(nb_workers=1) as fan_out:
+        await fan_out.put(1, "token", schemas.Platform.ios, pool, send_push)
+        await fan_out.join()
+    assert send_push.call_count == 1
+    (delivery,) = fan_out.pop_deliveries()
+    assert delivery.result.status_code == 429
+
+
+@pytest.mark.asyncio
+async def test_fan_out_exception(pool, mocker):
+    send_push = mocker.AsyncMock(side_effect=Exception("boom"))
+    async with fanout.FanOut(nb_workers=1) as fan_out:
+        await fan_out.put(1, "token", schemas.Platform.ios, pool, send_push)
+        await fan_out.join()
+    # Unexpected errors aren't retried
+    assert send_push.call_count == 1
+    (delivery,) = fan_out.pop_deliveries()
+    assert delivery.result.status == schemas.DeliveryStatus.failure
+    assert delivery.result.reason == "Exception('boom')"
+
+
+@pytest.mark.asyncio
+async def test_fan_out_retry_releases_worker(pool):
+    calls = []
+
+    async def send_push(client, name, results):
+        calls.append(name)
+        return results.pop(0)
+
+    async with fanout.FanOut(nb_workers=1) as fan_out:
+        await fan_out.put(
+            1,
+            "a",
+            schemas.Platform.ios,
+            pool,
+            send_push,
+            "a",
+            [push_result(503, 0.05), push_result(200)],
+        )
+        await fan_out.put(
+            2, "b", schemas.Platform.ios, pool, send_push, "b", [push_result(200)]
+        )
+        await fan_out.join()
+    # b was sent while a was waiting before its retry
+    assert calls == ["a", "b", "a"]
+    deliveries = fan_out.pop_deliveries()
+    assert [(delivery.token, delivery.result.attempts) for delivery in deliveries] == [
+        ("b", 1),
+        ("a", 2),
+    ]
+    assert deliveries[1].result.latency >= 0.05
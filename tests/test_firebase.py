@@ -1,8 +1,12 @@
+import asyncio
 import json
+import time
+from datetime import datetime, timedelta, timezone
 import pytest
 import httpx
 import respx
-from app import schemas, firebase
+from app import clients, fanout, firebase, schemas
+from . import fake_fcm
 
 
 @pytest.fixture(scope="module")
@@ -15,12 +19,81 @@ def android_payload():
     )
 
 
+@pytest.fixture
+def google_refresh(mocker):
+    """Mock the request of new access tokens to Google"""
+
+    def refresh(credentials, request):
+        # Give concurrent callers the time to ask for a token
+        time.sleep(0.01)
+        credentials.token = f"token-{google_refresh.call_count}"
+        credentials.expiry = datetime.now(timezone.utc).replace(
+            tzinfo=None
+        ) + timedelta(hours=1)
+
+    google_refresh = mocker.patch(
+        "google.oauth2.service_account.Credentials.refresh",
+        autospec=True,
+        side_effect=refresh,
+    )
+    return google_refresh
+
+
+@pytest.mark.asyncio
+async def test_access_token_cached(google_refresh):
+    access_token = firebase.AccessToken()
+    # The key file is only read on first use
+    assert access_token.credentials is None
+    assert await access_token.get() == "token-1"
+    assert await access_token.get() == "token-1"
+    assert google_refresh.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_access_token_single_flight(google_refresh):
+    access_token = firebase.AccessToken()
+    tokens = await asyncio.gather(*(access_token.get() for _ in range(10)))
+    assert tokens == ["token-1"] * 10
+    assert google_refresh.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_access_token_refresh_margin(google_refresh):
+    access_token = firebase.AccessToken(refresh_margin=300)
+    await access_token.get()
+    access_token.credentials.expiry = datetime.now(timezone.utc).replace(
+        tzinfo=None
+    ) + timedelta(seconds=310)
+    assert await access_token.get() == "token-1"
+    access_token.credentials.expiry -= timedelta(seconds=20)
+    assert access_token.is_stale
+    # Refreshed before Google considers the token expired
+    assert access_token.credentials.valid
+    assert await access_token.get() == "token-2"
+    assert not access_token.is_stale
+
+
+@pytest.mark.asyncio
+async def test_access_token_background_refresh(google_refresh):
+    access_token = firebase.AccessToken()
+    await access_token.start()
+    for _ in range(100):
+        if not access_token.is_stale:
+            break
+        await asyncio.sleep(0.01)
+    # Token refreshed without having to call get()
+    assert google_refresh.call_count == 1
+    assert not access_token.is_stale
+    await access_token.stop()
+    assert await access_token.get() == "token-1"
+
+
 @pytest.mark.asyncio
 async def test_create_headers(mocker):
     request_id = "5a3d2400-5552-4667-867a-9dc359ba1120"
     access_token = "my-token"
     mock_get_firebase_access_token = mocker.patch(
-        "app.firebase.get_access_token", return_value=access_token
+        "app.firebase.access_token.get", return_value=access_token
     )
     headers = await firebase.create_headers(request_id)
     assert mock_get_firebase_access_token.call_count == 1
@@ -39,11 +112,16 @@ async def test_send_push_to_android_success(db, user, android_payload):
     )
     request.side_effect = httpx.Response(200)
     async with httpx.AsyncClient() as client:
-        notification_sent = await firebase.send_push(client, android_payload, db, user)
+        notification_sent = await firebase.send_push(
+            client,
+            android_payload.message.token,
+            android_payload.model_dump_json().encode(),
+            user.username,
+        )
     assert request.called
     req, _ = respx.calls[0]
     assert json.loads(req._content.decode("utf-8")) == android_payload.model_dump()
-    assert notification_sent
+    assert notification_sent.success
 
 
 @respx.mock
@@ -72,14 +150,52 @@ async def test_send_push_to_android_error(
     )
     request.side_effect = side_effect
     async with httpx.AsyncClient() as client:
-        notification_sent = await firebase.send_push(client, android_payload, db, user)
+        notification_sent = await firebase.send_push(
+            client,
+            android_payload.message.token,
+            android_payload.model_dump_json().encode(),
+            user.username,
+        )
     assert request.called
-    assert not notification_sent
+    assert not notification_sent.success
     # Device token still present
     db.refresh(user)
     assert user.device_tokens == [device_token]
 
 
+@respx.mock
+@pytest.mark.asyncio
+async def test_send_push_to_android_html_error_retried(android_payload, mocker):
+    mocker.patch("app.fanout.retry_delay", return_value=0)
+    request = respx.post(
+        "https://fcm.googleapis.com/v1/projects/my-project/messages:send",
+    )
+    request.side_effect = [
+        httpx.Response(503, html="<html><body>Service Unavailable</body></html>"),
+        httpx.Response(200, json={"name": "message"}),
+    ]
+    pool = clients.ClientPool("FCM", size=1)
+    try:
+        async with fanout.FanOut(nb_workers=1) as fan_out:
+            await fan_out.put(
+                1,
+                "my-token",
+                schemas.Platform.android,
+                pool,
+                firebase.send_push,
+                "my-token",
+                android_payload.model_dump_json().encode(),
+                "john",
+            )
+            await fan_out.join()
+    finally:
+        await pool.stop()
+    assert request.call_count == 2
+    (delivery,) = fan_out.pop_deliveries()
+    assert delivery.result.success
+    assert delivery.result.attempts == 2
+
+
 @respx.mock
 @pytest.mark.asyncio
 async def test_send_push_to_android_404(
@@ -93,11 +209,69 @@ async def test_send_push_to_android_404(
     request = respx.post(
         "https://fcm.googleapis.com/v1/projects/my-project/messages:send",
     )
-    request.side_effect = httpx.Response(404, json={"error": "message"})
+    request.side_effect = httpx.Response(
+        404,
+        json={
+            "error": {
+                "code": 404,
+                "message": "Requested entity was not found.",
+                "status": "NOT_FOUND",
+                "details": [
+                    {
+                        "@type": "type.googleapis.com/google.firebase.fcm.v1.FcmError",
+                        "errorCode": "UNREGISTERED",
+                    }
+                ],
+            }
+        },
+    )
     async with httpx.AsyncClient() as client:
-        notification_sent = await firebase.send_push(client, android_payload, db, user)
+        notification_sent = await firebase.send_push(
+            client,
+            android_payload.message.token,
+            android_payload.model_dump_json().encode(),
+            user.username,
+        )
     assert request.called
-    assert not notification_sent
+    assert notification_sent.status == schemas.DeliveryStatus.unregistered
+    assert notification_sent.reason == "UNREGISTERED"
+    # The token is deleted by the caller (see utils.send_notification)
     db.refresh(user)
-    # No longer active or invalid token deleted
-    assert user.device_tokens == []
+    assert user.device_tokens == [device_token]
+
+
+@pytest.mark.asyncio
+async def test_send_push_multiplexed(mocker):
+    async with fake_fcm.FakeFCM(latency=0.05) as server:
+        mocker.patch("app.firebase.FCM_URL", server.url)
+        pool = clients.ClientPool("FCM", size=1, http1=False)
+        tokens = [f"token{nb}" for nb in range(20)] + [
+            "unregistered-token",
+            "throttled-token",
+            "unavailable-token",
+        ]
+
+        async def send(token):
+            body = json.dumps({"message": {"token": token, "data": {}}}).encode()
+            async with pool.client() as client:
+                return await firebase.send_push(
+                    client, token, body, "john", headers={"Authorization": "Bearer foo"}
+                )
+
+        try:
+            results = await asyncio.gather(*(send(token) for token in tokens))
+        finally:
+            await pool.stop()
+    # All requests sent in parallel on one HTTP/2 connection
+    assert server.nb_connections == 1
+    assert server.max_concurrent_streams == len(tokens)
+    assert sorted(server.tokens) == sorted(tokens)
+    assert all(result.success for result in results[:20])
+    unregistered, throttled, unavailable = results[20:]
+    assert unregistered.status == schemas.DeliveryStatus.unregistered
+    assert unregistered.reason == "UNREGISTERED"
+    assert throttled.status_code == 429
+    assert throttled.retry_after == 1
+    assert throttled.is_transient
+    assert unavailable.status_code == 503
+    assert unavailable.is_transient
@@ -1,9 +1,11 @@
+import asyncio
 import json
 import pytest
 import httpx
 import respx
-from datetime import datetime
-from app import schemas, ios
+from datetime import datetime, timedelta
+from prometheus_client import REGISTRY
+from app import ios, schemas
 
 
 @pytest.fixture(scope="module")
@@ -11,7 +13,7 @@ def apn_payload():
     aps = schemas.Aps(
         alert=schemas.Alert(title="New alert", subtitle="This is a test"), badge=3
     )
-    return schemas.ApnPayload(aps=aps)
+    return schemas.ApnPayload(aps=aps).model_dump_json().encode()
 
 
 def test_create_headers():
@@ -22,6 +24,7 @@ def test_create_headers():
         "apns-priority",
         "apns-topic",
         "authorization",
+        "content-type",
     }
     assert headers["apns-expiration"] == "0"
     assert headers["apns-priority"] == "10"
@@ -38,11 +41,12 @@ async def test_send_push_to_ios_success(db, user, apn_payload):
     )
     request.side_effect = httpx.Response(200)
     async with httpx.AsyncClient(http2=True) as client:
-        notification_sent = await ios.send_push(client, apn, apn_payload, db, user)
+        notification_sent = await ios.send_push(client, apn, apn_payload, user.username)
     assert request.called
     req, _ = respx.calls[0]
-    assert json.loads(req._content.decode("utf-8")) == apn_payload.model_dump()
-    assert notification_sent
+    assert json.loads(req._content.decode("utf-8")) == json.loads(apn_payload)
+    assert req.headers["content-type"] == "application/json"
+    assert notification_sent.success
 
 
 @respx.mock
@@ -70,10 +74,10 @@ async def test_send_push_to_ios_error(db, user_factory, apn_payload, side_effect
     request.side_effect = side_effect
     async with httpx.AsyncClient(http2=True) as client:
         notification_sent = await ios.send_push(
-            client, device_token, apn_payload, db, user
+            client, device_token, apn_payload, user.username
         )
     assert request.called
-    assert not notification_sent
+    assert not notification_sent.success
     db.refresh(user)
     assert user.device_tokens == [device_token]
 
@@ -88,12 +92,162 @@ async def test_send_push_to_ios_410(db, user_factory, apn_payload):
         f"https://api.development.push.apple.com/3/device/{device_token}",
     )
     request.side_effect = httpx.Response(410)
+    nb_requests = (
+        REGISTRY.get_sample_value(
+            "notify_push_requests_total", {"platform": "ios", "status_code": "410"}
+        )
+        or 0
+    )
     async with httpx.AsyncClient(http2=True) as client:
         notification_sent = await ios.send_push(
-            client, device_token, apn_payload, db, user
+            client, device_token, apn_payload, user.username
         )
     assert request.called
-    assert not notification_sent
+    assert notification_sent.status == schemas.DeliveryStatus.unregistered
+    assert notification_sent.status_code == 410
+    # The token is deleted by the caller (see utils.send_notification)
     db.refresh(user)
-    # No longer active token deleted
-    assert user.device_tokens == []
+    assert user.device_tokens == [device_token]
+    assert (
+        REGISTRY.get_sample_value(
+            "notify_push_requests_total", {"platform": "ios", "status_code": "410"}
+        )
+        == nb_requests + 1
+    )
+
+
+def test_provider_token_cached():
+    provider_token = ios.ProviderToken()
+    headers = provider_token.headers()
+    assert headers["authorization"].startswith("Bearer")
+    # The token is only signed once
+    assert provider_token.headers() is headers
+
+
+def test_provider_token_refresh_interval():
+    provider_token = ios.ProviderToken(refresh_interval=3000)
+    headers = provider_token.headers()
+    provider_token.issued_at -= timedelta(seconds=2999)
+    assert provider_token.headers() is headers
+    provider_token.issued_at -= timedelta(seconds=1)
+    assert provider_token.is_stale
+    new_headers = provider_token.headers()
+    assert new_headers is not headers
+    assert not provider_token.is_stale
+
+
+def test_provider_token_min_refresh_interval():
+    # Apple throttles refreshes more frequent than every 20 minutes
+    provider_token = ios.ProviderToken(refresh_interval=60)
+    assert provider_token.refresh_interval == timedelta(minutes=20)
+
+
+def test_provider_token_expire():
+    provider_token = ios.ProviderToken()
+    headers = provider_token.headers()
+    provider_token.expire(headers)
+    new_headers = provider_token.headers()
+    assert new_headers is not headers
+    # Expiring old headers doesn't trigger a new refresh
+    provider_token.expire(headers)
+    assert provider_token.headers() is new_headers
+
+
+@pytest.mark.asyncio
+async def test_provider_token_background_refresh():
+    provider_token = ios.ProviderToken()
+    await provider_token.start()
+    await asyncio.sleep(0.01)
+    # Token refreshed without having to call headers()
+    assert provider_token.issued_at is not None
+    await provider_token.stop()
+
+
+@pytest.mark.asyncio
+async def test_provider_token_background_refresh_margin():
+    provider_token = ios.ProviderToken(refresh_interval=3000, refresh_margin=60)
+    provider_token.refresh()
+    issued_at = provider_token.issued_at - timedelta(seconds=2950)
+    provider_token.issued_at = issued_at
+    # Not stale yet but refreshed in the background before requests need it
+    assert not provider_token.is_stale
+    await provider_token.start()
+    await asyncio.sleep(0.05)
+    assert provider_token.issued_at > issued_at
+    await provider_token.stop()
+
+
+@pytest.mark.asyncio
+async def test_provider_token_background_refresh_failure(mocker):
+    mock_create_headers = mocker.patch(
+        "app.ios.create_headers", side_effect=[ValueError("Invalid key"), {}]
+    )
+    provider_token = ios.ProviderToken()
+    await provider_token.start()
+    await asyncio.sleep(0.01)
+    # The background task keeps running after a failure
+    assert mock_create_headers.call_count == 1
+    assert provider_token.issued_at is None
+    assert not provider_token._refresh_task.done()
+    await provider_token.stop()
+
+
+def test_provider_token_refresh_margin_min_interval():
+    provider_token = ios.ProviderToken(refresh_interval=60, refresh_margin=600)
+    provider_token.refresh()
+    # Never refreshed more often than every 20 minutes
+    assert provider_token.next_refresh - provider_token.issued_at == timedelta(
+        minutes=20
+    )
+
+
+@respx.mock
+@pytest.mark.asyncio
+async def test_send_push_to_ios_expired_provider_token(db, user, apn_payload, mocker):
+    apn = "apn-token"
+    mock_expire = mocker.spy(ios.provider_token, "expire")
+    request = respx.post(
+        f"https://api.development.push.apple.com/3/device/{apn}",
+    )
+    request.side_effect = [
+        httpx.Response(403, json={"reason": "ExpiredProviderToken"}),
+        httpx.Response(200),
+    ]
+    async with httpx.AsyncClient(http2=True) as client:
+        notification_sent = await ios.send_push(client, apn, apn_payload, user.username)
+    assert notification_sent.success
+    assert notification_sent.attempts == 2
+    assert request.call_count == 2
+    assert mock_expire.call_count == 1
+    # The second request used the new token
+    first, second = respx.calls
+    assert (
+        first.request.headers["authorization"]
+        != second.request.headers["authorization"]
+    )
+
+
+@respx.mock
+@pytest.mark.asyncio
+async def test_send_push_to_ios_too_many_provider_token_updates(
+    db, user, apn_payload, mocker
+):
+    apn = "apn-token"
+    ios.provider_token.headers()
+    mock_refresh = mocker.spy(ios.provider_token, "refresh")
+    request = respx.post(
+        f"https://api.development.push.apple.com/3/device/{apn}",
+    )
+    request.side_effect = [
+        httpx.Response(429, json={"reason": "TooManyProviderTokenUpdates"}),
+        httpx.Response(429, json={"reason": "TooManyProviderTokenUpdates"}),
+    ]
+    async with httpx.AsyncClient(http2=True) as client:
+        notification_sent = await ios.send_push(client, apn, apn_payload, user.username)
+    # Only retried once with the same token
+    assert not notification_sent.success
+    assert notification_sent.status_code == 429
+    assert notification_sent.reason == "TooManyProviderTokenUpdates"
+    assert notification_sent.attempts == 2
+    assert request.call_count == 2
+    assert not mock_refresh.called
@@ -1,7 +1,8 @@
 import uuid
 from datetime import datetime, timedelta, timezone
 from sqlalchemy.orm import Session
-from app import schemas
+import pytest
+from app import models, schemas
 
 
 def test_user(db: Session, user_factory) -> None:
@@ -12,7 +13,7 @@ def test_user(db: Session, user_factory) -> None:
     assert not user.is_admin
     assert not hasattr(user, "token")
     assert user.device_tokens == []
-    assert user._device_tokens == ""
+    assert user.tokens == []
 
 
 def test_user_is_logged_in(db: Session, user_factory) -> None:
@@ -27,11 +28,9 @@ def test_user_add_device_token(db: Session, user) -> None:
     device_token1 = "my-token"
     user.add_device_token(device_token1)
     assert user.device_tokens == [device_token1]
-    assert user._device_tokens == device_token1
     device_token2 = "another-token"
     user.add_device_token(device_token2)
     assert user.device_tokens == [device_token1, device_token2]
-    assert user._device_tokens == f"{device_token1};{device_token2}"
     # Adding an existing token doesn't change anything
     user.add_device_token(device_token1)
     assert user.device_tokens == [device_token1, device_token2]
@@ -54,6 +53,37 @@ def test_user_tokens(db: Session, user_factory, make_device_token) -> None:
     user = user_factory(device_tokens=[token1, token2, token3, token4])
     assert user.ios_tokens == [token1, token3]
     assert user.android_tokens == [token2, token4]
+    assert [device_token.platform for device_token in user.tokens] == [
+        "ios",
+        "android",
+        "ios",
+        "android",
+    ]
+
+
+def test_user_device_tokens_setter(db: Session, user_factory) -> None:
+    user = user_factory(device_tokens=["first-token", "second-token"])
+    db.commit()
+    first_token = user.tokens[0]
+    user.device_tokens = ["third-token", "first-token"]
+    db.commit()
+    # Existing tokens are kept (tokens are sorted by creation)
+    assert user.device_tokens == ["first-token", "third-token"]
+    assert user.tokens[0] is first_token
+    assert db.query(models.DeviceToken).count() == 2
+
+
+@pytest.mark.parametrize(
+    "length, platform",
+    [
+        (10, None),
+        (63, None),
+        (64, schemas.Platform.ios),
+        (152, schemas.Platform.android),
+    ],
+)
+def test_get_platform(make_device_token, length, platform) -> None:
+    assert models.get_platform(make_device_token(length)) == platform
 
 
 def test_user_subscribe_service(db: Session, user, service_factory):
@@ -1,7 +1,66 @@
+import httpx
+import os
+import subprocess
+import sys
 from fastapi.testclient import TestClient
+from app import monitoring
 
 
 def test_health_check(client: TestClient, api_version):
     response = client.get(f"/api/{api_version}/-/health")
     assert response.status_code == 200
     assert response.text == "OK"
+
+
+def test_pool_status(client: TestClient, api_version):
+    response = client.get(f"/api/{api_version}/-/pool")
+    assert response.status_code == 200
+    # The tests use an in-memory sqlite database
+    assert response.json() == {"pool": "StaticPool"}
+
+
+def test_metrics(client: TestClient, api_version, service, user_token_headers):
+    response = client.get(
+        f"/api/{api_version}/users/user/profile", headers=user_token_headers
+    )
+    assert response.status_code == 200
+    response = client.get(f"/api/{api_version}/-/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=")
+    assert "# TYPE notify_pushes_total counter" in response.text
+    assert "notify_push_jobs_queued 0" in response.text
+    assert (
+        'notify_http_request_duration_seconds_count{method="GET",'
+        f'route="/api/{api_version}/users/user/profile",status_code="200"}}'
+    ) in response.text
+
+
+def test_metrics_multiprocess(db, tmp_path, monkeypatch):
+    # Values written by another process (e.g. a gunicorn worker)
+    env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path)}
+    code = (
+        "from app import metrics; "
+        "metrics.pushes.labels(platform='ios', result='success').inc(2)"
+    )
+    subprocess.run([sys.executable, "-c", code], env=env, check=True)
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    registry = monitoring.create_registry()
+    assert (
+        registry.get_sample_value(
+            "notify_pushes_total", {"platform": "ios", "result": "success"}
+        )
+        == 2
+    )
+    assert registry.get_sample_value("notify_push_jobs_queued") == 0
+
+
+def test_metrics_server():
+    server = monitoring.start_metrics_server(0, host="127.0.0.1")
+    port = server.server_port
+    try:
+        response = httpx.get(f"http://127.0.0.1:{port}/metrics")
+        assert response.status_code == 200
+        assert "# TYPE notify_pushes_total counter" in response.text
+    finally:
+        server.shutdown()
+        server.server_close()
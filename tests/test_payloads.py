@@ -0,0 +1,46 @@
+import json
+import pytest
+from app import payloads
+
+
+@pytest.mark.parametrize(
+    "title,subtitle",
+    [
+        ("My alert", "This is a test"),
+        ('"quoted" \\ title', "line1\nline2"),
+        ("Température élevée", "Ümlaut 🔥"),
+        # Title looking like a placeholder
+        ("__placeholder__", ""),
+    ],
+)
+def test_notification_payloads(notification_factory, title, subtitle):
+    notification = notification_factory(title=title, subtitle=subtitle, url="")
+    notification_payloads = payloads.NotificationPayloads(notification)
+    for badge in (0, 3, 3, 42):
+        assert (
+            json.loads(notification_payloads.apn(badge))
+            == notification.to_apn_payload(badge).model_dump()
+        )
+    for token in ("my-token", "a" * 152):
+        assert (
+            json.loads(notification_payloads.android(token))
+            == notification.to_android_payload(token).model_dump()
+        )
+
+
+def test_notification_payloads_long_subtitle(notification_factory):
+    notification = notification_factory(subtitle="x" * 1000)
+    body = json.loads(payloads.NotificationPayloads(notification).apn(1))
+    assert body["aps"]["alert"]["subtitle"] == "x" * 256
+
+
+def test_notification_payloads_apn_cached(notification_factory):
+    notification_payloads = payloads.NotificationPayloads(notification_factory())
+    assert notification_payloads.apn(2) is notification_payloads.apn(2)
+
+
+def test_template():
+    template = payloads.Template({"a": "value", "b": [1, "X"]}, "X")
+    assert template.render(b"2") == b'{"a":"value","b":[1,2]}'
+    with pytest.raises(ValueError):
+        payloads.Template({"a": "X", "b": "X"}, "X")
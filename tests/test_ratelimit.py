@@ -0,0 +1,137 @@
+import pytest
+from app import models, ratelimit
+
+
+@pytest.fixture
+def clock(mocker):
+    """Control the time seen by the backends"""
+    now = [1000.0]
+    mocker.patch("app.ratelimit.time.monotonic", side_effect=lambda: now[0])
+    mocker.patch("app.ratelimit.time.time", side_effect=lambda: now[0])
+    return now
+
+
+@pytest.fixture(params=["memory", "database"])
+def backend(request, db, mocker):
+    if request.param == "memory":
+        return ratelimit.MemoryBackend()
+    # Use the test session
+    mocker.patch.object(db, "close")
+    return ratelimit.DatabaseBackend(lambda: db)
+
+
+@pytest.mark.parametrize(
+    "tokens,elapsed,expected",
+    [
+        (5, 0, (4, 0)),
+        (0, 0, (0, 0.5)),
+        (0, 1, (1, 0)),
+        (0.5, 0, (0.5, 0.25)),
+        # Never more than the burst
+        (2, 100, (4, 0)),
+    ],
+)
+def test_take_token(tokens, elapsed, expected):
+    assert ratelimit.take_token(tokens, elapsed, rate=2, burst=5) == expected
+
+
+@pytest.mark.parametrize(
+    "tokens,cost,expected",
+    [
+        (5, 3, (2, 0)),
+        (2, 3, (2, 0.5)),
+        # A cost above the burst needs a full bucket and leaves a debt
+        (4, 8, (4, 0.5)),
+        (5, 8, (-3, 0)),
+        (-3, 1, (-3, 2)),
+    ],
+)
+def test_take_token_cost(tokens, cost, expected):
+    assert ratelimit.take_token(tokens, 0, rate=2, burst=5, cost=cost) == expected
+
+
+def test_rate_limit(backend, clock):
+    rate_limit = ratelimit.RateLimit("service", rate=2, burst=3, backend=backend)
+    assert [rate_limit.acquire("foo") for _ in range(4)] == [0, 0, 0, 0.5]
+    # Each key has its own bucket
+    assert rate_limit.acquire("bar") == 0
+    clock[0] += 0.5
+    assert rate_limit.acquire("foo") == 0
+    assert rate_limit.acquire("foo") == 0.5
+    clock[0] += 10
+    assert [rate_limit.acquire("foo") for _ in range(4)] == [0, 0, 0, 0.5]
+    backend.clear()
+    assert rate_limit.acquire("foo") == 0
+
+
+def test_rate_limit_cost(backend, clock):
+    rate_limit = ratelimit.RateLimit("service", rate=2, burst=3, backend=backend)
+    assert rate_limit.acquire("foo", 2) == 0
+    assert rate_limit.acquire("foo", 2) == 0.5
+    clock[0] += 1
+    assert rate_limit.acquire("foo", 10) == 0
+    # The next requests wait until the 7 extra tokens are paid back
+    assert rate_limit.acquire("foo") == 4
+    clock[0] += 4
+    assert rate_limit.acquire("foo") == 0
+
+
+def test_rate_limit_disabled(backend):
+    rate_limit = ratelimit.RateLimit("service", rate=0, burst=1, backend=backend)
+    assert all(rate_limit.acquire("foo") == 0 for _ in range(10))
+
+
+def test_rate_limit_purge(backend, clock):
+    per_service = ratelimit.RateLimit("service", rate=2, burst=4, backend=backend)
+    per_ip = ratelimit.RateLimit("ip", rate=1, burst=4, backend=backend)
+    per_service.acquire("foo", 4)
+    per_service.acquire("bar")
+    per_ip.acquire("10.0.0.1", 2)
+    clock[0] += 1
+    # Only the buckets full again are deleted
+    assert per_service.purge() == 1
+    assert per_ip.purge() == 0
+    clock[0] += 1
+    assert per_service.purge() == 1
+    assert per_ip.purge() == 1
+    # Until the debt of a large request is paid back
+    per_service.acquire("foo", 10)
+    clock[0] += 2.5
+    assert per_service.purge() == 0
+    clock[0] += 2.5
+    assert per_service.purge() == 1
+    # All the buckets are deleted when the limit is disabled
+    per_ip.acquire("10.0.0.1")
+    per_ip.rate = 0
+    assert per_ip.purge() == 1
+
+
+def test_backend_abstract():
+    with pytest.raises(TypeError):
+        ratelimit.Backend()
+
+
+def test_database_backend_shared(db, mocker, clock):
+    mocker.patch.object(db, "close")
+    # Two processes using the same database
+    rate_limit1 = ratelimit.RateLimit(
+        "ip", rate=1, burst=2, backend=ratelimit.DatabaseBackend(lambda: db)
+    )
+    rate_limit2 = ratelimit.RateLimit(
+        "ip", rate=1, burst=2, backend=ratelimit.DatabaseBackend(lambda: db)
+    )
+    assert rate_limit1.acquire("10.0.0.1") == 0
+    assert rate_limit2.acquire("10.0.0.1") == 0
+    assert rate_limit1.acquire("10.0.0.1") == 1
+    bucket = db.query(models.RateLimit).one()
+    assert bucket.key == "ip:10.0.0.1"
+
+
+def test_memory_backend_size(clock):
+    backend = ratelimit.MemoryBackend(size=2)
+    rate_limit = ratelimit.RateLimit("ip", rate=1, burst=1, backend=backend)
+    for key in ("a", "b", "a", "c"):
+        rate_limit.acquire(key)
+    assert rate_limit.acquire("a") == 1
+    # Least recently used bucket dropped
+    assert rate_limit.acquire("b") == 0
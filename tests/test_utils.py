@@ -1,6 +1,21 @@
+import json
 import pytest
 from datetime import datetime, timedelta, timezone
-from app import schemas, utils
+from sqlalchemy import event
+from starlette.requests import Request
+from prometheus_client import REGISTRY
+from app import crud, crud_async, models, schemas, utils
+from app.database import engine
+
+
+@pytest.fixture
+def session_local(db, mocker):
+    """Make send_notification use the test session
+
+    Deliveries are committed: a new session would commit the test transaction.
+    """
+    mocker.patch.object(db, "close")
+    return mocker.patch("app.utils.SessionLocal", return_value=db)
 
 
 @pytest.mark.parametrize(
@@ -16,6 +31,64 @@ def test_is_ip_allowed(ip, allowed_networks, expected):
     assert utils.is_ip_allowed(ip, allowed_networks) is expected
 
 
+@pytest.mark.parametrize(
+    "ip,expected",
+    [
+        ("10.0.0.0", True),
+        ("10.0.255.255", True),
+        ("10.1.0.0", True),
+        ("10.1.0.255", True),
+        ("10.1.1.0", False),
+        ("9.255.255.255", False),
+        ("192.168.1.7", True),
+        ("192.168.1.8", False),
+        ("2001:db8::1", True),
+        ("2001:db9::", False),
+        ("::ffff:10.0.0.1", False),
+        ("foo", False),
+    ],
+)
+def test_network_matcher(ip, expected):
+    matcher = utils.NetworkMatcher(
+        [
+            "10.0.0.0/16",
+            "10.0.128.0/24",
+            # Adjacent to 10.0.0.0/16
+            "10.1.0.0/24",
+            "192.168.1.7/32",
+            "2001:db8::/32",
+        ]
+    )
+    # Overlapping and adjacent networks are merged
+    assert matcher.nb_ranges == 3
+    assert (ip in matcher) is expected
+
+
+def test_network_matcher_large():
+    # Every other /24 network of 10.0.0.0/8
+    matcher = utils.NetworkMatcher(
+        [f"10.{nb // 128}.{(nb % 128) * 2}.0/24" for nb in range(256 * 128)]
+    )
+    assert matcher.nb_ranges == 256 * 128
+    assert "10.3.4.1" in matcher
+    assert "10.3.5.1" not in matcher
+    assert "10.255.254.255" in matcher
+    assert "10.255.255.0" not in matcher
+
+
+def test_network_matcher_empty():
+    matcher = utils.NetworkMatcher([])
+    assert not matcher
+    assert "10.0.0.1" not in matcher
+    # Any IP is allowed without network
+    assert utils.check_ips(["10.0.0.1"], matcher)
+
+
+def test_network_matcher_invalid():
+    with pytest.raises(ValueError):
+        utils.NetworkMatcher(["192.168.1.1/24"])
+
+
 @pytest.mark.parametrize(
     "ips,allowed_networks,expected",
     [
@@ -37,14 +110,43 @@ def test_check_ips(ips, allowed_networks, expected):
     assert utils.check_ips(ips, allowed_networks) is expected
 
 
+@pytest.mark.parametrize(
+    "client, x_forwarded_for, expected",
+    [
+        (("10.0.0.1", 1234), None, "10.0.0.1"),
+        (None, None, ""),
+        (("10.0.0.1", 1234), ["192.168.1.2"], "192.168.1.2"),
+        (("10.0.0.1", 1234), ["192.0.2.1, 192.168.1.2"], "192.168.1.2"),
+        (("10.0.0.1", 1234), ["192.0.2.1", "192.168.1.2"], "192.168.1.2"),
+    ],
+)
+def test_get_client_ip(client, x_forwarded_for, expected):
+    request = Request({"type": "http", "client": client})
+    assert utils.get_client_ip(request, x_forwarded_for) == expected
+
+
 @pytest.mark.asyncio
 async def test_send_notification(
-    db, user_factory, notification_factory, make_device_token, mocker
+    db, session_local, user_factory, notification_factory, make_device_token, mocker
 ):
-    mock_send_push_to_ios = mocker.patch("app.ios.send_push")
-    mock_send_push_to_android = mocker.patch("app.firebase.send_push")
+    mock_send_push_to_ios = mocker.patch(
+        "app.ios.send_push",
+        return_value=crud.PushResult(schemas.DeliveryStatus.success, status_code=200),
+    )
+    mock_send_push_to_android = mocker.patch(
+        "app.firebase.send_push",
+        side_effect=[
+            crud.PushResult(schemas.DeliveryStatus.success, status_code=200),
+            crud.PushResult(
+                schemas.DeliveryStatus.unregistered,
+                status_code=404,
+                reason="UNREGISTERED",
+            ),
+            Exception("boom"),
+        ],
+    )
     mock_get_firebase_access_token = mocker.patch(
-        "app.firebase.get_access_token", return_value="my-token"
+        "app.firebase.access_token.get", return_value="my-token"
     )
     notification1 = notification_factory()
     notification2 = notification_factory()
@@ -54,11 +156,13 @@ async def test_send_notification(
     ios_token3 = make_device_token(64)
     ios_token4 = make_device_token(64)
     ios_token5 = make_device_token(64)
+    ios_token6 = make_device_token(64)
     android_token1 = make_device_token(128)
     android_token2 = make_device_token(128)
     android_token3 = make_device_token(128)
     android_token4 = make_device_token(128)
     android_token5 = make_device_token(128)
+    android_token6 = make_device_token(128)
     expire_date = datetime.now(timezone.utc) + timedelta(minutes=60)
     user1 = user_factory(
         device_tokens=[ios_token1, ios_token2], login_token_expire_date=expire_date
@@ -75,7 +179,7 @@ async def test_send_notification(
         login_token_expire_date=datetime.now(timezone.utc) + timedelta(minutes=-1),
     )
     user5 = user_factory(
-        device_tokens=[ios_token5, android_token5],
+        device_tokens=[ios_token6, android_token6],
         login_token_expire_date=expire_date,
         is_active=False,
     )
@@ -87,6 +191,14 @@ async def test_send_notification(
     user4.notifications.append(notification1)
     user5.notifications.append(notification1)
     db.commit()
+    # Notifications weren't added by create_service_notification
+    crud.reconcile_unread_counts(db)
+    nb_pruned = (
+        REGISTRY.get_sample_value(
+            "notify_device_tokens_pruned_total", {"platform": "android"}
+        )
+        or 0
+    )
     await utils.send_notification(notification1.id)
     # Check that send_push_to_ios was called 3 times
     # - twice for user1 (2 APN tokens)
@@ -111,12 +223,15 @@ async def test_send_notification(
         )
     )
     # Only keep second and third arguments (token and payload)
-    # first arg is httpx client and others (db and user) are internal
-    calls = [call.args[1:3] for call in mock_send_push_to_ios.call_args_list]
+    # first arg is httpx client and the other (username) is internal
+    calls = [
+        (call.args[1], json.loads(call.args[2]))
+        for call in mock_send_push_to_ios.call_args_list
+    ]
     expected_calls_args = [
-        (ios_token1, user1_payload),
-        (ios_token2, user1_payload),
-        (ios_token3, user2_payload),
+        (ios_token1, user1_payload.model_dump()),
+        (ios_token2, user1_payload.model_dump()),
+        (ios_token3, user2_payload.model_dump()),
     ]
     assert calls == expected_calls_args
     # Check that send_push_to_android was called 3 times
@@ -156,15 +271,55 @@ async def test_send_notification(
             ),
         )
     )
-    # Only keep second argument (payload)
-    # first arg is httpx client and others (db and user) are internal
-    calls = [(call.args[1],) for call in mock_send_push_to_android.call_args_list]
+    # Only keep second and third arguments (token and payload)
+    # first arg is httpx client and others (username and headers) are internal
+    calls = [
+        (call.args[1], json.loads(call.args[2]))
+        for call in mock_send_push_to_android.call_args_list
+    ]
     expected_calls_args = [
-        (user2_payload1,),
-        (user3_payload1,),
-        (user3_payload2,),
+        (android_token1, user2_payload1.model_dump()),
+        (android_token2, user3_payload1.model_dump()),
+        (android_token3, user3_payload2.model_dump()),
     ]
     assert calls == expected_calls_args
+    # The outcome of each push is saved
+    # (in the order the pushes completed)
+    deliveries = crud.get_deliveries(db, notification1.id)
+    assert sorted(
+        (d.username, d.token, d.status, d.reason) for d in deliveries
+    ) == sorted(
+        [
+            (user1.username, ios_token1, schemas.DeliveryStatus.success, None),
+            (user1.username, ios_token2, schemas.DeliveryStatus.success, None),
+            (user2.username, ios_token3, schemas.DeliveryStatus.success, None),
+            (user2.username, android_token1, schemas.DeliveryStatus.success, None),
+            (
+                user3.username,
+                android_token2,
+                schemas.DeliveryStatus.unregistered,
+                "UNREGISTERED",
+            ),
+            (
+                user3.username,
+                android_token3,
+                schemas.DeliveryStatus.failure,
+                "Exception('boom')",
+            ),
+        ]
+    )
+    # Unregistered token deleted
+    db.refresh(user3)
+    assert user3.device_tokens == [android_token3]
+    assert user3.tokens[0].last_success_at is None
+    assert (
+        REGISTRY.get_sample_value(
+            "notify_device_tokens_pruned_total", {"platform": "android"}
+        )
+        == nb_pruned + 1
+    )
+    db.refresh(user2)
+    assert all(token.last_success_at is not None for token in user2.tokens)
 
     # Check with invalid notification id
     # send_push_to_ios or android shouldn't be called
@@ -177,6 +332,108 @@ async def test_send_notification(
     assert not mock_send_push_to_android.called
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("nb_recipients", [1, 10, 50])
+async def test_send_notification_query_count(
+    db,
+    session_local,
+    user_factory,
+    notification_factory,
+    make_device_token,
+    mocker,
+    nb_recipients,
+):
+    result = crud.PushResult(schemas.DeliveryStatus.success, status_code=200)
+    mock_send_push_to_ios = mocker.patch("app.ios.send_push", return_value=result)
+    mock_send_push_to_android = mocker.patch(
+        "app.firebase.send_push", return_value=result
+    )
+    mocker.patch("app.firebase.access_token.get", return_value="my-token")
+    notification = notification_factory()
+    expire_date = datetime.now(timezone.utc) + timedelta(minutes=60)
+    for nb in range(nb_recipients):
+        user = user_factory(
+            username=f"user{nb}",
+            device_tokens=[make_device_token(64), make_device_token(128)],
+            login_token_expire_date=expire_date,
+        )
+        user.notifications.append(notification)
+    db.commit()
+    notification_id = notification.id
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count_statement)
+    try:
+        await utils.send_notification(notification_id)
+    finally:
+        event.remove(engine, "before_cursor_execute", count_statement)
+    assert mock_send_push_to_ios.call_count == nb_recipients
+    assert mock_send_push_to_android.call_count == nb_recipients
+    # The number of queries doesn't depend on the number of recipients:
+    # one to get the notification, one to get the recipients,
+    # one to get their device tokens, one to insert the deliveries
+    # and one to update the last success of the tokens
+    assert len(statements) == 5
+
+
+@pytest.mark.asyncio
+async def test_send_notification_pages(
+    db, session_local, user_factory, notification_factory, make_device_token, mocker
+):
+    result = crud.PushResult(schemas.DeliveryStatus.success, status_code=200)
+    mock_send_push_to_ios = mocker.patch("app.ios.send_push", return_value=result)
+    mocker.patch("app.firebase.access_token.get", return_value="my-token")
+    spy_get_recipients = mocker.spy(crud_async, "get_notification_recipients")
+    notification = notification_factory()
+    expire_date = datetime.now(timezone.utc) + timedelta(minutes=60)
+    for nb in range(5):
+        user = user_factory(
+            username=f"user{nb}",
+            device_tokens=[make_device_token(64)],
+            login_token_expire_date=expire_date,
+        )
+        user.notifications.append(notification)
+    db.commit()
+    notification_id = notification.id
+    await utils.send_notification(notification_id, page_size=2)
+    # Recipients are read by pages of 2 users
+    assert [call.args[2:] for call in spy_get_recipients.call_args_list] == [
+        (0, 2),
+        (db.query(models.User.id).filter_by(username="user1").scalar(), 2),
+        (db.query(models.User.id).filter_by(username="user3").scalar(), 2),
+    ]
+    assert mock_send_push_to_ios.call_count == 5
+    assert len(crud.get_deliveries(db, notification_id)) == 5
+
+
+@pytest.mark.asyncio
+async def test_send_notification_coalesced(
+    db, session_local, user_factory, notification_factory, make_device_token, mocker
+):
+    result = crud.PushResult(schemas.DeliveryStatus.success, status_code=200)
+    mock_send_push_to_ios = mocker.patch("app.ios.send_push", return_value=result)
+    mocker.patch("app.firebase.access_token.get", return_value="my-token")
+    notification = notification_factory(title="Alarm 5")
+    user = user_factory(
+        device_tokens=[make_device_token(64)],
+        login_token_expire_date=datetime.now(timezone.utc) + timedelta(minutes=60),
+    )
+    user.notifications.append(notification)
+    db.commit()
+    category = notification.service.category
+    await utils.send_notification(notification.id, nb_notifications=5)
+    # One summary pushed for the last 5 notifications of the service
+    assert mock_send_push_to_ios.call_count == 1
+    assert json.loads(mock_send_push_to_ios.call_args.args[2])["aps"]["alert"] == {
+        "title": f"5 new notifications from {category}",
+        "subtitle": "Alarm 5",
+    }
+    assert len(crud.get_deliveries(db, notification.id)) == 1
+
+
 def test_create_and_decode_access_token():
     username = "johndoe"
     encoded_token = utils.create_access_token(
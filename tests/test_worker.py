@@ -0,0 +1,108 @@
+import asyncio
+import pytest
+from app import crud, models, schemas, worker
+
+
+@pytest.fixture(autouse=True)
+def worker_session(db, mocker):
+    # Make the worker use the test session
+    mocker.patch("app.worker.SessionLocal", return_value=db)
+    mocker.patch.object(db, "close")
+
+
+@pytest.mark.asyncio
+async def test_process_job(db, service, mocker):
+    mock_send_notification = mocker.patch("app.utils.send_notification")
+    notification = crud.create_service_notification(
+        db, schemas.NotificationCreate(title="message"), service
+    )
+    (job,) = crud.claim_push_jobs(db, limit=10, lease=60)
+    await worker.process_job(job)
+    mock_send_notification.assert_called_once_with(notification.id, nb_notifications=1)
+    # Job removed from the queue once processed
+    assert db.query(models.PushJob).count() == 0
+
+
+@pytest.mark.asyncio
+async def test_process_job_failure(db, service, mocker):
+    mocker.patch("app.utils.send_notification", side_effect=Exception("boom"))
+    crud.create_service_notification(
+        db, schemas.NotificationCreate(title="message"), service
+    )
+    (job,) = crud.claim_push_jobs(db, limit=10, lease=60)
+    await worker.process_job(job)
+    # Job kept in the queue to be retried later
+    db_job = db.query(models.PushJob).one()
+    assert db_job.locked_until is None
+    assert db_job.available_at > models.utcnow()
+    assert db_job.attempts == 1
+
+
+@pytest.mark.asyncio
+async def test_process_job_max_attempts(db, service, mocker):
+    mock_send_notification = mocker.patch("app.utils.send_notification")
+    mocker.patch("app.worker.PUSH_JOB_MAX_ATTEMPTS", 1)
+    crud.create_service_notification(
+        db, schemas.NotificationCreate(title="message"), service
+    )
+    crud.claim_push_jobs(db, limit=10, lease=-1)
+    (job,) = crud.claim_push_jobs(db, limit=10, lease=60)
+    assert job.attempts == 2
+    await worker.process_job(job)
+    # Job dropped without trying again
+    assert not mock_send_notification.called
+    assert db.query(models.PushJob).count() == 0
+
+
+@pytest.mark.asyncio
+async def test_run(db, service_factory, mocker):
+    stop = asyncio.Event()
+    sent = []
+
+    async def send_notification(notification_id, nb_notifications):
+        sent.append(notification_id)
+        if len(sent) == 3:
+            stop.set()
+
+    mocker.patch("app.utils.send_notification", side_effect=send_notification)
+    mocker.patch("app.worker.PUSH_WORKER_POLL_INTERVAL", 0.01)
+    notifications = [
+        crud.create_service_notification(
+            db, schemas.NotificationCreate(title=f"message{nb}"), service_factory()
+        )
+        for nb in range(3)
+    ]
+    await asyncio.wait_for(worker.run(stop=stop), timeout=5)
+    assert sent == [notification.id for notification in notifications]
+    assert db.query(models.PushJob).count() == 0
+
+
+@pytest.mark.asyncio
+async def test_run_long_job(db, service_factory, mocker):
+    # A long job doesn't prevent the other slots from being refilled
+    stop = asyncio.Event()
+    others_sent = asyncio.Event()
+    sent = []
+    notifications = [
+        crud.create_service_notification(
+            db, schemas.NotificationCreate(title=f"message{nb}"), service_factory()
+        )
+        for nb in range(4)
+    ]
+
+    async def send_notification(notification_id, nb_notifications):
+        if notification_id == notifications[0].id:
+            await others_sent.wait()
+            stop.set()
+        sent.append(notification_id)
+        if len(sent) == 3:
+            others_sent.set()
+
+    mocker.patch("app.utils.send_notification", side_effect=send_notification)
+    mocker.patch("app.worker.PUSH_WORKER_POLL_INTERVAL", 0.01)
+    mocker.patch("app.worker.PUSH_WORKER_BATCH_SIZE", 2)
+    await asyncio.wait_for(worker.run(stop=stop), timeout=5)
+    assert sent == [notification.id for notification in notifications[1:]] + [
+        notifications[0].id
+    ]
+    assert db.query(models.PushJob).count() == 0